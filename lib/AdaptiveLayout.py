@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import numpy
+from lib import GridLayout
+
+DEFAULT_LEVELS = 2 # Tiles up to 2**levels times the collage image size
+DEFAULT_THRESHOLD = 24 # Colour standard deviation above which a tile is split (about the median of the 2x2 tiles of photos)
+
+class AdaptiveLayout(GridLayout.GridLayout):
+  # Square tiles of different sizes from a quadtree of the base image: a tile is split in four
+  # while its colour varies too much or it crosses the border, and it is bigger than the collage
+  # image size. The tiles are compared with the images on the same number of sectors, whatever their size
+
+  def __init__(self, collager, levels=DEFAULT_LEVELS, threshold=DEFAULT_THRESHOLD):
+    GridLayout.GridLayout.__init__(self, collager)
+    self.levels = levels
+    self.threshold = threshold
+    self.cells = None # (x, y, size) of every tile, in scan order
+    self.cells_map = None # Tile of every collage image sized square, -1 out of the cells
+    self.sums = None # Summed-area table of the base image, while loading
+    self.collage_near = False # The images already in the collage are near images too
+
+  def setup(self):
+    self.loadCells()
+    self.loadTiles()
+    self.loadColours()
+
+  def setupCells(self, cells):
+    # Tiles on the given (x, y, size) cells only, the images of a collage placed again:
+    # the images left around them are near images
+    self.loadSums()
+    self.setCells(cells)
+    self.collage_near = True
+    self.loadTiles()
+    self.loadColours()
+
+  def loadSums(self):
+    # Summed-area tables of the colours and of their squares, the table of the colours is kept
+    # for the sectors of the tiles
+    data = self.collager.base_image.getArray()
+    height, width, _ = data.shape
+    sums = numpy.zeros((height + 1, width + 1, 3), dtype=numpy.float64)
+    sums[1:, 1:] = numpy.cumsum(numpy.cumsum(data, axis=0, dtype=numpy.float64), axis=1)
+    squares = numpy.zeros((height + 1, width + 1, 3), dtype=numpy.float64)
+    squares[1:, 1:] = numpy.cumsum(numpy.cumsum(numpy.square(data, dtype=numpy.uint32), axis=0, dtype=numpy.float64), axis=1)
+    self.sums = sums
+    return sums, squares
+
+  def loadCells(self):
+    # Quadtree with the variance of the cells from summed-area tables
+    sums, squares = self.loadSums()
+    height, width = sums.shape[0] - 1, sums.shape[1] - 1
+    max_size = self.tile_size * 2 ** self.levels
+    cells = []
+    stack = []
+    for y in range(0, height, max_size):
+      for x in range(0, width, max_size):
+        stack.append((x, y, max_size))
+    while len(stack) > 0:
+      x, y, size = stack.pop()
+      # Only the tiles of the collage image size may cross the border
+      crossing = x + size > width or y + size > height
+      if size > self.tile_size and (crossing or self.getDeviation(sums, squares, x, y, size) > self.threshold):
+        half = size // 2
+        for dy in (0, half):
+          for dx in (0, half):
+            if x + dx < width and y + dy < height:
+              stack.append((x + dx, y + dy, half))
+      else:
+        cells.append((x, y, size))
+    self.setCells(cells)
+
+  def setCells(self, cells):
+    self.cells = sorted(cells, key=lambda el : (el[1], el[0]))
+    self.tiles_number = len(self.cells)
+    # Map of the tiles on the collage image sized squares, for the near images
+    self.cells_map = numpy.full((self.rows, self.columns), -1, dtype=numpy.int64)
+    for tile, (x, y, size) in enumerate(self.cells):
+      squares_number = size // self.tile_size
+      row, column = y // self.tile_size, x // self.tile_size
+      self.cells_map[row:row+squares_number, column:column+squares_number] = tile
+
+  def getDeviation(self, sums, squares, x, y, size):
+    # Mean over the channels of the colour standard deviation in the cell (clipped to the image)
+    height, width = sums.shape[0] - 1, sums.shape[1] - 1
+    x1, y1 = min(x + size, width), min(y + size, height)
+    count = (x1 - x) * (y1 - y)
+    total = sums[y1, x1] - sums[y, x1] - sums[y1, x] + sums[y, x]
+    total_squares = squares[y1, x1] - squares[y, x1] - squares[y1, x] + squares[y, x]
+    variance = numpy.maximum(total_squares / count - (total / count) ** 2, 0)
+    return float(numpy.mean(numpy.sqrt(variance)))
+
+  def loadTiles(self):
+    # Sectors of every tile on lines x lines sectors of a size proportional to the tile,
+    # from the summed-area table of loadCells
+    sums = self.sums
+    height, width = sums.shape[0] - 1, sums.shape[1] - 1
+    steps = numpy.arange(self.lines + 1)
+    tiles = numpy.full((self.tiles_number, self.lines, self.lines, 3), numpy.nan)
+    for tile, (x, y, size) in enumerate(self.cells):
+      sector = size // self.lines
+      xs = numpy.minimum(x + steps * sector, width)
+      ys = numpy.minimum(y + steps * sector, height)
+      corners = sums[ys][:, xs]
+      totals = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+      counts = numpy.diff(ys)[:, None] * numpy.diff(xs)[None, :]
+      # Sectors outside the base image stay nan
+      inside = counts > 0
+      tiles[tile][inside] = totals[inside] / counts[inside][:, None]
+    self.sums = None
+    # Sectors outside the base image are not compared
+    self.tiles_mask = numpy.logical_not(numpy.isnan(tiles[:, :, :, 0]))
+    tiles = numpy.nan_to_num(tiles)
+    counts = numpy.sum(self.tiles_mask, axis=(1, 2))
+    self.tiles_colour = numpy.sum(tiles, axis=(1, 2)) / counts[:, None]
+    self.tiles = tiles.astype(numpy.float32)
+
+  def getTilePosition(self, tile):
+    x, y, _ = self.cells[tile]
+    return x, y
+
+  def getTileSize(self, tile):
+    _, _, size = self.cells[tile]
+    return size, size
+
+  def getNearColours(self, assignment, tile):
+    # Colours already assigned to the tiles within near_size collage image sizes
+    near_size = self.collager.near_size
+    if near_size <= 0:
+      return numpy.zeros(0, dtype=numpy.int64)
+    x, y, size = self.cells[tile]
+    row, column = y // self.tile_size, x // self.tile_size
+    squares_number = size // self.tile_size
+    near = self.cells_map[max(row - near_size, 0):row + squares_number + near_size, max(column - near_size, 0):column + squares_number + near_size]
+    near = numpy.unique(near)
+    near = assignment[near[near >= 0]]
+    near = near[near >= 0]
+    if self.collage_near:
+      collage_near = [self.index[colour] for colour in self.collager.getNearImages((x, y))]
+      near = numpy.concatenate([near, numpy.array(collage_near, dtype=numpy.int64)])
+    return numpy.unique(near)
+
+def new(*args, **kwargs):
+  layout = AdaptiveLayout(*args, **kwargs)
+  return layout
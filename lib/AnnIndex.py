@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import numpy
+
+DEFAULT_DIMENSIONS = 16 # Size of the vectors after the PCA
+DEFAULT_PROBES = 4 # Lists visited by a query, more is slower with better recall
+KMEANS_ITERATIONS = 10
+KMEANS_CHUNK = 8192 # Vectors assigned at once
+
+class AnnIndex():
+  # Inverted file index over the sectors of a tile sized square of every colour:
+  # the vectors are reduced with a PCA and grouped around k-means centroids,
+  # a query only visits the lists of the closest centroids
+
+  def __init__(self, colours, lines, dimensions=DEFAULT_DIMENSIONS):
+    self.colours = colours
+    self.lines = lines # Sectors on each side of the square
+    self.index = {}
+    for i, colour in enumerate(colours):
+      self.index[colour] = i
+    vectors = numpy.array([self.getVector(colour.getSignature(colour.getSize())) for colour in colours], dtype=numpy.float32)
+    self.mean = numpy.mean(vectors, axis=0)
+    self.components = None
+    if vectors.shape[1] > dimensions and len(colours) > dimensions:
+      _, _, vt = numpy.linalg.svd(vectors - self.mean, full_matrices=False)
+      self.components = vt[:dimensions].T.astype(numpy.float32)
+    self.vectors = self.project(vectors)
+    self.buildLists(max(int(numpy.sqrt(len(colours))), 1))
+
+  def getVector(self, signature):
+    # Top left lines x lines sectors, the missing ones repeat the border
+    square = signature[:self.lines, :self.lines]
+    height, width, _ = square.shape
+    if height < self.lines or width < self.lines:
+      square = numpy.pad(square, ((0, self.lines - height), (0, self.lines - width), (0, 0)), mode='edge')
+    return square.reshape(-1)
+
+  def project(self, vectors):
+    if self.components is None:
+      return (vectors - self.mean).astype(numpy.float32)
+    return numpy.dot(vectors - self.mean, self.components).astype(numpy.float32)
+
+  def buildLists(self, lists_number):
+    # K-means on the projected vectors (fixed seed, the index is the same at every run)
+    random_state = numpy.random.RandomState(0)
+    self.centroids = self.vectors[random_state.choice(len(self.vectors), lists_number, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+      assignment = self.assignLists(self.vectors)
+      for l in range(lists_number):
+        members = self.vectors[assignment == l]
+        if len(members) > 0:
+          self.centroids[l] = numpy.mean(members, axis=0)
+    assignment = self.assignLists(self.vectors)
+    self.lists = [numpy.nonzero(assignment == l)[0] for l in range(lists_number)]
+    self.centroids_norms = numpy.sum(self.centroids ** 2, axis=1)
+    self.excluded = numpy.zeros(len(self.vectors), dtype=bool) # Excluded colours of a query, cleared after it
+
+  def assignLists(self, vectors):
+    assignment = numpy.zeros(len(vectors), dtype=numpy.int64)
+    for start in range(0, len(vectors), KMEANS_CHUNK):
+      chunk = vectors[start:start+KMEANS_CHUNK]
+      distances = numpy.sum((chunk[:, None] - self.centroids[None]) ** 2, axis=2)
+      assignment[start:start+KMEANS_CHUNK] = numpy.argmin(distances, axis=1)
+    return assignment
+
+  def query(self, refer_signature, excluded, k, probes=DEFAULT_PROBES):
+    # Indices of the (about) k colours closest to the refer sectors, without the excluded colours
+    vector = self.project(self.getVector(refer_signature)[None].astype(numpy.float32))[0]
+    excluded_indices = [self.index[colour] for colour in excluded if colour in self.index]
+    self.excluded[excluded_indices] = True
+    # Closest lists first: only the probed ones are sorted, the others if they are needed
+    distances = self.centroids_norms - 2 * numpy.dot(self.centroids, vector)
+    probes = min(max(probes, 1), len(distances))
+    closest = numpy.argpartition(distances, probes - 1)[:probes]
+    order = closest[numpy.argsort(distances[closest])]
+    candidates = []
+    found = 0
+    probed = 0
+    while probed < len(distances):
+      if probed == len(order):
+        if found >= k:
+          break
+        rest = numpy.ones(len(distances), dtype=bool)
+        rest[order] = False
+        rest = numpy.nonzero(rest)[0]
+        order = numpy.concatenate([order, rest[numpy.argsort(distances[rest])]])
+      members = self.lists[order[probed]]
+      members = members[numpy.logical_not(self.excluded[members])]
+      candidates.append(members)
+      found += len(members)
+      probed += 1
+      if probed >= probes and found >= k:
+        break
+    self.excluded[excluded_indices] = False
+    if found == 0:
+      return numpy.zeros(0, dtype=numpy.int64)
+    candidates = numpy.concatenate(candidates)
+    if len(candidates) > k:
+      distances = numpy.sum((self.vectors[candidates] - vector) ** 2, axis=1)
+      candidates = candidates[numpy.argpartition(distances, k - 1)[:k]]
+    return candidates
+
+def new(*args, **kwargs):
+  index = AnnIndex(*args, **kwargs)
+  return index
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import heapq
+import numpy
+
+AUCTION_EPSILON = 1.0 # Min bid increment (the solution is optimal within tiles * epsilon)
+DUMMY_PENALTY = 100.0 # Extra cost of leaving a tile unassigned
+
+class AuctionSolver():
+  # Min cost assignment of tiles to colours with capacities, solved with a sparse auction:
+  # every tile only bids for its candidate colours
+
+  def __init__(self, candidates, costs, capacities, epsilon=AUCTION_EPSILON):
+    self.candidates = numpy.array(candidates, dtype=numpy.int64) # (tiles, K) colour indices, -1 if missing
+    self.costs = costs # (tiles, K)
+    self.capacities = capacities # (colours,)
+    self.epsilon = epsilon
+    # If the candidates are full a tile stays unassigned
+    valid_costs = numpy.where(self.candidates >= 0, costs, -numpy.inf)
+    self.dummy_costs = numpy.max(valid_costs, axis=1)
+    self.dummy_costs = numpy.where(numpy.isfinite(self.dummy_costs), self.dummy_costs, 0.0) + DUMMY_PENALTY
+    # Auction state, kept between solve calls
+    tiles_number, _ = self.candidates.shape
+    self.assignment = numpy.full(tiles_number, -1, dtype=numpy.int64)
+    self.holders = {} # colour -> heap of (bid, tile)
+    self.prices = numpy.zeros(len(capacities), dtype=numpy.float64)
+
+  def solve(self, tiles=None):
+    # Assign the given tiles (all by default), returns the colour index of every tile, -1 for unassigned tiles
+    if tiles is None:
+      tiles = range(len(self.assignment))
+    queue = list(reversed(list(tiles)))
+    while len(queue) > 0:
+      tile = queue.pop()
+      candidates = self.candidates[tile]
+      valid = candidates >= 0
+      colours = candidates[valid]
+      if len(colours) == 0:
+        continue
+      values = self.costs[tile][valid] + self.prices[colours]
+      best = int(numpy.argmin(values))
+      best_value = values[best]
+      if best_value >= self.dummy_costs[tile]:
+        # Cheaper to stay unassigned
+        continue
+      if len(values) > 1:
+        second_value = min(numpy.partition(values, 1)[1], self.dummy_costs[tile])
+      else:
+        second_value = self.dummy_costs[tile]
+      colour = int(colours[best])
+      bid = self.prices[colour] + second_value - best_value + self.epsilon
+      # Assign to the colour and evict the lowest bidder if full
+      heap = self.holders.setdefault(colour, [])
+      heapq.heappush(heap, (bid, tile))
+      self.assignment[tile] = colour
+      if len(heap) > self.capacities[colour]:
+        _, evicted = heapq.heappop(heap)
+        self.assignment[evicted] = -1
+        queue.append(evicted)
+      if len(heap) > 0 and len(heap) >= self.capacities[colour]:
+        self.prices[colour] = heap[0][0]
+    return self.assignment
+
+def new(*args, **kwargs):
+  solver = AuctionSolver(*args, **kwargs)
+  return solver
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import numpy
+from lib import FeatureStore
+from lib import FittingCache
+
+BATCH_SIZE = 4096 # Candidates evaluated together
+
+class BatchMatcher():
+
+  def __init__(self, colours, levels, sector_size, min_size, ladder=None, store=None):
+    self.colours = colours
+    self.levels = levels
+    self.sector_size = sector_size
+    self.min_size = min_size
+    # Index of the colours (near images are colours)
+    self.index = {}
+    for i, colour in enumerate(colours):
+      self.index[colour] = i
+    # Dimensions, average colours and pyramids are read from the feature store (not copied)
+    if store is None:
+      store = FeatureStore.newFromColours(colours, levels)
+    self.store = store
+    self.widths = store['widths']
+    self.heights = store['heights']
+    self.averages = store['averages']
+    # Pyramids in a (colours, levels, height_lines, width_lines, 3) tensor
+    self.signatures_height = store['signatures_height']
+    self.signatures_width = store['signatures_width']
+    self.signatures = store['signatures']
+    # Resize intervals of the colours per area
+    self.fitting = FittingCache.new(colours, min_size, ladder)
+
+  def getColoursNumber(self):
+    return len(self.colours)
+
+  def checkFittings(self, indices, max_area, min_area):
+    # Same as Collager.checkFitting for all the given colours, the intervals are cached per area
+    return self.fitting.checkFittings(indices, max_area, min_area)
+
+  def selectLevels(self, indices, new_widths, new_heights):
+    # Pyramid level with the closest number of sectors, as in CollageColour.getSignature
+    width_lines = numpy.ceil(new_widths / self.sector_size)
+    height_lines = numpy.ceil(new_heights / self.sector_size)
+    distance = numpy.abs(self.signatures_height[indices] - height_lines[:, None]) + \
+               numpy.abs(self.signatures_width[indices] - width_lines[:, None])
+    return numpy.argmin(distance, axis=1)
+
+  def computeDistances(self, indices, levels, refer_signature):
+    # Mean colour distance of the overlapping sectors for each colour
+    _, _, max_height, max_width, _ = self.signatures.shape
+    refer_height, refer_width, _ = refer_signature.shape
+    refer = numpy.zeros((max_height, max_width, 3), dtype=numpy.float32)
+    height = min(max_height, refer_height)
+    width = min(max_width, refer_width)
+    refer[:height, :width] = refer_signature[:height, :width]
+    distances = numpy.zeros(len(indices), dtype=numpy.float64)
+    for start in range(0, len(indices), BATCH_SIZE):
+      batch = indices[start:start+BATCH_SIZE]
+      batch_levels = levels[start:start+BATCH_SIZE]
+      signatures = self.signatures[batch, batch_levels]
+      norms = numpy.linalg.norm(signatures - refer, axis=3)
+      heights = numpy.minimum(self.signatures_height[batch, batch_levels], refer_height)
+      widths = numpy.minimum(self.signatures_width[batch, batch_levels], refer_width)
+      mask = (numpy.arange(max_height)[None, :, None] < heights[:, None, None]) & \
+             (numpy.arange(max_width)[None, None, :] < widths[:, None, None])
+      counts = numpy.maximum(heights * widths, 1)
+      distances[start:start+BATCH_SIZE] = numpy.sum(norms * mask, axis=(1, 2)) / counts
+    return distances
+
+  def findBestFits(self, refer_signature, refer_colour, near_images, max_area, min_area, threshold, shuffle_distance, candidates=None):
+    # Returns the fits as in Collager.findBestFits and the colour with the closest average.
+    # With candidates (indices of colours that are not near images) only those are evaluated
+    if candidates is not None:
+      indices = candidates
+    else:
+      available = numpy.ones(len(self.colours), dtype=bool)
+      for img in near_images:
+        if img in self.index:
+          available[self.index[img]] = False
+      indices = numpy.nonzero(available)[0]
+    if len(indices) == 0:
+      return [], None
+    # Average colour threshold
+    averages_difference = numpy.linalg.norm(self.averages[indices] - numpy.array(refer_colour), axis=1)
+    best_fit_threshold = self.colours[indices[numpy.argmin(averages_difference)]]
+    indices = indices[averages_difference <= threshold]
+    if len(indices) == 0:
+      return [], best_fit_threshold
+    # Fitting and colour difference
+    new_widths, new_heights, factor_differences = self.checkFittings(indices, max_area, min_area)
+    levels = self.selectLevels(indices, new_widths, new_heights)
+    distances = self.computeDistances(indices, levels, refer_signature)
+    # Keep the fits close to the best one
+    keep = numpy.nonzero(distances < numpy.min(distances) + shuffle_distance)[0]
+    best_fits = []
+    for k in keep:
+      colour = self.colours[indices[k]]
+      new_size = (int(new_widths[k]), int(new_heights[k]))
+      best_fits.append((colour, new_size, float(factor_differences[k]), float(distances[k])))
+    return best_fits, best_fit_threshold
+
+def new(*args, **kwargs):
+  matcher = BatchMatcher(*args, **kwargs)
+  return matcher
@@ -2,56 +2,130 @@
 
 import os
 import sys
+import numpy
 from json import JSONEncoder
 from json import JSONDecoder
 from PIL import Image
 from lib import ImageManager
+from lib import Prefetcher
+from lib import ImageWriter
 
 JSON_encoder = JSONEncoder()
 JSON_decoder = JSONDecoder()
 
-MAX_IMAGES_MEM = 1 # DO NOT SET LOWER THAN 1
 MAX_COLOURS_MEM = 200
 DATA_IMAGE_SIZE = 'ImageSize'
 DATA_COLOURS = 'Colours'
 
 class CollageColour():
+  # Compact record of a resource image: path, sizes, average colour and sectors.
+  # The pixels are decoded once when the features are extracted, then only when rendering
+  __slots__ = ('imgpath', 'name', 'original_width', 'original_height', 'width', 'height', 'sector_size',
+               'average_colour', 'image_hash', 'pyramid', 'tile_signature')
 
-  def __init__(self, base_img, sector_size):
-    self.base_img = base_img
+  def __init__(self, imgpath, original_size, size=None, sector_size=None, name=None):
+    self.imgpath = imgpath
+    if name is None:
+      name = os.path.basename(imgpath)
+    self.name = name # Path from the resources folder, used in schemas
+    self.original_width, self.original_height = original_size
+    if size is None:
+      size = original_size
+    self.width, self.height = size # Size of the image used for the collage
     self.sector_size = sector_size
-    self.images = {}
+    self.average_colour = None
+    self.image_hash = None # Perceptual hash, to find near duplicates
+    self.pyramid = {}
+    self.tile_signature = None # Sectors of the centre square of the image at the collage image size
   
-  def getBaseImage(self):
-    return self.base_img
+  def getFilepath(self):
+    return self.imgpath
   
-  def reload(self):
-    self.images = {}
-    imgpath = self.base_img.getFilepath()
-    self.base_img = ImageManager.newFromPath(imgpath)
+  def getSize(self):
+    return self.width, self.height
   
-  def getResizedImage(self, size, antialias=False, partition=True, memorize=True):
-    width, height = size
-    if size in self.images:
-      img = self.images[width, height]
-      img.setSectorSize(self.sector_size)
-      if partition and not img.isPartitioned():
-        img.partition()
+  def getAverageColour(self):
+    return self.average_colour
+  
+  def getImageHash(self):
+    return self.image_hash
+  
+  def getAverageColourDifference(self, colour):
+    r, g, b = colour
+    img_r, img_g, img_b = self.average_colour
+    return numpy.linalg.norm( [r - img_r, g - img_g, b - img_b] )
+  
+  def getBaseImage(self, content=None):
+    # Image loaded from the file (or its content if already read) at the record size, it is not kept in memory
+    if content is not None:
+      img = ImageManager.newFromContent(content, self.imgpath)
     else:
-      img_raw = self.base_img.getResizedCopy(size, antialias)
-      img = ImageManager.newFromData(img_raw)
-      img.setSectorSize(self.sector_size)
-      if partition:
-        img.partition()
-      if memorize and MAX_IMAGES_MEM > 0:
-        if len(self.images) > MAX_IMAGES_MEM:
-          # delete one element
-          del_key = list(self.images.keys())[0]
-          del self.images[del_key]
-        # Add this image
-        self.images[width, height] = img
+      img = ImageManager.newFromPath(self.imgpath)
+    img.draft((self.width, self.height))
+    if img.size != (self.width, self.height):
+      img.resize(self.width, self.height)
+    img.load()
     return img
   
+  def extractFeatures(self, levels, content=None, tile_size=None):
+    # Average colour, hash, pyramid and square tile sectors with a single load of the pixels
+    img = self.getBaseImage(content)
+    img.setSectorSize(self.sector_size)
+    self.average_colour = tuple(numpy.mean(img.signature(), axis=(0, 1)))
+    self.image_hash = img.differenceHash()
+    self.buildPyramid(levels, img)
+    if tile_size is not None:
+      self.tile_signature = self.buildSignature((tile_size, tile_size), img)
+  
+  def getLevelSize(self, level):
+    # Size of the image resized so that its shorter side is level
+    factor = 1.0 * level / min(self.width, self.height)
+    width = max(int(numpy.ceil(round(self.width * factor, 6))), 1)
+    height = max(int(numpy.ceil(round(self.height * factor, 6))), 1)
+    return width, height
+  
+  def buildPyramid(self, levels, img=None):
+    # Precompute the sectors of the image at the given levels (shorter side lengths)
+    missing = [level for level in levels if level not in self.pyramid]
+    if len(missing) > 0 and img is None:
+      img = self.getBaseImage()
+    for level in missing:
+      self.pyramid[level] = self.buildSignature(self.getLevelSize(level), img)
+  
+  def buildSignature(self, size, img):
+    # Sectors of the loaded image resized to the given size
+    resized = ImageManager.newFromData(img.getResizedCopy(size))
+    resized.setSectorSize(self.sector_size)
+    return resized.signature().astype(numpy.float32)
+  
+  def getSignature(self, size):
+    # Sectors of the pyramid level closest to the given size
+    width, height = size
+    width_lines = numpy.ceil(1.0 * width / self.sector_size)
+    height_lines = numpy.ceil(1.0 * height / self.sector_size)
+    best_signature = None
+    best_distance = None
+    for level in self.pyramid:
+      signature = self.pyramid[level]
+      distance = abs(signature.shape[0] - height_lines) + abs(signature.shape[1] - width_lines)
+      if best_distance is None or distance < best_distance:
+        best_distance = distance
+        best_signature = signature
+    return best_signature
+  
+  def getTileSignature(self, tile_size):
+    # Sectors of the centre square of the image at tile_size: built at load, or sampled from
+    # the closest pyramid level (the file is never decoded again)
+    lines = int(numpy.ceil(1.0 * tile_size / self.sector_size))
+    if self.tile_signature is not None and self.tile_signature.shape[:2] == (lines, lines):
+      return self.tile_signature
+    signature = self.getSignature((tile_size, tile_size))
+    side = min(signature.shape[0], signature.shape[1])
+    top = (signature.shape[0] - side) // 2
+    left = (signature.shape[1] - side) // 2
+    steps = ((numpy.arange(lines) + 0.5) * side / lines).astype(numpy.int64)
+    return signature[top + steps][:, left + steps]
+  
 class CollageImage():
 
   def __init__(self, size):
@@ -59,8 +133,7 @@ class CollageImage():
     self.width = width
     self.height = height
     self.size = size
-    self.img = Image.new("RGBA", self.size, color=(255, 255, 255, 0))
-    self.pixelManager = self.img.load()
+    self.occupied = numpy.zeros((height, (width + 7) // 8), dtype=numpy.uint8) # Pixels covered by an image, a bit each
     self.colours = {}
     self.colours_size = {}
     self.colours_usage = {}
@@ -70,17 +143,46 @@ class CollageImage():
     if x < 0 or x >= self.width or y < 0 or y >= self.height:
       return False
     else:
-      return self.pixelManager[position][3] == 0
+      return not int(self.occupied[y, x >> 3]) & (128 >> (x & 7))
+  
+  def getOccupied(self, position, size):
+    # Covered pixels of the area (clipped to the collage) as a bool array
+    x, y = position
+    width, height = size
+    x1, y1 = min(x + width, self.width), min(y + height, self.height)
+    if x >= x1 or y >= y1:
+      return numpy.zeros((max(y1 - y, 0), max(x1 - x, 0)), dtype=bool)
+    start = x >> 3
+    bits = numpy.unpackbits(self.occupied[y:y1, start:(x1 + 7) >> 3], axis=1)
+    return bits[:, x - 8*start:x1 - 8*start].astype(bool)
+  
+  def setOccupied(self, position, size, value):
+    x, y = position
+    width, height = size
+    x1, y1 = min(x + width, self.width), min(y + height, self.height)
+    if x >= x1 or y >= y1:
+      return
+    start, end = x >> 3, (x1 + 7) >> 3
+    bits = numpy.unpackbits(self.occupied[y:y1, start:end], axis=1)
+    bits[:, x - 8*start:x1 - 8*start] = value
+    self.occupied[y:y1, start:end] = numpy.packbits(bits, axis=1)
+  
+  def blockArea(self, position, size):
+    # Mark an area as used without placing an image on it
+    self.setOccupied(position, size, True)
   
   def addColourAtPosition(self, colour, position, size):
+    # Only the size and the position are recorded, the images are resized when rendering
+    self.markColourAtPosition(colour, position, size)
+  
+  def markColourAtPosition(self, colour, position, size):
     self.colours[position] = colour
     self.colours_size[position] = size
     if colour in self.colours_usage:
       self.colours_usage[colour] += 1
     else:
       self.colours_usage[colour] = 1
-    image = colour.getResizedImage(size, partition=False)
-    self.img.paste(image.getImage(), position)
+    self.setOccupied(position, size, True)
           
   def getColourIndexAtPosition(self, position):
     x, y = position
@@ -100,8 +202,7 @@ class CollageImage():
   
   def removeImageAtPosition(self, position):
     img_size = self.colours_size[position]
-    blank_img = Image.new("RGBA", img_size, color=(255, 255, 255, 0))
-    self.img.paste(blank_img, position)
+    self.setOccupied(position, img_size, False)
     colour = self.colours[position]
     self.colours_usage[colour] -= 1
     del self.colours[position]
@@ -115,33 +216,23 @@ class CollageImage():
     width = 0
     if x < 0 or x >= self.width or y < 0 or y >= self.height:
       return width
-    for i in range(max_width):
-      if not self.isPositionEmpty((x+i, y)):
-        break
-      else:
-        width += 1
-    return width
+    used = numpy.nonzero(self.getOccupied(position, (max_width, 1))[0])[0]
+    if len(used) > 0:
+      return int(used[0])
+    return min(max_width, self.width - x)
   
   def getMaxSpaceBottom(self, position, max_height):
     x, y = position
     height = 0
     if x < 0 or x >= self.width or y < 0 or y >= self.height:
       return height
-    for j in range(max_height):
-      if not self.isPositionEmpty((x, y+j)):
-        break
-      else:
-        height += 1
-    return height
+    used = numpy.nonzero(self.getOccupied(position, (1, max_height))[:, 0])[0]
+    if len(used) > 0:
+      return int(used[0])
+    return min(max_height, self.height - y)
   
   def isSectionFree(self, x, y, width, height):
-    for i in range(width):
-      if self.pixelManager[x+i, y][3] != 0:
-        return False
-    for j in range(height):
-      if self.pixelManager[x, y+j][3] != 0:
-        return False
-    return True
+    return not numpy.any(self.getOccupied((x, y), (width, 1))) and not numpy.any(self.getOccupied((x, y), (1, height)))
   
   def getColourUsage(self, colour):
     if colour in self.colours_usage:
@@ -150,7 +241,26 @@ class CollageImage():
       return 0
   
   def save(self, savepath):
-    self.img.save(savepath)
+    # The empty areas are transparent
+    self.saveResized(savepath)
+  
+  def getPreview(self, max_size=0):
+    # Collage painted with the sectors of the images (no file is decoded), at most max_size wide or high
+    return paintPreview(self.size, self.getPlacements(), max_size)
+  
+  def getPlacements(self):
+    # Snapshot of the placed images, (colour, position, size) for every image
+    return [(self.colours[pos], pos, self.colours_size[pos]) for pos in self.colours]
+  
+  def getOccupiedMask(self, scale=1):
+    # Alpha band of the areas covered by the images at the given scale, None if they cover everything
+    if numpy.all(numpy.unpackbits(self.occupied, axis=1, count=self.width)):
+      return None
+    # The rows of the bits are laid out as in a PIL bilevel image
+    mask = Image.frombytes("1", (self.width, self.height), self.occupied.tobytes()).convert("L")
+    if scale != 1:
+      mask = mask.resize((self.width*scale, self.height*scale), Image.NEAREST)
+    return mask
   
   def debugFillEmptySpace(self, position, colour):
     width, height = self.getMaxSpaceAt(position, self.width, self.height)
@@ -161,42 +271,98 @@ class CollageImage():
     self.debugFillSpace(position, (width, height), colour)
   
   def debugFillSpace(self, position, size, colour):
-    img = Image.new("RGBA", size, color=colour)
-    self.img.paste(img, position)
+    # Transparent colours leave the space empty
+    self.setOccupied(position, size, len(colour) < 4 or colour[3] != 0)
 
-  def saveResized(self, savepath, scale=1):
-    # Create new image with rescaled size
+  def saveResized(self, savepath, scale=1, thumbnail_cache=None, prefetcher=None, writer=None):
+    # Create new image with rescaled size, on RGB: the empty areas come from the positions.
+    # With a writer the encoding is only started, the caller waits for it
     width, height = self.size
     new_width, new_height = width*scale, height*scale
-    img = Image.new("RGBA", (new_width, new_height), color=(255, 255, 255, 0))
+    img = Image.new("RGB", (new_width, new_height), color=(255, 255, 255))
     # Paint new image
-    reloaded_colours = []
-    tot_colours = len(self.colours)
+    self.pasteResized(img, list(self.colours), scale, thumbnail_cache, prefetcher)
+    print("Saving")
+    # save
+    if writer is None:
+      ImageWriter.new().write(img, savepath, self.getOccupiedMask(scale))
+    else:
+      alpha = self.getOccupiedMask(scale) if writer.hasAlpha(savepath) else None
+      writer.start(img, savepath, alpha)
+  
+  def saveRegion(self, savepath, positions, cleared, scale=1, thumbnail_cache=None, prefetcher=None, writer=None):
+    # Update a saved image: clear the (position, size) areas and paint the images at positions
+    img = Image.open(savepath)
+    img.load()
+    width, height = self.size
+    if img.size != (width*scale, height*scale):
+      raise Exception('The saved image has not the size of the collage: ' + savepath)
+    # Images with empty areas keep their alpha band
+    if img.mode == "RGBA":
+      blank_colour = (255, 255, 255, 0)
+    else:
+      img = img.convert("RGB")
+      blank_colour = (255, 255, 255)
+    for position, size in cleared:
+      x, y = position
+      width, height = size
+      blank_img = Image.new(img.mode, (width*scale, height*scale), color=blank_colour)
+      img.paste(blank_img, (x*scale, y*scale))
+    self.pasteResized(img, positions, scale, thumbnail_cache, prefetcher)
+    print("Saving")
+    if writer is None:
+      writer = ImageWriter.new()
+    writer.write(img, savepath)
+  
+  def pasteResized(self, img, positions, scale=1, thumbnail_cache=None, prefetcher=None):
+    # Paint the original images at positions on img, scaled
+    # NOTE: the originals are opened apart, the colours may be shared with other collages
+    originals = {}
+    keep_originals = len(positions) <= MAX_COLOURS_MEM
+    # Positions where a file is read (the first use of an image if it is kept), read ahead by the prefetcher
+    reads = []
+    read_colours = set()
+    for pos in positions:
+      colour = self.colours[pos]
+      if not colour in read_colours:
+        reads.append(pos)
+        if keep_originals or thumbnail_cache is not None:
+          read_colours.add(colour)
+    files = Prefetcher.iterFiles([self.colours[pos].getFilepath() for pos in reads], prefetcher)
+    reads = set(reads)
+    tot_colours = len(positions)
     actual_pos = 0
-    for pos in self.colours:
+    for pos in positions:
       # Show progression
       perc = round(100.0 * actual_pos / tot_colours)
       sys.stdout.write('\r Progression: ' + str(perc) + ' %   ')
       sys.stdout.flush()
       actual_pos += 1
+      content = None
+      if pos in reads:
+        _, content = next(files)
       # Resize and paste the image
       x, y = pos
       new_x, new_y = x*scale, y*scale
       width, height = self.colours_size[x,y]
       new_width, new_height = width*scale, height*scale
       colour = self.colours[x,y]
-      if not colour in reloaded_colours:
-        colour.reload()
-        reloaded_colours.append(colour)
-      image = colour.getResizedImage((new_width, new_height), antialias=True, partition=False, memorize=False)
-      img.paste(image.getImage(), (new_x, new_y))
-      if len(self.colours) > MAX_COLOURS_MEM :
-        colour.reload() # Free the memory of the base image (otherwise I use too much RAM)
+      if thumbnail_cache is not None:
+        # Decode and resize only the thumbnails not rendered before
+        image = thumbnail_cache.getResized(colour.getFilepath(), (new_width, new_height), content)
+        img.paste(image, (new_x, new_y))
+        continue
+      if not colour in originals:
+        if content is not None:
+          originals[colour] = ImageManager.newFromContent(content, colour.getFilepath())
+        else:
+          originals[colour] = ImageManager.newFromPath(colour.getFilepath())
+      image = originals[colour].getResizedCopy((new_width, new_height), antialias=True)
+      img.paste(image, (new_x, new_y))
+      if not keep_originals:
+        del originals[colour] # Free the memory of the base image (otherwise I use too much RAM)
     sys.stdout.write('\r Progression: 100 %   \n')
     sys.stdout.flush()
-    print("Saving")
-    # save
-    img.save(savepath)
 
   def saveSchema(self, savepath):
     data = {}
@@ -204,7 +370,7 @@ class CollageImage():
     colours = []
     for pos in self.colours:
       colour = self.colours[pos]
-      imgname = os.path.basename(colour.getBaseImage().getFilepath())
+      imgname = getColourName(colour)
       size = self.colours_size[pos]
       colour_data = (imgname, pos, size)
       colours.append(colour_data)
@@ -219,9 +385,36 @@ class CollageImage():
       hand.write(colour_string + '\n')
     hand.close()
   
+  def getPositionsInBox(self, box):
+    # Positions of the images intersecting the box (x0, y0, x1, y1)
+    x0, y0, x1, y1 = box
+    positions = []
+    for pos in self.colours:
+      x, y = pos
+      width, height = self.colours_size[pos]
+      if x < x1 and x + width > x0 and y < y1 and y + height > y0:
+        positions.append(pos)
+    return positions
+  
+  def getPositionsInMask(self, maskpath):
+    # Positions of the images intersecting the non transparent pixels of the mask
+    mask = Image.open(maskpath).convert('RGBA')
+    mask = mask.resize((self.size), Image.ANTIALIAS)
+    return self.getPositionsInArea(numpy.asarray(mask)[:, :, 3] != 0)
+  
+  def getPositionsInArea(self, masked):
+    # Positions of the images intersecting the true pixels of a (height, width) array
+    positions = []
+    for pos in self.colours:
+      x, y = pos
+      width, height = self.colours_size[pos]
+      if numpy.any(masked[y:y+height, x:x+width]):
+        positions.append(pos)
+    return positions
+  
   def applyMask(self, maskpath):
     mask = Image.open(maskpath).convert('RGBA')
-    mask = mask.resize((self.img.size), Image.ANTIALIAS)
+    mask = mask.resize((self.size), Image.ANTIALIAS)
     mask_width, mask_height = mask.size
     maskPixelManager = mask.load()
     delete_list = []
@@ -255,12 +448,35 @@ def newColour(*args, **kwargs):
   colour = CollageColour(*args, **kwargs)
   return colour
 
-def newColourFromPath(imgpath, sector_size=None):
+def newColourFromPath(imgpath, sector_size=None, name=None):
   img = ImageManager.newFromPath(imgpath)
-  colour = CollageColour(img, sector_size)
+  colour = CollageColour(imgpath, img.size, sector_size=sector_size, name=name)
   return colour
 
-def newFromSchema(filepath, images_folder): 
+def getColourName(colour):
+  # Name of the colour image in schemas
+  return colour.name
+
+def paintPreview(size, placements, max_size=0):
+  # Preview of a collage of size from a snapshot of CollageImage.getPlacements, the colours are only read
+  width, height = size
+  factor = 1.0
+  if max_size > 0 and max(width, height) > max_size:
+    factor = 1.0 * max_size / max(width, height)
+  preview = Image.new("RGB", (max(int(width * factor), 1), max(int(height * factor), 1)), color=(255, 255, 255))
+  for colour, pos, img_size in placements:
+    x, y = pos
+    signature = colour.getSignature(img_size)
+    if signature is None:
+      continue
+    sectors = Image.fromarray(numpy.clip(signature, 0, 255).astype(numpy.uint8))
+    new_size = (max(int(round(img_size[0] * factor)), 1), max(int(round(img_size[1] * factor)), 1))
+    sectors = sectors.resize(new_size, Image.NEAREST, box=ImageManager.getCropBox(sectors.size, new_size))
+    preview.paste(sectors, (int(x * factor), int(y * factor)))
+  return preview
+
+def newFromSchema(filepath, images_folder, colours=None):
+  # With colours the images are taken from them (by name) instead of the images folder
   with open(filepath, 'r') as hand:
     # Read size
     line = hand.readline()
@@ -272,23 +488,37 @@ def newFromSchema(filepath, images_folder):
       image_data = JSON_decoder.decode(line)
       images.append(image_data)
   # Create collage
-  collage = CollageImage(size)
+  collage = CollageImage(tuple(size))
   colours_dict = {}
+  basenames_dict = {}
+  if colours is not None:
+    for colour in colours:
+      colours_dict[getColourName(colour)] = colour
+      # Older schemas have only the file names
+      basenames_dict.setdefault(os.path.basename(colour.getFilepath()), colour)
   # Add colours
   for img_data in images:
     imgname, position, size = img_data
-    imgpath = os.path.join(images_folder, imgname)
-    if not os.path.exists(imgpath):
-      print("Image: " + imgpath + ' not found!')
-      print("Please select the correct images folder")
-      return None, None
-    if imgpath in colours_dict:
-      colour = colours_dict[imgpath]
+    if colours is not None:
+      if imgname in colours_dict:
+        colour = colours_dict[imgname]
+      elif imgname in basenames_dict:
+        colour = basenames_dict[imgname]
+      else:
+        print("Image: " + imgname + ' not found in the resources!')
+        return None
     else:
-      colour = newColourFromPath(imgpath)
-      colours_dict[imgpath] = colour
+      imgpath = os.path.join(images_folder, imgname)
+      if not os.path.exists(imgpath):
+        print("Image: " + imgpath + ' not found!')
+        print("Please select the correct images folder")
+        return None
+      if imgpath in colours_dict:
+        colour = colours_dict[imgpath]
+      else:
+        colour = newColourFromPath(imgpath, name=imgname)
+        colours_dict[imgpath] = colour
     i, j = position
-    collage.colours[i, j] = colour
-    collage.colours_size[i, j] = size
+    collage.markColourAtPosition(colour, (i, j), tuple(size))
   
   return collage
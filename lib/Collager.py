@@ -5,12 +5,24 @@ import sys
 import numpy
 import random
 import time
+import shutil
+import multiprocessing
+from json import JSONEncoder
+from json import JSONDecoder
 from lib import ImageManager
 from lib import CollageImage
+from lib import GridLayout
+from lib import AdaptiveLayout
+from lib import ResourceLibrary
+from lib import PreviewWriter
+from lib import ImageWriter
+from lib import FittingCache
+from lib import AnnIndex
 
 random.seed(time.time())
 
-VALID_FILETYPES = ['.png', '.jpg', '.jpeg']
+JSON_encoder = JSONEncoder()
+JSON_decoder = JSONDecoder()
 
 MAX_DIFF_CLASSES = 10
 RESIZE_DIFFERENCE_BOUND = 0.01
@@ -18,13 +30,32 @@ LOWER_ADAPT_HEIGHT_BOUND = 0.2
 
 PREVIEWS_NUMBER = 10
 
+CHECKPOINT_EXTENSION = '.checkpoint'
+DATA_POSITION = 'Position'
+DATA_RANDOM_STATE = 'RandomState'
+DATA_NUMPY_RANDOM_STATE = 'NumpyRandomState'
+DATA_COLOURS = 'Colours'
+DATA_COLOURS_USAGE = 'ColoursUsage'
+DATA_NEAR_SIZE = 'NearSize'
+DATA_SAME_HEIGHT_STREAK = 'SameHeightStreak'
+
 DEFAULT_PRECISION = 4
 DEFAULT_THRESHOLD = 100
+DEFAULT_SEQUENCE_THRESHOLD = 20 # Sector colour change that makes a frame replace the images over it
 DEFAULT_NEAR_SIZE = 3
 DEFAULT_SHUFFLE_COLOURS_DISTANCE = 10
 DEFAULT_SHUFFLE_GEOMETRY = 0
 
-DEFAULT_COLLAGE_IMAGE_SIZE_PRECISION = 0.8
+LAYOUT_SCAN = 'scan'
+LAYOUT_GRID = 'grid'
+LAYOUT_BANDS = 'bands'
+LAYOUT_ADAPTIVE = 'adaptive'
+LAYOUTS = [LAYOUT_SCAN, LAYOUT_GRID, LAYOUT_BANDS, LAYOUT_ADAPTIVE]
+
+ASSIGNMENT_GREEDY = 'greedy'
+ASSIGNMENT_GLOBAL = 'global'
+ASSIGNMENTS = [ASSIGNMENT_GREEDY, ASSIGNMENT_GLOBAL]
+
 DEFAULT_COLLAGE_SAME_HEIGHT_STREAK = 4
 
 class Collager():
@@ -34,6 +65,7 @@ class Collager():
     self.base_image = ImageManager.newFromPath(imagepath)
     self.base_image.load()
     self.colours = None
+    self.library = None
     self.collage_image = CollageImage.new(self.base_image.size)
     self.output_image_savepath = None
     self.images_folder = None
@@ -47,16 +79,40 @@ class Collager():
     self.shuffle_colours = False
     self.shuffle_colours_distance = DEFAULT_SHUFFLE_COLOURS_DISTANCE
     self.shuffle_geometry = DEFAULT_SHUFFLE_GEOMETRY
+    self.size_ladder_step = 0
+    self.size_ladder = None
+    self.batch_matching = False
+    self.matcher = None
+    self.fitting = None
+    self.ann_candidates = 0
+    self.ann_probes = AnnIndex.DEFAULT_PROBES
+    self.ann_index = None
+    self.layout = LAYOUT_SCAN
+    self.adaptive_levels = AdaptiveLayout.DEFAULT_LEVELS
+    self.adaptive_threshold = AdaptiveLayout.DEFAULT_THRESHOLD
+    self.assignment = ASSIGNMENT_GREEDY
+    self.max_usage = 0
+    self.workers = multiprocessing.cpu_count()
     # Workflow options
     self.show_partials = False
+    self.keep_output = False # The output is updated in place (recollage): no previews
+    self.preview_size = PreviewWriter.DEFAULT_MAX_SIZE
+    self.preview_writer = None
+    self.checkpoint_interval = 0
+    self.resume = False
+    self.thumbnail_cache = None
+    self.prefetcher = None
+    self.image_writer = ImageWriter.new()
     # Class variables
     self.sector_size = None
     self.collage_image_size = None
-    self.collage_image_size_precision = DEFAULT_COLLAGE_IMAGE_SIZE_PRECISION
+    self.collage_image_size_precision = ResourceLibrary.DEFAULT_COLLAGE_IMAGE_SIZE_PRECISION
     self.collage_image_size_min = None # Enforced limit
     self.collage_image_size_max_width = None # Non-enforced limit
     self.collage_image_size_max_height = None # Non-enforced limit
     # Collage variables
+    self.collage_position = 0
+    self.collage_placements = 0
     self.collage_same_height_streak = DEFAULT_COLLAGE_SAME_HEIGHT_STREAK
     self.collage_same_height_streak_max = DEFAULT_COLLAGE_SAME_HEIGHT_STREAK
   
@@ -81,9 +137,60 @@ class Collager():
   def setShuffleGeometry(self, percent):
     self.shuffle_geometry = percent
   
+  def setSizeLadder(self, step):
+    # Snap the images sizes to multiples of step sectors (0 to disable)
+    self.size_ladder_step = step
+  
+  def setBatchMatching(self, value=True):
+    self.batch_matching = value
+  
+  def setAnnSearch(self, candidates, probes=AnnIndex.DEFAULT_PROBES):
+    # Evaluate only the candidates images with the closest sectors (0 to evaluate all the images),
+    # probes sets the recall of the search
+    self.ann_candidates = candidates
+    self.ann_probes = probes
+  
+  def setLayout(self, layout):
+    self.layout = layout
+  
+  def setAdaptiveLayout(self, levels, threshold):
+    # Adaptive layout tiles up to 2**levels times the images size, split above the threshold colour deviation
+    self.adaptive_levels = levels
+    self.adaptive_threshold = threshold
+  
+  def setAssignment(self, assignment):
+    self.assignment = assignment
+  
+  def setMaxUsage(self, value):
+    # Max number of times an image can be used (0 for automatic)
+    self.max_usage = value
+  
+  def setWorkers(self, workers):
+    self.workers = max(workers, 1)
+  
   def setShowPartials(self, value):
     self.show_partials = value
   
+  def setPreviewSize(self, size):
+    # Max width or height of the previews (0 for full size)
+    self.preview_size = size
+  
+  def setCheckpointInterval(self, placements):
+    # Save a checkpoint every given number of placements (0 to disable)
+    self.checkpoint_interval = placements
+  
+  def setResume(self, value=True):
+    self.resume = value
+  
+  def setThumbnailCache(self, cache):
+    self.thumbnail_cache = cache
+  
+  def setPrefetcher(self, prefetcher):
+    self.prefetcher = prefetcher
+  
+  def setImageWriter(self, writer):
+    self.image_writer = writer
+  
   def setImagesNumberOnWidth(self, n):
     self.collage_image_size = int(numpy.ceil(1.0 * self.base_image.width / n))
   
@@ -102,65 +209,135 @@ class Collager():
     else:
       self.log = logger.createInfoLogger('main.txt', self)
   
-  def loadColours(self, folder):
-    self.images_folder = folder
-    self.colours = []
-    self.sector_size = max(int(1.0 * self.collage_image_size / self.precision), 1)
-    self.collage_image_size = self.sector_size * self.precision
-    self.loadColoursComplete()
-    
-  def loadColoursComplete(self):
-    self.log.info('loadColoursComplete == Loading colours')
-    self.log.debug('loadColoursComplete == Collage image size: ' + str(self.collage_image_size))
-    self.log.debug('loadColoursComplete == Collage image size precision: ' + str(self.collage_image_size_precision))
-    self.log.debug('loadColoursComplete == Sector size: ' + str(self.sector_size))
-    # Set min size
-    self.collage_image_size_min = int(numpy.ceil(self.collage_image_size * self.collage_image_size_precision))
-    self.log.info('loadColoursComplete == Min size: ' + str(self.collage_image_size_min))
-    # Save width and height
-    images_width = []
-    images_height = []
-    print('Loading resources')
-    self.log.info('loadColoursComplete == Loading from images')
-    loading_folder = self.images_folder
-    for name in os.listdir(loading_folder):
-      path = os.path.join(loading_folder, name)
-      if not os.path.isdir(path) and self.hasValidExtension(path): # Ignore folders and invalid files
-        try:
-          img = ImageManager.new(path)
-          img.setSectorSize(self.sector_size)
-          # resize
-          img.resizeMaximal(self.collage_image_size)
-          # partition
-          img.partition()
-          # load colour
-          colour = CollageImage.newColour(img, self.sector_size)
-          # add to self.colours
-          self.colours.append(colour)
-          # add sizes
-          images_width.append(img.width)
-          images_height.append(img.height)
-          # Show progress
-          sys.stdout.write('.')
-          sys.stdout.flush()
-        except Exception as error:
-          self.log.info('loadColoursComplete == Error loading: ' + path)
-          print('\n*Error loading ' + path)
-          continue
-    self.collage_image_size_avg_width = int(numpy.ceil(numpy.mean(images_width)))
-    self.collage_image_size_avg_height = int(numpy.ceil(numpy.mean(images_height)))
-    self.collage_image_size_max_width = int(numpy.max(images_width))
-    self.collage_image_size_max_height = int(numpy.max(images_height))
-    self.log.info('loadColoursComplete == Collage image size avg width: ' + str(self.collage_image_size_avg_width))
-    self.log.info('loadColoursComplete == Collage image size avg height: ' + str(self.collage_image_size_avg_height))
-    self.log.info('loadColoursComplete == Collage image size max width: ' + str(self.collage_image_size_max_width))
-    self.log.info('loadColoursComplete == Collage image size max height: ' + str(self.collage_image_size_max_height))
-    print('\nLoaded ' + str(len(self.colours)) + ' resources')
+  def setLog(self, log):
+    # Use an existing logger
+    self.log = log
+  
+  def loadColours(self, folder, duplicates_distance=None, manifest=None):
+    library = ResourceLibrary.new(folder, self.collage_image_size, self.precision, duplicates_distance, manifest)
+    library.setLogger(self.log)
+    library.setPrefetcher(self.prefetcher)
+    library.load()
+    self.setLibrary(library)
+  
+  def setLibrary(self, library):
+    self.library = library
+    self.images_folder = library.images_folder
+    self.colours = library.colours
+    self.precision = library.precision
+    self.sector_size = library.sector_size
+    self.collage_image_size = library.collage_image_size
+    self.collage_image_size_precision = library.collage_image_size_precision
+    self.collage_image_size_min = library.collage_image_size_min
+    self.collage_image_size_avg_width = library.collage_image_size_avg_width
+    self.collage_image_size_avg_height = library.collage_image_size_avg_height
+    self.collage_image_size_max_width = library.collage_image_size_max_width
+    self.collage_image_size_max_height = library.collage_image_size_max_height
+  
+  def fitToLibrary(self, library, images_width=None, images_height=None):
+    # Scale the base image so that the library images size gives the number of images requested
+    if images_height is not None:
+      factor = 1.0 * images_height * library.collage_image_size / self.base_image.height
+    else:
+      factor = 1.0 * images_width * library.collage_image_size / self.base_image.width
+    width = max(int(round(self.base_image.width * factor)), 1)
+    height = max(int(round(self.base_image.height * factor)), 1)
+    self.base_image.resize(width, height)
+    self.base_image.load()
+    self.collage_image = CollageImage.new(self.base_image.size)
+    self.setLibrary(library)
   
   def collage(self):
     self.fixParameters()
     self.setupBaseImage()
-    self.collageStart()
+    if self.layout == LAYOUT_GRID or self.layout == LAYOUT_ADAPTIVE:
+      self.collageGrid()
+    elif self.layout == LAYOUT_BANDS:
+      self.setupColours()
+      self.collageBands()
+    else:
+      self.setupColours()
+      start = 0
+      if self.resume:
+        start = self.loadCheckpoint()
+      self.collageStart(start)
+      self.removeCheckpoint()
+  
+  def recollageRegion(self, schema_filepath, box=None, maskpath=None, masked=None):
+    # Replace the images of a saved collage intersecting the box (x0, y0, x1, y1), the mask
+    # or the true pixels of masked, returns the removed (position, size) and the new positions
+    self.fixParameters()
+    collage_image = CollageImage.newFromSchema(schema_filepath, self.images_folder, self.colours)
+    if collage_image is None:
+      raise Exception('Schema images not found in resources: ' + schema_filepath)
+    if tuple(collage_image.size) != tuple(self.base_image.size):
+      # The base image must cover the collage
+      width, height = collage_image.size
+      self.base_image.resize(width, height)
+      self.base_image.load()
+    self.collage_image = collage_image
+    self.setupBaseImage()
+    if masked is not None:
+      positions = self.collage_image.getPositionsInArea(masked)
+    elif maskpath is not None:
+      positions = self.collage_image.getPositionsInMask(maskpath)
+    else:
+      positions = self.collage_image.getPositionsInBox(box)
+    self.log.info('recollageRegion == Images to replace: ' + str(len(positions)))
+    if len(positions) == 0:
+      return [], []
+    cleared = []
+    for position in positions:
+      cleared.append((position, self.collage_image.getImageSizeAt(position)))
+      self.collage_image.removeImageAtPosition(position)
+    kept = set(self.collage_image.colours)
+    # The output is updated in place by saveRegion, no preview is written over it
+    self.keep_output = True
+    if self.layout == LAYOUT_GRID or self.layout == LAYOUT_ADAPTIVE:
+      self.collageCells(cleared)
+    else:
+      # Only the areas of the removed images are filled, the surrounding images are near images as usual
+      region = numpy.zeros((self.collage_image.height, self.collage_image.width), dtype=bool)
+      for position, size in cleared:
+        x, y = position
+        region[y:y+size[1], x:x+size[0]] = True
+      start = min([position[1] for position, size in cleared])
+      end = max([position[1] + size[1] for position, size in cleared])
+      self.setupColours()
+      self.collageStart(start, end, region)
+    placed = [position for position in self.collage_image.colours if not position in kept]
+    return cleared, placed
+  
+  def getSectorColours(self):
+    # Mean colour of the sectors of the base image, compared between the frames of a sequence
+    return ImageManager.computeSectorGrid(self.base_image.getArray(), self.sector_size)
+  
+  def collageFrame(self, previous_output, reference, threshold=DEFAULT_SEQUENCE_THRESHOLD):
+    # Next frame of a sequence: start from the collage and the render of the previous frame and
+    # replace only the images over the sectors that changed more than threshold since they were matched.
+    # reference holds the sector colours of the last match, returns it updated
+    colours = self.getSectorColours()
+    if colours.shape != reference.shape:
+      raise Exception('The frame has not the size of the previous one: ' + self.base_image.getFilepath())
+    changed = numpy.linalg.norm(colours - reference, axis=2) > threshold
+    reference = numpy.where(changed[:, :, None], colours, reference)
+    height, width = self.base_image.height, self.base_image.width
+    masked = numpy.repeat(numpy.repeat(changed, self.sector_size, axis=0), self.sector_size, axis=1)[:height, :width]
+    self.log.info('collageFrame == Changed sectors: ' + str(int(numpy.sum(changed))) + '/' + str(changed.size))
+    shutil.copyfile(previous_output, self.output_image_savepath)
+    cleared, placed = self.recollageRegion(previous_output + '.schema.cls', masked=masked)
+    if len(cleared) > 0:
+      self.saveRegion(cleared, placed)
+    else:
+      self.saveSchema()
+    return reference
+  
+  def saveRegion(self, cleared, placed):
+    # Update the saved output with the images placed by recollageRegion
+    self.closePreviews()
+    self.log.info('saveRegion == Saving ' + str(len(placed)) + ' images')
+    self.collage_image.saveRegion(self.output_image_savepath, placed, cleared, self.scale_factor, self.thumbnail_cache, self.prefetcher, self.image_writer)
+    self.saveSchema()
   
   def fixParameters(self):
     if self.near_size > 0 and len(self.colours) < 4*self.near_size**2:
@@ -173,8 +350,39 @@ class Collager():
   def setupBaseImage(self):
     self.base_image.setSectorSize(self.sector_size)
   
-  def collageStart(self):
-    self.log.info('collageStart == Starting')
+  def setupColours(self):
+    # Precompute the sectors of every resource so that matching never resizes images
+    levels = self.getPyramidLevels()
+    self.log.info('setupColours == Pyramid levels: ' + str(levels))
+    ladder = self.getSizeLadder()
+    self.size_ladder = ladder
+    if ladder is not None:
+      self.log.info('setupColours == Size ladder: ' + str(ladder))
+    for colour in self.colours:
+      colour.buildPyramid(levels)
+    self.fitting = None
+    if self.batch_matching or self.ann_candidates > 0:
+      self.matcher = self.library.getMatcher(levels, ladder)
+    elif self.layout == LAYOUT_BANDS and self.workers > 1:
+      # The band workers read the pyramids from shared memory instead of copying them
+      self.library.getStore(levels)
+    if self.ann_candidates > 0:
+      self.ann_index = self.library.getAnnIndex()
+  
+  def getPyramidLevels(self):
+    return ResourceLibrary.getPyramidLevels(self.sector_size, self.collage_image_size_min, self.collage_image_size_max_width, self.collage_image_size_max_height)
+  
+  def getSizeLadder(self):
+    # Pyramid levels taken every size_ladder_step sectors
+    if self.size_ladder_step <= 0:
+      return None
+    return self.getPyramidLevels()[::self.size_ladder_step]
+  
+  def collageStart(self, start=0, end=None, region=None):
+    # With region (bool array of the collage size) only the empty positions inside it are filled
+    if end is None:
+      end = self.collage_image.height
+    self.log.info('collageStart == Starting from line ' + str(start))
     # Setup partials
     tot_pixels = self.collage_image.width * self.collage_image.height
     partials = []
@@ -184,7 +392,8 @@ class Collager():
         partials.append(skip*i)
     # Start collage
     print('Collage!') 
-    for y in range(self.collage_image.height):
+    for y in range(start, end):
+      self.collage_position = y
       index = y * self.collage_image.width
       perc = round(100.0 * index / tot_pixels)
       sys.stdout.write('\r Progression: ' + str(perc) + ' %   ')
@@ -193,7 +402,7 @@ class Collager():
         self.log.info('collageStart == Save preview')
         self.savePreview()
       for x in range(self.collage_image.width):
-        if self.collage_image.isPositionEmpty((x, y)):
+        if self.collage_image.isPositionEmpty((x, y)) and (region is None or region[y, x]):
           self.log.info('collageStart == Filling point ' + str(x) + ', ' + str(y))
           max_area, min_area = self.findAvailableArea((x,y))
           self.log.info('collageStart == Max area ' + str(max_area[0]) + ', ' + str(max_area[1]))
@@ -214,17 +423,175 @@ class Collager():
             if p < self.shuffle_geometry:
               self.log.info('collageStart == Start new streak')
               self.collage_same_height_streak = 0
+          if region is not None:
+            # Inside a region there can be images below the area
+            max_area, min_area = self.fitFreeArea((x,y), max_area, min_area)
           # Fill Area
           self.log.info('collageStart == Prepare to fill area')
           self.log.info('collageStart == Max area ' + str(max_area[0]) + ', ' + str(max_area[1]))
           self.log.info('collageStart == Min area ' + str(min_area[0]) + ', ' + str(min_area[1]))
-          self.fillArea((x,y), max_area, min_area)
+          # Inside a region a larger image would cover the images around the area
+          self.fillArea((x,y), max_area, min_area, region is not None)
+          self.collage_placements += 1
+          if self.checkpoint_interval > 0 and self.collage_placements % self.checkpoint_interval == 0:
+            self.saveCheckpoint()
           if self.debug:
             self.savePreview()
             input('Press any key to continue...')
     sys.stdout.write('\r Progression: 100 %   \n')
     sys.stdout.flush()
   
+  def collageGrid(self):
+    # Square tiles of the collage image size on a fixed grid, or of different sizes with the adaptive layout
+    self.log.info('collageGrid == Starting')
+    if self.layout == LAYOUT_ADAPTIVE:
+      grid = AdaptiveLayout.new(self, self.adaptive_levels, self.adaptive_threshold)
+    else:
+      grid = GridLayout.new(self)
+    grid.setup()
+    self.collageTiles(grid)
+  
+  def collageCells(self, cleared):
+    # Grid layouts: match again the cells of the removed images, same positions and sizes
+    cells = []
+    for position, size in cleared:
+      width, height = size
+      if width != height or width % self.collage_image_size != 0:
+        raise Exception('Image not on a cell of the ' + self.layout + ' layout: ' + str(position) + ', ' + str(size))
+      cells.append((position[0], position[1], width))
+    grid = AdaptiveLayout.new(self, self.adaptive_levels, self.adaptive_threshold)
+    grid.setupCells(cells)
+    self.collageTiles(grid)
+  
+  def collageTiles(self, grid):
+    # Assign the colours to the tiles of a layout and place them
+    self.log.info('collageGrid == Tiles: ' + str(grid.tiles_number))
+    print('Collage!')
+    if self.assignment == ASSIGNMENT_GLOBAL:
+      max_usage = self.max_usage
+      if max_usage <= 0:
+        max_usage = 2 * int(numpy.ceil(1.0 * grid.tiles_number / len(self.colours)))
+      self.log.info('collageGrid == Global assignment, max usage: ' + str(max_usage))
+      assignment = grid.assignGlobal(max_usage)
+    else:
+      assignment = grid.assign()
+    grid.place(assignment)
+  
+  def collageBands(self):
+    # Fill horizontal bands in parallel, then fix the seams between them
+    self.log.info('collageBands == Starting')
+    if multiprocessing.current_process().daemon:
+      # Already in a worker process, which cannot start other processes
+      self.log.info('collageBands == Running in a worker, fill the whole canvas')
+      self.collageStart()
+      return
+    bands = self.getBands()
+    self.log.info('collageBands == Bands: ' + str(bands))
+    print('Collage! (' + str(len(bands)) + ' bands)')
+    global _band_collager
+    _band_collager = self
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(self.workers, len(bands))) as pool:
+      results = pool.map(collageBandWorker, bands)
+    _band_collager = None
+    # Merge
+    bands_colours = {}
+    for band, placements in zip(bands, results):
+      for index, position, size in placements:
+        self.addSectionToImage(self.colours[index], position, size)
+        bands_colours[position] = band
+    self.log.info('collageBands == Merged ' + str(len(bands_colours)) + ' images')
+    self.reconcileBands(bands, bands_colours)
+  
+  def getBands(self):
+    # Bands of whole images lines, at most one per worker
+    height = self.collage_image.height
+    lines = int(numpy.ceil(1.0 * height / self.collage_image_size))
+    bands_number = max(min(self.workers, lines // 2), 1)
+    bands = []
+    for i in range(bands_number):
+      start = (lines * i // bands_number) * self.collage_image_size
+      end = min((lines * (i+1) // bands_number) * self.collage_image_size, height)
+      bands.append((start, end))
+    return bands
+  
+  def collageBand(self, band):
+    # Fill a band only, the rest of the canvas is marked as used
+    start, end = band
+    width, height = self.collage_image.size
+    if start > 0:
+      self.collage_image.blockArea((0, 0), (width, start))
+    if end < height:
+      self.collage_image.blockArea((0, end), (width, height - end))
+    self.collageStart(start, end)
+    colours_index = {}
+    for i, colour in enumerate(self.colours):
+      colours_index[colour] = i
+    placements = []
+    for position in self.collage_image.colours:
+      colour = self.collage_image.colours[position]
+      placements.append((colours_index[colour], position, self.collage_image.colours_size[position]))
+    return placements
+  
+  def reconcileBands(self, bands, bands_colours):
+    # Place again the images squeezed on a seam, with the images of the other band touching them
+    # across the seam, and the images near the same image across a seam
+    seams = set(band_end for band_start, band_end in bands[:-1])
+    groups = []
+    for position in sorted(bands_colours, key=lambda position: (position[1], position[0])):
+      x, y = position
+      width, height = self.collage_image.getImageSizeAt(position)
+      if height < self.collage_image_size_min and (y in seams or y + height in seams):
+        groups.append([position] + self.getImagesAcrossSeam(position, bands_colours))
+      elif self.hasNearImageInOtherBand(position, bands_colours):
+        groups.append([position])
+    self.log.info('reconcileBands == Groups of images to place again: ' + str(len(groups)))
+    if len(groups) == 0:
+      return
+    print('Fixing seams')
+    for group in groups:
+      # Every group is filled on its own, the region stays closed by the images around it
+      cleared = []
+      for position in group:
+        if position in bands_colours:
+          cleared.append((position, self.collage_image.getImageSizeAt(position)))
+          del bands_colours[position]
+          self.collage_image.removeImageAtPosition(position)
+      if len(cleared) == 0:
+        continue
+      region = numpy.zeros((self.collage_image.height, self.collage_image.width), dtype=bool)
+      for position, size in cleared:
+        x, y = position
+        region[y:y+size[1], x:x+size[0]] = True
+      start = min(position[1] for position, size in cleared)
+      end = max(position[1] + size[1] for position, size in cleared)
+      self.collageStart(start, end, region)
+  
+  def getImagesAcrossSeam(self, position, bands_colours):
+    # Images of the other band sharing the top or the bottom side of the image at position
+    x, y = position
+    width, height = self.collage_image.getImageSizeAt(position)
+    band = bands_colours[position]
+    images = []
+    for other in bands_colours:
+      if bands_colours[other] == band:
+        continue
+      other_x, other_y = other
+      other_width, other_height = self.collage_image.getImageSizeAt(other)
+      if (other_y + other_height == y or other_y == y + height) and other_x < x + width and x < other_x + other_width:
+        images.append(other)
+    return images
+  
+  def hasNearImageInOtherBand(self, position, bands_colours):
+    # Only the image in the lower band is placed again
+    band = bands_colours[position]
+    colour = self.collage_image.colours[position]
+    for near_position in self.getNearPositions(position):
+      if near_position in bands_colours and bands_colours[near_position] < band and \
+         self.collage_image.colours[near_position] is colour:
+        return True
+    return False
+  
   def findAvailableArea(self, position):
     x, y = position
     base_width, base_height = self.collage_image.getMaxSpaceAt(position, self.collage_image_size_max_width, self.collage_image_size_max_height)
@@ -242,7 +609,7 @@ class Collager():
     elif right_space < self.collage_image_size_min:
       # missing space right
       if base_width + right_space >= 2 * self.collage_image_size_min:
-        base_width = base_width - self.collage_image_size_min
+        base_width = base_width + right_space - self.collage_image_size_min
         # Now I have the min space on the right
       else:
         # include right area (and I must fill all the width)
@@ -257,7 +624,7 @@ class Collager():
     elif bottom_space < self.collage_image_size_min:
       # missing space bottom
       if base_height + bottom_space >= 2 * self.collage_image_size_min:
-        base_height = base_height - self.collage_image_size_min
+        base_height = base_height + bottom_space - self.collage_image_size_min
         # Now I have the min space on the bottom
       else:
         # include right area (and I must fill all the width)
@@ -266,6 +633,24 @@ class Collager():
     
     return (base_width, base_height) , (min_width, min_height)
     
+  def fitFreeArea(self, position, max_area, min_area):
+    # findAvailableArea only looks at the line and the column of the position, the canvas below is
+    # empty only in the scan order: inside a region the height stops before the first image below,
+    # leaving at least the minimum size to the next image
+    max_width, max_height = max_area
+    min_width, min_height = min_area
+    used = numpy.nonzero(numpy.any(self.collage_image.getOccupied(position, (max_width, max_height + self.collage_image_size_min)), axis=1))[0]
+    if len(used) == 0:
+      return max_area, min_area
+    free_height = int(used[0])
+    if free_height < 2 * self.collage_image_size_min:
+      # Fill all the height
+      max_height = min_height = free_height
+    else:
+      max_height = min(max_height, free_height - self.collage_image_size_min)
+      min_height = min(min_height, max_height)
+    return (max_width, max_height), (min_width, min_height)
+  
   def tryAdaptHeight(self, position, max_area, min_area):
     # Analyze area
     x, y = position
@@ -298,18 +683,37 @@ class Collager():
             adapted = True
     return max_area, min_area, adapted
   
-  def fillArea(self, position, max_area, min_area):
-    # Get the base partition
-    base_partition = self.base_image.createShiftedPartition(position, max_area)
+  def fillArea(self, position, max_area, min_area, crop=False):
+    # With crop the images never go out of max_area (cropped when forced to a larger size)
+    # Get the base sectors
+    base_signature = self.base_image.createShiftedSignature(position, max_area)
     # Refer average colour
-    base_colour = base_partition.getAverageColour()
+    base_colour = tuple(numpy.mean(base_signature, axis=(0, 1)))
     # Get near images
     near_images = self.getNearImages(position)
-    if len(near_images) >= len(self.colours):
+    while len(near_images) >= len(self.colours):
       # Warning
       print('Too many images considered near, decreasing near size.')
       self.near_size = self.near_size - 1
-      return self.fillArea(position, max_area, min_area)
+      near_images = self.getNearImages(position)
+    best_fits, best_fit_threshold = self.findBestFits(base_signature, base_colour, near_images, max_area, min_area)
+    if len(best_fits) == 0:
+      # No colours available -> use best threshold
+      # NOTE: best_fit_threshold cannot be None since I check the length of near_images at the start of the function
+      self.forceFitting(best_fit_threshold, position, max_area, min_area, crop)
+    else:
+      self.log.info('fillArea == Select best fit')
+      colour, size = self.selectBestFit(best_fits)
+      if crop:
+        size = (min(size[0], max_area[0]), min(size[1], max_area[1]))
+      self.addSectionToImage(colour, position, size)
+    
+  def findBestFits(self, base_signature, base_colour, near_images, max_area, min_area):
+    if self.matcher is not None:
+      candidates = None
+      if self.ann_index is not None:
+        candidates = self.ann_index.query(base_signature, near_images, self.ann_candidates, self.ann_probes)
+      return self.matcher.findBestFits(base_signature, base_colour, near_images, max_area, min_area, self.threshold, self.shuffle_colours_distance, candidates)
     # Threshold
     best_threshold = None
     best_fit_threshold = None
@@ -318,9 +722,8 @@ class Collager():
     best_fit_difference = None
     # check colours
     for colour in self.colours:
-      img = colour.getBaseImage()
-      if not img in near_images:
-        diff = img.getAverageColourDifference(base_colour)
+      if not colour in near_images:
+        diff = colour.getAverageColourDifference(base_colour)
         # Check best threshold
         if best_threshold is None or diff < best_threshold:
             best_threshold = diff
@@ -330,11 +733,10 @@ class Collager():
           continue
         else:
           # Check fitting
-          new_size, factor_difference = self.checkFitting(img, max_area, min_area)
-          # Calculate colour difference
-          img_resized = colour.getResizedImage(new_size)
-          img_partition = img_resized.getPartition()
-          colour_difference = self.computeSectorsDistance(img_partition, base_partition)
+          new_size, factor_difference = self.checkFitting(colour, max_area, min_area)
+          # Calculate colour difference on the closest pyramid level
+          colour_signature = colour.getSignature(new_size)
+          colour_difference = self.computeSectorsDistance(colour_signature, base_signature)
           # Add to fits list
           current_fit = (colour, new_size, factor_difference, colour_difference)
           if best_fit_difference is None or colour_difference < best_fit_difference + self.shuffle_colours_distance:
@@ -350,16 +752,8 @@ class Collager():
                   rm.append(el)
               for el in rm:
                 best_fits.remove(el)
-    
-    if len(best_fits) == 0:
-      # No colours available -> use best threshold
-      # NOTE: best_fit_threshold cannot be None since I check the length of near_images at the start of the function
-      self.forceFitting(best_fit_threshold, position, max_area, min_area)
-    else:
-      self.log.info('fillArea == Select best fit')
-      colour, size = self.selectBestFit(best_fits)
-      self.addSectionToImage(colour, position, size)
-    
+    return best_fits, best_fit_threshold
+  
   def selectBestFit(self, fits):
     # NOTE: I assume fits is not empty
     if self.shuffle_colours:
@@ -402,45 +796,37 @@ class Collager():
     return best_colour
     
   def checkFitting(self, img, max_area, min_area):
-    min_width, min_height = min_area
-    min_factor = max( min_width / img.width, min_height / img.height)
-    max_width, max_height = max_area
-    max_factor = min( max_width / img.width, max_height / img.height)
-    # Lower bound for height and width: I need at least this resize
-    lower_factor = self.collage_image_size_min / min(img.width, img.height)
-    min_factor = max(lower_factor, min_factor)
-    if max_factor >= min_factor:
-      # Any factor in this interval is fine
-      factor = min_factor + random.random() * (max_factor - min_factor)
-      factor_difference = 0.0
-      new_size_width = int(numpy.ceil(img.width * factor))
-      new_size_height = int(numpy.ceil(img.height * factor))
-    else:
-      # I have min_factor > max_factor
-      #factor_difference = min_factor - max_factor
-      if img.width > img.height:
-        new_size_width = max_width
-        new_size_height = max(min_height, self.collage_image_size_min)
+    # Any factor of the resize interval of the area if the image fits in it,
+    # else fill the area along the longer side (the intervals are cached per area)
+    return self.getFittingCache().checkFitting(img, max_area, min_area)
+  
+  def getFittingCache(self):
+    if self.fitting is None:
+      if self.matcher is not None:
+        self.fitting = self.matcher.fitting
       else:
-        new_size_width = max(min_width, self.collage_image_size_min)
-        new_size_height = max_height
-      factor_difference = abs(new_size_width / img.width - new_size_height / img.height)
-    
-    new_size = new_size_width, new_size_height
-    
-    return new_size, factor_difference
+        self.fitting = FittingCache.new(self.colours, self.collage_image_size_min, self.size_ladder)
+    return self.fitting
   
-  def forceFitting(self, colour, position, max_area, min_area): 
+  def forceFitting(self, colour, position, max_area, min_area, crop=False): 
     self.log.info('forceFitting == Force at ' + str(position[0]) + ', ' + str(position[1]))
-    img = colour.getBaseImage() 
-    new_size, _ = self.checkFitting(img, max_area, min_area)
+    new_size, _ = self.checkFitting(colour, max_area, min_area)
+    if crop:
+      new_size = (min(new_size[0], max_area[0]), min(new_size[1], max_area[1]))
     self.addSectionToImage(colour, position, new_size)
     
   def addSectionToImage(self, colour, position, size):
     self.collage_image.addColourAtPosition(colour, position, size)
   
   def getNearImages(self, position):
-    imgs = []
+    # Colours of the images near position
+    colours = []
+    for i, j in self.getNearPositions(position):
+      colours.append(self.collage_image.colours[i,j])
+    return colours
+  
+  def getNearPositions(self, position):
+    positions = []
     x, y = position
     if self.near_size > 0:
       near_dimension_width = self.collage_image_size_avg_width * self.near_size
@@ -449,52 +835,124 @@ class Collager():
         i, j = el
         if i >= x - near_dimension_width - 1 and i <= x + near_dimension_width + 1 and \
            j >= y - near_dimension_height - 1 and j <= y + near_dimension_height + 1:
-          imgs.append(self.collage_image.colours[i,j].getBaseImage())
-    return imgs
-  
-  def computeSectorsDistance(self, colour_partition, refer_partition, refer_shift=None):
-    diff = []
-    if refer_shift is None:
-      i_shift = 0
-      j_shift = 0
-    else:
-      i_shift, j_shift = refer_shift
-    #real_colour_partition = colour_partition.get()
-    #real_refer_partition = refer_partition.get()
-    for index in colour_partition:
-      i, j = index
-      r_i = i + i_shift
-      r_j = j + j_shift
-      if (r_i, r_j) in refer_partition:
-        diff.append( colour_partition[index] - refer_partition[r_i, r_j] )
+          positions.append(el)
+    return positions
+  
+  def computeSectorsDistance(self, colour_signature, refer_signature):
+    diff_mean = ImageManager.computeSignatureDistance(colour_signature, refer_signature)
     # DEBUG WARNING
-    if len(diff) == 0:
+    if diff_mean is None:
       self.log.warn('computeSectorsDistance == Partitions incompatible?')
       # What happened??
       print('ERROR Partition are incompatible????')
       print('***************************')
       return 1.0
-    diff_mean = numpy.mean(diff)
     return diff_mean
   
   def save(self):
     self.log.info('save == Saving...')
-    self.collage_image.saveResized(self.output_image_savepath, self.scale_factor)
+    self.closePreviews()
+    self.collage_image.saveResized(self.output_image_savepath, self.scale_factor, self.thumbnail_cache, self.prefetcher, self.image_writer)
+    # The schema is written while the image is encoded
     self.saveSchema()
+    self.image_writer.wait()
   
   def saveSchema(self):
     schema_savepath = self.output_image_savepath + '.schema.cls'
     self.collage_image.saveSchema(schema_savepath)
   
+  def getCheckpointPath(self):
+    return self.output_image_savepath + CHECKPOINT_EXTENSION
+  
+  def saveCheckpoint(self):
+    # Save the placed images and the state needed to continue from the current line
+    self.log.info('saveCheckpoint == Line ' + str(self.collage_position))
+    data = {}
+    data[DATA_POSITION] = self.collage_position
+    data[DATA_RANDOM_STATE] = random.getstate()
+    numpy_state = numpy.random.get_state()
+    data[DATA_NUMPY_RANDOM_STATE] = [numpy_state[0], numpy_state[1].tolist()] + list(numpy_state[2:])
+    colours = []
+    colours_usage = {}
+    for pos in self.collage_image.colours:
+      colour = self.collage_image.colours[pos]
+      imgname = CollageImage.getColourName(colour)
+      colours.append((imgname, pos, self.collage_image.colours_size[pos]))
+      colours_usage[imgname] = self.collage_image.getColourUsage(colour)
+    data[DATA_COLOURS] = colours
+    data[DATA_COLOURS_USAGE] = colours_usage
+    data[DATA_NEAR_SIZE] = self.near_size
+    data[DATA_SAME_HEIGHT_STREAK] = self.collage_same_height_streak
+    # Write and replace, a crash never leaves a broken checkpoint
+    checkpoint_path = self.getCheckpointPath()
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as hand:
+      hand.write(JSON_encoder.encode(data))
+    os.replace(tmp_path, checkpoint_path)
+  
+  def loadCheckpoint(self):
+    # Restore the collage from the checkpoint, returns the line to continue from
+    checkpoint_path = self.getCheckpointPath()
+    if not os.path.exists(checkpoint_path):
+      print('No checkpoint found, starting from the beginning')
+      return 0
+    print('Resuming from ' + checkpoint_path)
+    with open(checkpoint_path, 'r') as hand:
+      data = JSON_decoder.decode(hand.read())
+    colours_dict = {}
+    for colour in self.colours:
+      colours_dict[CollageImage.getColourName(colour)] = colour
+    for imgname, position, size in data[DATA_COLOURS]:
+      if not imgname in colours_dict:
+        raise Exception('Checkpoint image not found in resources: ' + imgname)
+      self.addSectionToImage(colours_dict[imgname], tuple(position), tuple(size))
+    for imgname in data[DATA_COLOURS_USAGE]:
+      if self.collage_image.getColourUsage(colours_dict[imgname]) != data[DATA_COLOURS_USAGE][imgname]:
+        self.log.warn('loadCheckpoint == Usage mismatch for ' + imgname)
+    version, state, gauss = data[DATA_RANDOM_STATE]
+    random.setstate((version, tuple(state), gauss))
+    numpy_state = data[DATA_NUMPY_RANDOM_STATE]
+    numpy.random.set_state((numpy_state[0], numpy.array(numpy_state[1], dtype=numpy.uint32)) + tuple(numpy_state[2:]))
+    self.near_size = data[DATA_NEAR_SIZE]
+    self.collage_same_height_streak = data[DATA_SAME_HEIGHT_STREAK]
+    self.collage_position = data[DATA_POSITION]
+    self.collage_placements = len(data[DATA_COLOURS])
+    self.log.info('loadCheckpoint == Restored ' + str(self.collage_placements) + ' images, line ' + str(self.collage_position))
+    return self.collage_position
+  
+  def removeCheckpoint(self):
+    checkpoint_path = self.getCheckpointPath()
+    if self.checkpoint_interval > 0 and os.path.exists(checkpoint_path):
+      os.remove(checkpoint_path)
+  
   def savePreview(self):
-    self.collage_image.save(self.output_image_savepath)
+    # Saved in background, the collage goes on
+    if self.keep_output:
+      return
+    if self.preview_writer is None:
+      self.preview_writer = PreviewWriter.new(self.output_image_savepath, self.preview_size)
+    # Only the list of the placements is made here, the preview is painted by the writer
+    self.preview_writer.submit(self.collage_image.size, self.collage_image.getPlacements())
   
-  def hasValidExtension(self, path):
-    _, ext = os.path.splitext(path)
-    return ext.lower() in VALID_FILETYPES
-      
+  def closePreviews(self):
+    # Wait for the last preview, the output is not written by the previews anymore
+    if self.preview_writer is not None:
+      self.preview_writer.close()
+      self.preview_writer = None
   
-def new(base_image, images_folder, images_width, images_height, precision, logger, debug):
+
+_band_collager = None # Collager shared with the band workers (fork)
+
+def collageBandWorker(band):
+  # Each worker has its own copy of the collager
+  sys.stdout = open(os.devnull, 'w')
+  _band_collager.setShowPartials(False) # A band is not a preview of the collage
+  start, _ = band
+  random.seed(time.time() + start)
+  numpy.random.seed((int(time.time()) + start) % 2**32)
+  return _band_collager.collageBand(band)
+
+def new(base_image, images_folder, images_width, images_height, precision, logger, debug, duplicates_distance=None, manifest=None, prefetcher=None):
   collager = Collager(base_image)
   collager.setDebug(debug)
   collager.setLogger(logger)
@@ -505,5 +963,14 @@ def new(base_image, images_folder, images_width, images_height, precision, logge
   else:
     collager.setImagesNumberOnWidth(images_width)
   # Load images
-  collager.loadColours(images_folder)
+  collager.setPrefetcher(prefetcher)
+  collager.loadColours(images_folder, duplicates_distance, manifest)
+  return collager
+
+def newFromLibrary(base_image, library, images_width, images_height, log, debug):
+  # Collager using an already loaded library, the base image is scaled to the library images size
+  collager = Collager(base_image)
+  collager.setDebug(debug)
+  collager.setLog(log)
+  collager.fitToLibrary(library, images_width, images_height)
   return collager
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os
+import atexit
+import numpy
+try:
+  from multiprocessing import shared_memory
+except ImportError: # Python < 3.8
+  shared_memory = None
+
+ALIGNMENT = 64 # Bytes between the start of the arrays
+
+class FeatureStore():
+  # Features of the colours of a library (dimensions, average colours and pyramids) in one
+  # contiguous block of shared memory. Forked workers use the same pages, other processes
+  # attach to the block by name: nothing is copied or pickled
+
+  def __init__(self, layout, shm=None, owner=False):
+    self.layout = layout # name, size and (field, dtype, shape, offset) of every array
+    self.shm = shm
+    self.owner = owner
+    self.owner_pid = os.getpid()
+    if shm is not None:
+      buffer = shm.buf
+    else:
+      buffer = bytearray(layout['size']) # No shared memory: same layout in the process memory
+    self.arrays = {}
+    for field, dtype, shape, offset in layout['fields']:
+      self.arrays[field] = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=buffer, offset=offset)
+
+  def __getitem__(self, field):
+    return self.arrays[field]
+
+  def getLayout(self):
+    # What another process needs to attach (picklable)
+    return self.layout
+
+  def freeze(self):
+    # The store is read only once filled
+    for field in self.arrays:
+      self.arrays[field].flags.writeable = False
+
+  def release(self):
+    # Only the process that created the block removes it
+    if self.shm is None or os.getpid() != self.owner_pid:
+      return
+    self.arrays = {}
+    # Unlink first: the pyramids of the colours may still use the block, it is freed with them
+    try:
+      if self.owner:
+        self.shm.unlink()
+      self.shm.close()
+    except (OSError, BufferError):
+      pass
+    self.shm = None
+
+def getLayout(fields, name=None):
+  # Offsets of the arrays in the block
+  layout_fields = []
+  offset = 0
+  for field, dtype, shape in fields:
+    layout_fields.append((field, numpy.dtype(dtype).str, tuple(int(el) for el in shape), offset))
+    size = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    offset += (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+  return {'name': name, 'size': max(offset, 1), 'fields': layout_fields}
+
+def newFromColours(colours, levels):
+  # Store with the features of the colours, the pyramids of the colours become views of the store
+  colours_number = len(colours)
+  levels_number = len(levels)
+  signatures_height = numpy.zeros((colours_number, levels_number), dtype=numpy.int64)
+  signatures_width = numpy.zeros((colours_number, levels_number), dtype=numpy.int64)
+  for i, colour in enumerate(colours):
+    for l, level in enumerate(levels):
+      height, width, _ = colour.pyramid[level].shape
+      signatures_height[i, l] = height
+      signatures_width[i, l] = width
+  max_height = int(numpy.max(signatures_height))
+  max_width = int(numpy.max(signatures_width))
+  fields = [
+    ('widths', numpy.float64, (colours_number,)),
+    ('heights', numpy.float64, (colours_number,)),
+    ('averages', numpy.float64, (colours_number, 3)),
+    ('signatures_height', numpy.int64, (colours_number, levels_number)),
+    ('signatures_width', numpy.int64, (colours_number, levels_number)),
+    ('signatures', numpy.float32, (colours_number, levels_number, max_height, max_width, 3))
+  ]
+  layout = getLayout(fields)
+  shm = None
+  if shared_memory is not None:
+    shm = shared_memory.SharedMemory(create=True, size=layout['size'])
+    layout['name'] = shm.name
+  store = FeatureStore(layout, shm, owner=True)
+  if shm is not None:
+    atexit.register(store.release)
+  store['widths'][:] = [colour.width for colour in colours]
+  store['heights'][:] = [colour.height for colour in colours]
+  store['averages'][:] = [colour.getAverageColour() for colour in colours]
+  store['signatures_height'][:] = signatures_height
+  store['signatures_width'][:] = signatures_width
+  signatures = store['signatures']
+  for i, colour in enumerate(colours):
+    for l, level in enumerate(levels):
+      signatures[i, l, :signatures_height[i, l], :signatures_width[i, l]] = colour.pyramid[level]
+  store.freeze()
+  # Keep a single copy of the sectors, read only
+  signatures = store['signatures']
+  for i, colour in enumerate(colours):
+    for l, level in enumerate(levels):
+      colour.pyramid[level] = signatures[i, l, :signatures_height[i, l], :signatures_width[i, l]]
+  return store
+
+def attach(layout):
+  # Read only store of another process (same layout)
+  if layout['name'] is None:
+    raise Exception('The feature store is not in shared memory')
+  shm = shared_memory.SharedMemory(name=layout['name'])
+  store = FeatureStore(layout, shm, owner=False)
+  store.freeze()
+  return store
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import math
+import random
+import collections
+import numpy
+
+MAX_CACHE_BYTES = 64 * 2**20 # Memory of the cached geometries
+MIN_CACHE_ENTRIES = 16
+
+class FittingCache():
+  # Resize intervals of the colours for an area, computed once and kept for the next placements
+  # with the same (max_area, min_area): only the random factor is picked at every call. The batch
+  # path computes only the candidates it asks for, the scalar path all the colours at once
+
+  def __init__(self, colours, min_size, ladder=None):
+    self.min_size = min_size
+    self.ladder = None if ladder is None else numpy.array(ladder, dtype=numpy.float64)
+    self.index = {}
+    for i, colour in enumerate(colours):
+      self.index[colour] = i
+    self.widths = numpy.array([colour.width for colour in colours], dtype=numpy.float64)
+    self.heights = numpy.array([colour.height for colour in colours], dtype=numpy.float64)
+    self.short_sides = numpy.minimum(self.widths, self.heights)
+    self.short_side_values = self.short_sides.tolist()
+    self.ladder_values = None if self.ladder is None else self.ladder.tolist()
+    self.lower_factors = self.min_size / self.short_sides
+    self.wide = self.widths > self.heights
+    self.geometries = collections.OrderedDict() # (max_area, min_area) -> geometry, least recently used first
+    entry_bytes = max(len(colours), 1) * (8 * 8 + 1 + 8 * 24) # Eight arrays of 8 bytes, the known colours and the rows
+    self.max_entries = max(MAX_CACHE_BYTES // entry_bytes, MIN_CACHE_ENTRIES)
+    self.hits = 0
+    self.misses = 0
+
+  def getGeometry(self, max_area, min_area, indices=None):
+    # Geometry of the area, computed only for the given colours (all without indices) not seen before
+    key = (tuple(max_area), tuple(min_area))
+    if key in self.geometries:
+      self.geometries.move_to_end(key)
+      geometry = self.geometries[key]
+    else:
+      geometry = self.newGeometry()
+      self.geometries[key] = geometry
+      if len(self.geometries) > self.max_entries:
+        self.geometries.popitem(last=False)
+    if geometry['complete']:
+      self.hits += 1
+      return geometry
+    if indices is None:
+      missing = numpy.nonzero(numpy.logical_not(geometry['known']))[0]
+    else:
+      missing = indices[numpy.logical_not(geometry['known'][indices])]
+    if len(missing) == 0:
+      self.hits += 1
+      return geometry
+    self.misses += 1
+    for field, values in self.computeGeometry(max_area, min_area, missing).items():
+      geometry[field][missing] = values
+    geometry['known'][missing] = True
+    geometry['complete'] = len(missing) == len(self.widths) or bool(numpy.all(geometry['known']))
+    return geometry
+
+  def getRows(self, max_area, min_area):
+    # Geometry of every colour as Python values, for the scalar path: (fitting, min_factor, max_factor,
+    # forced_width, forced_height, factor_difference), then first_rung and rungs_number with a ladder
+    geometry = self.getGeometry(max_area, min_area)
+    if geometry['rows'] is None:
+      columns = [geometry['fitting'], geometry['min_factor'], geometry['max_factor'], geometry['forced_widths'],
+        geometry['forced_heights'], geometry['factor_differences']]
+      if self.ladder is not None:
+        columns += [geometry['first_rung'], geometry['rungs_number']]
+      geometry['rows'] = list(zip(*[column.tolist() for column in columns]))
+    return geometry['rows']
+
+  def newGeometry(self):
+    colours_number = len(self.widths)
+    geometry = {'known': numpy.zeros(colours_number, dtype=bool), 'complete': colours_number == 0, 'rows': None}
+    for field in ['min_factor', 'max_factor', 'factor_differences']:
+      geometry[field] = numpy.zeros(colours_number, dtype=numpy.float64)
+    for field in ['forced_widths', 'forced_heights']:
+      geometry[field] = numpy.zeros(colours_number, dtype=numpy.int64)
+    geometry['fitting'] = numpy.zeros(colours_number, dtype=bool)
+    if self.ladder is not None:
+      geometry['first_rung'] = numpy.zeros(colours_number, dtype=numpy.int64)
+      geometry['rungs_number'] = numpy.zeros(colours_number, dtype=numpy.int64)
+    return geometry
+
+  def computeGeometry(self, max_area, min_area, indices):
+    # Same as Collager.checkFitting without the random factor, for the given colours
+    min_width, min_height = min_area
+    max_width, max_height = max_area
+    widths = self.widths[indices]
+    heights = self.heights[indices]
+    wide = self.wide[indices]
+    min_factor = numpy.maximum(min_width / widths, min_height / heights)
+    max_factor = numpy.minimum(max_width / widths, max_height / heights)
+    min_factor = numpy.maximum(self.lower_factors[indices], min_factor)
+    fitting = max_factor >= min_factor
+    # Not fitting: fill the area along the longer side
+    forced_widths = numpy.where(wide, max_width, max(min_width, self.min_size)).astype(numpy.int64)
+    forced_heights = numpy.where(wide, max(min_height, self.min_size), max_height).astype(numpy.int64)
+    factor_differences = numpy.where(fitting, 0.0, numpy.abs(forced_widths / widths - forced_heights / heights))
+    geometry = {'min_factor': min_factor, 'max_factor': max_factor, 'fitting': fitting,
+      'forced_widths': forced_widths, 'forced_heights': forced_heights, 'factor_differences': factor_differences}
+    if self.ladder is not None:
+      # Rungs of the ladder in the interval
+      short_sides = self.short_sides[indices]
+      first = numpy.searchsorted(self.ladder, short_sides * min_factor, side='left')
+      last = numpy.searchsorted(self.ladder, short_sides * max_factor, side='right')
+      geometry['first_rung'] = first
+      geometry['rungs_number'] = last - first
+    return geometry
+
+  def checkFittings(self, indices, max_area, min_area):
+    # New sizes and factor differences of the given colours (numpy random)
+    indices = numpy.asarray(indices, dtype=numpy.int64)
+    geometry = self.getGeometry(max_area, min_area, indices)
+    widths = self.widths[indices]
+    heights = self.heights[indices]
+    min_factor = geometry['min_factor'][indices]
+    max_factor = geometry['max_factor'][indices]
+    fitting = geometry['fitting'][indices]
+    factor = min_factor + numpy.random.random(len(indices)) * (max_factor - min_factor)
+    laddered = numpy.zeros(len(indices), dtype=bool)
+    if self.ladder is not None:
+      # Pick a random rung of the ladder in the interval
+      first = geometry['first_rung'][indices]
+      rungs_number = geometry['rungs_number'][indices]
+      rung = first + numpy.floor(numpy.random.random(len(indices)) * rungs_number).astype(numpy.int64)
+      rung = numpy.minimum(rung, len(self.ladder) - 1)
+      laddered = rungs_number > 0
+      factor = numpy.where(laddered, self.ladder[rung] / self.short_sides[indices], factor)
+    # A rung gives the short side exactly: drop the float error before the ceil
+    new_widths = numpy.where(laddered, numpy.ceil(numpy.round(widths * factor, 6)), numpy.ceil(widths * factor))
+    new_heights = numpy.where(laddered, numpy.ceil(numpy.round(heights * factor, 6)), numpy.ceil(heights * factor))
+    new_widths = numpy.where(fitting, new_widths, geometry['forced_widths'][indices]).astype(numpy.int64)
+    new_heights = numpy.where(fitting, new_heights, geometry['forced_heights'][indices]).astype(numpy.int64)
+    return new_widths, new_heights, geometry['factor_differences'][indices]
+
+  def checkFitting(self, colour, max_area, min_area):
+    # New size and factor difference of a colour (random module, as Collager.checkFitting)
+    i = self.index[colour]
+    row = self.getRows(max_area, min_area)[i]
+    if not row[0]:
+      return (row[3], row[4]), row[5]
+    factor = None
+    if self.ladder is not None:
+      rungs_number = row[7]
+      if rungs_number > 0:
+        r = random.randint(0, rungs_number-1)
+        factor = self.ladder_values[row[6] + r] / self.short_side_values[i]
+    if factor is None:
+      factor = row[1] + random.random() * (row[2] - row[1])
+      new_size = (math.ceil(colour.width * factor), math.ceil(colour.height * factor))
+    else:
+      # A rung gives the short side exactly: drop the float error before the ceil
+      new_size = (math.ceil(round(colour.width * factor, 6)), math.ceil(round(colour.height * factor, 6)))
+    return new_size, 0.0
+
+def new(*args, **kwargs):
+  cache = FittingCache(*args, **kwargs)
+  return cache
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import sys
+import numpy
+from lib import AssignmentSolver
+
+MAX_COST_ELEMENTS = 2**22 # Sectors compared at once when computing the costs
+GLOBAL_CANDIDATES = 32 # Colours considered for each tile by the global assignment
+
+class GridLayout():
+
+  def __init__(self, collager):
+    self.collager = collager
+    self.colours = collager.colours
+    self.tile_size = collager.collage_image_size
+    self.sector_size = collager.sector_size
+    self.lines = self.tile_size // self.sector_size
+    width, height = collager.collage_image.size
+    self.columns = int(numpy.ceil(1.0 * width / self.tile_size))
+    self.rows = int(numpy.ceil(1.0 * height / self.tile_size))
+    self.tiles_number = self.columns * self.rows
+    self.index = {}
+    for i, colour in enumerate(self.colours):
+      self.index[colour] = i
+    self.tiles = None
+    self.tiles_mask = None
+    self.tiles_colour = None
+    self.signatures = None
+    self.averages = None
+
+  def setup(self):
+    self.loadTiles()
+    self.loadColours()
+
+  def loadTiles(self):
+    # Sectors of every tile of the base image in one pass, in scan order
+    grid = self.collager.base_image.signature()
+    height_lines, width_lines, _ = grid.shape
+    padded = numpy.full((self.rows * self.lines, self.columns * self.lines, 3), numpy.nan)
+    padded[:height_lines, :width_lines] = grid
+    tiles = padded.reshape(self.rows, self.lines, self.columns, self.lines, 3)
+    tiles = tiles.transpose(0, 2, 1, 3, 4).reshape(self.tiles_number, self.lines, self.lines, 3)
+    # Sectors outside the base image are not compared
+    self.tiles_mask = numpy.logical_not(numpy.isnan(tiles[:, :, :, 0]))
+    tiles = numpy.nan_to_num(tiles)
+    counts = numpy.sum(self.tiles_mask, axis=(1, 2))
+    self.tiles_colour = numpy.sum(tiles, axis=(1, 2)) / counts[:, None]
+    self.tiles = tiles.astype(numpy.float32)
+
+  def loadColours(self):
+    # Sectors of every colour resized to the tile size
+    self.signatures = numpy.array([colour.getTileSignature(self.tile_size) for colour in self.colours], dtype=numpy.float32)
+    self.averages = numpy.array([colour.getAverageColour() for colour in self.colours], dtype=numpy.float64)
+
+  def getTilePosition(self, tile):
+    row, column = divmod(tile, self.columns)
+    return column * self.tile_size, row * self.tile_size
+
+  def getTileSize(self, tile):
+    return self.tile_size, self.tile_size
+
+  def iterCosts(self, tiles_index=None):
+    # Yield the sectors distance and the average colour difference (tiles x colours) by chunks of tiles
+    if tiles_index is None:
+      tiles_index = numpy.arange(self.tiles_number)
+    colours_number = len(self.colours)
+    chunk = max(1, MAX_COST_ELEMENTS // (colours_number * self.lines * self.lines))
+    for start in range(0, len(tiles_index), chunk):
+      batch = tiles_index[start:start+chunk]
+      tiles = self.tiles[batch]
+      mask = self.tiles_mask[batch]
+      norms = numpy.linalg.norm(self.signatures[None] - tiles[:, None], axis=4)
+      counts = numpy.sum(mask, axis=(1, 2))
+      costs = numpy.sum(norms * mask[:, None], axis=(2, 3)) / counts[:, None]
+      averages_difference = numpy.linalg.norm(self.tiles_colour[batch, None] - self.averages[None], axis=2)
+      yield start, costs, averages_difference
+
+  def getCapacities(self, max_usage):
+    # Usages left for every colour, counting the images already in the collage
+    usage = numpy.array([self.collager.collage_image.getColourUsage(colour) for colour in self.colours], dtype=numpy.int64)
+    return numpy.maximum(max_usage - usage, 0)
+
+  def getNearColours(self, assignment, tile):
+    # Colours already assigned to the tiles within near_size tiles
+    near_size = self.collager.near_size
+    if near_size <= 0:
+      return numpy.zeros(0, dtype=numpy.int64)
+    grid = assignment.reshape(self.rows, self.columns)
+    row, column = divmod(tile, self.columns)
+    near = grid[max(row - near_size, 0):row + near_size + 1, max(column - near_size, 0):column + near_size + 1]
+    return numpy.unique(near[near >= 0])
+
+  def findTileFits(self, costs, averages_difference, excluded):
+    # Returns the fits as in Collager.findBestFits and the colour index with the closest average
+    available = numpy.ones(len(self.colours), dtype=bool)
+    available[excluded] = False
+    if not numpy.any(available):
+      available[:] = True
+    forced = int(numpy.argmin(numpy.where(available, averages_difference, numpy.inf)))
+    candidates = numpy.logical_and(available, averages_difference <= self.collager.threshold)
+    if not numpy.any(candidates):
+      return [], forced
+    best_cost = numpy.min(costs[candidates])
+    keep = numpy.nonzero(numpy.logical_and(candidates, costs < best_cost + self.collager.shuffle_colours_distance))[0]
+    size = (self.tile_size, self.tile_size)
+    fits = []
+    for k in keep:
+      fits.append((self.colours[k], size, 0.0, float(costs[k])))
+    return fits, forced
+
+  def assign(self):
+    # Greedy assignment in scan order
+    assignment = numpy.full(self.tiles_number, -1, dtype=numpy.int64)
+    for start, costs, averages_difference in self.iterCosts():
+      for k in range(len(costs)):
+        tile = start + k
+        excluded = self.getNearColours(assignment, tile)
+        fits, forced = self.findTileFits(costs[k], averages_difference[k], excluded)
+        if len(fits) == 0:
+          assignment[tile] = forced
+        else:
+          colour, _ = self.collager.selectBestFit(fits)
+          assignment[tile] = self.index[colour]
+      perc = round(100.0 * (start + len(costs)) / self.tiles_number)
+      sys.stdout.write('\r Matching: ' + str(perc) + ' %   ')
+      sys.stdout.flush()
+    sys.stdout.write('\n')
+    return assignment
+
+  def assignGlobal(self, max_usage):
+    # Min cost assignment of the whole grid with at most max_usage tiles per colour
+    capacities = self.getCapacities(max_usage)
+    candidates_number = min(GLOBAL_CANDIDATES, len(self.colours))
+    candidates = numpy.full((self.tiles_number, candidates_number), -1, dtype=numpy.int64)
+    candidates_cost = numpy.zeros((self.tiles_number, candidates_number), dtype=numpy.float64)
+    for start, costs, averages_difference in self.iterCosts():
+      available = capacities > 0
+      allowed = numpy.logical_and(available[None], averages_difference <= self.collager.threshold)
+      # Tiles without colours under the threshold can use any colour
+      allowed[numpy.logical_not(numpy.any(allowed, axis=1))] = available
+      costs = numpy.where(allowed, costs, numpy.inf)
+      best = numpy.argpartition(costs, candidates_number - 1, axis=1)[:, :candidates_number]
+      best_cost = numpy.take_along_axis(costs, best, axis=1)
+      end = start + len(costs)
+      candidates[start:end] = numpy.where(numpy.isfinite(best_cost), best, -1)
+      candidates_cost[start:end] = numpy.where(numpy.isfinite(best_cost), best_cost, 0.0)
+    print(' Solving assignment')
+    solver = AssignmentSolver.new(candidates, candidates_cost, capacities)
+    solution = solver.solve()
+    # Follow the solution in scan order, the prices of the solver guide the tiles that
+    # cannot use their colour because of near images or usage limits
+    usage = numpy.zeros(len(self.colours), dtype=numpy.int64)
+    assignment = numpy.full(self.tiles_number, -1, dtype=numpy.int64)
+    missing = []
+    for tile in range(self.tiles_number):
+      excluded = self.getNearColours(assignment, tile)
+      colour = solution[tile]
+      if colour < 0 or colour in excluded or usage[colour] >= capacities[colour]:
+        colour = -1
+        best_value = None
+        for k in range(candidates_number):
+          candidate = candidates[tile, k]
+          if candidate >= 0 and usage[candidate] < capacities[candidate] and not candidate in excluded:
+            value = candidates_cost[tile, k] + solver.prices[candidate]
+            if best_value is None or value < best_value:
+              best_value = value
+              colour = candidate
+      if colour < 0:
+        missing.append(tile)
+        continue
+      assignment[tile] = colour
+      usage[colour] += 1
+    self.fillMissing(assignment, missing, usage, capacities, solver.prices)
+    return assignment
+
+  def fillMissing(self, assignment, missing, usage, capacities, prices):
+    # Pick the best colour among all the others, ignoring the usage limit if needed
+    if len(missing) == 0:
+      return
+    self.collager.log.info('fillMissing == Tiles without candidates: ' + str(len(missing)))
+    missing = numpy.array(missing, dtype=numpy.int64)
+    for start, costs, averages_difference in self.iterCosts(missing):
+      for k in range(len(costs)):
+        tile = missing[start + k]
+        excluded = self.getNearColours(assignment, tile)
+        full = numpy.nonzero(usage >= capacities)[0]
+        if len(numpy.union1d(excluded, full)) < len(self.colours):
+          excluded = numpy.union1d(excluded, full)
+        fits, forced = self.findTileFits(costs[k] + prices, averages_difference[k], excluded)
+        if len(fits) == 0:
+          colour = forced
+        else:
+          colour = self.index[min(fits, key=lambda el : el[3])[0]]
+        assignment[tile] = colour
+        usage[colour] += 1
+
+  def place(self, assignment):
+    for tile in range(self.tiles_number):
+      perc = round(100.0 * tile / self.tiles_number)
+      sys.stdout.write('\r Progression: ' + str(perc) + ' %   ')
+      sys.stdout.flush()
+      colour = self.colours[assignment[tile]]
+      self.collager.addSectionToImage(colour, self.getTilePosition(tile), self.getTileSize(tile))
+    sys.stdout.write('\r Progression: 100 %   \n')
+    sys.stdout.flush()
+
+def new(*args, **kwargs):
+  grid = GridLayout(*args, **kwargs)
+  return grid
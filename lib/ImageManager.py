@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import io
 from PIL import Image
 import numpy
 
@@ -84,6 +85,7 @@ class ImageManager():
     self.size = self.img.size
     self.width, self.height = self.size
     self.pixelManager = None
+    self._array = None
     self._partition = None
     self._partition_square_size = None
   
@@ -102,19 +104,39 @@ class ImageManager():
   def load(self):
     self.img = self.img.convert('RGB')
     self.pixelManager = self.img.load()
+    self._array = None
+  
+  def getArray(self):
+    # Pixels as an uint8 array of shape (height, width, 3), the sectors are reduced in float
+    if self.pixelManager is None:
+      self.load()
+    if self._array is None:
+      self._array = numpy.asarray(self.img, dtype=numpy.uint8)
+    return self._array
   
   def save(self, filepath):
     self.img.save(filepath)
   
   def resize(self, width, height):
     self.img = self.img.resize((width, height), Image.ANTIALIAS)
-    self.width, self.height = self.img.size
+    self.size = self.img.size
+    self.width, self.height = self.size
+    self.pixelManager = None
+    self._array = None
+  
+  def draft(self, size):
+    # Decode at a reduced scale (JPEG only) when the image is shrunk to size anyway
+    self.img.draft('RGB', size)
+    self.size = self.img.size
+    self.width, self.height = self.size
   
   def getResizedCopy(self, size, antialias=False):
+    # Centre crop to the aspect ratio of size, the image is never stretched
+    box = getCropBox(self.img.size, size)
     if antialias:
-      new_img = self.img.resize(size, Image.ANTIALIAS)
+      new_img = self.img.resize(size, Image.ANTIALIAS, box=box)
     else:
-      new_img = self.img.resize(size)
+      new_img = self.img.resize(size, box=box)
     return new_img
   
   def resizeMinimal(self, size):
@@ -126,10 +148,15 @@ class ImageManager():
   
   def resizeMaximal(self, size):
     # Resize the image so that width or height are of the given size
+    new_width, new_height = self.getMaximalSize(size)
+    self.resize(new_width, new_height)
+  
+  def getMaximalSize(self, size):
+    # Size given by resizeMaximal
     factor = 1.0 * size / min(self.width, self.height)
     new_width = int(numpy.ceil(self.width*factor))
     new_height = int(numpy.ceil(self.height*factor))
-    self.resize(new_width, new_height)
+    return new_width, new_height
   
   def resizeBest(self, size):
     # Resize to the best approx of n*size x m*size
@@ -198,6 +225,25 @@ class ImageManager():
     section = ImageSection((x, y), square_width, median)
     return section
   
+  def signature(self):
+    return self.createShiftedSignature((0, 0), (self.width, self.height))
+  
+  def createShiftedSignature(self, start, size):
+    # Same sectors as createShiftedPartition, as a (height_lines, width_lines, 3) array
+    x, y = start
+    width, height = size
+    data = self.getArray()[y:y+height, x:x+width]
+    return computeSectorGrid(data, self._partition_square_size)
+  
+  def differenceHash(self):
+    # 64 bits perceptual hash: brightness gradients of the image shrunk to 9x8
+    small = numpy.asarray(self.img.convert('L').resize((9, 8), Image.ANTIALIAS), dtype=numpy.int64)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+      value = (value << 1) | int(bit)
+    return value
+  
   def computeSection(self, i, j, square_width):
     return self.computeShiftedSection(0, 0, i, j, square_width)
   
@@ -223,6 +269,36 @@ class ImageManager():
       new_image.paste(colour_img, section.getPosition())
     new_image.save(savepath)
       
+def getCropBox(original_size, size):
+  # Centred box of an original_size image with the aspect ratio of size
+  width, height = original_size
+  new_width, new_height = size
+  if width * new_height > height * new_width:
+    crop_width = 1.0 * height * new_width / new_height
+    return ((width - crop_width) / 2, 0.0, (width + crop_width) / 2, float(height))
+  crop_height = 1.0 * width * new_height / new_width
+  return (0.0, (height - crop_height) / 2, float(width), (height + crop_height) / 2)
+
+def computeSectorGrid(data, square_width):
+  # Mean colour of each square_width x square_width sector of a (height, width, 3) array,
+  # sectors on the right and bottom borders may be smaller
+  height, width = data.shape[:2]
+  rows = numpy.arange(0, height, square_width)
+  cols = numpy.arange(0, width, square_width)
+  sums = numpy.add.reduceat(numpy.add.reduceat(data, rows, axis=0, dtype=numpy.float64), cols, axis=1)
+  rows_count = numpy.diff(numpy.append(rows, height))
+  cols_count = numpy.diff(numpy.append(cols, width))
+  return sums / (rows_count[:, None, None] * cols_count[None, :, None])
+
+def computeSignatureDistance(signature, refer_signature):
+  # Mean colour distance of the overlapping sectors, None if the signatures do not overlap
+  height = min(signature.shape[0], refer_signature.shape[0])
+  width = min(signature.shape[1], refer_signature.shape[1])
+  if height == 0 or width == 0:
+    return None
+  diff = signature[:height, :width] - refer_signature[:height, :width]
+  return numpy.mean(numpy.linalg.norm(diff, axis=2))
+
 def new(*args, **kwargs):
   img = ImageManager(*args, **kwargs)
   return img
@@ -234,3 +310,9 @@ def newFromPath(filepath):
 def newFromData(data):
   img = ImageManager(image=data)
   return img
+
+def newFromContent(content, filepath=None):
+  # Image from the bytes of a file already read
+  img = ImageManager(image=Image.open(io.BytesIO(content)))
+  img.imgpath = filepath
+  return img
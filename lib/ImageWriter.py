@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+
+FORMAT_PNG = 'png'
+FORMAT_JPEG = 'jpeg'
+FORMAT_WEBP = 'webp'
+FORMAT_TIFF = 'tiff'
+FORMATS = [FORMAT_PNG, FORMAT_JPEG, FORMAT_WEBP, FORMAT_TIFF]
+EXTENSIONS = {'.png': FORMAT_PNG, '.jpg': FORMAT_JPEG, '.jpeg': FORMAT_JPEG, '.webp': FORMAT_WEBP, '.tif': FORMAT_TIFF, '.tiff': FORMAT_TIFF}
+ALPHA_FORMATS = [FORMAT_PNG, FORMAT_WEBP, FORMAT_TIFF] # Formats keeping the empty areas transparent
+
+DEFAULT_COMPRESSION = 3 # zlib level of PNG (0-9), the PIL default (6) is much slower on big images
+DEFAULT_QUALITY = 90 # JPEG and WebP quality (0-100)
+DEFAULT_ROWS_PER_STRIP = 256 # TIFF rows compressed together
+
+class ImageWriter():
+  # Saves the rendered images with explicit settings for every format.
+  # The encoding may run on a background thread (PIL releases the GIL while encoding)
+
+  def __init__(self, image_format=None, compression=DEFAULT_COMPRESSION, quality=DEFAULT_QUALITY):
+    self.image_format = image_format # None: from the file extension
+    self.compression = compression
+    self.quality = quality
+    self.progressive = True # JPEG
+    self.lossless = False # WebP
+    self.thread = None
+    self.error = None
+
+  def setCompression(self, compression):
+    self.compression = compression
+
+  def setQuality(self, quality):
+    self.quality = quality
+
+  def setProgressive(self, value=True):
+    self.progressive = value
+
+  def setLossless(self, value=True):
+    self.lossless = value
+
+  def getFormat(self, savepath):
+    if self.image_format is not None:
+      return self.image_format
+    _, ext = os.path.splitext(savepath)
+    return EXTENSIONS.get(ext.lower(), FORMAT_PNG)
+
+  def hasAlpha(self, savepath):
+    return self.getFormat(savepath) in ALPHA_FORMATS
+
+  def getOptions(self, image_format, img=None):
+    if image_format == FORMAT_JPEG:
+      return {'quality': self.quality, 'optimize': True, 'progressive': self.progressive}
+    if image_format == FORMAT_WEBP:
+      return {'quality': self.quality, 'lossless': self.lossless, 'method': 4}
+    if image_format == FORMAT_TIFF:
+      # Compressed strips (PIL does not write tiled TIFF), the strip size is given in bytes
+      options = {'compression': 'tiff_adobe_deflate'}
+      if img is not None:
+        options['strip_size'] = DEFAULT_ROWS_PER_STRIP * img.width * len(img.getbands())
+      return options
+    return {'compress_level': self.compression}
+
+  def write(self, img, savepath, alpha=None):
+    # Save img (RGB) with the alpha band if given and the format keeps it
+    image_format = self.getFormat(savepath)
+    if alpha is not None and image_format in ALPHA_FORMATS:
+      img.putalpha(alpha)
+    if img.mode not in ('RGB', 'L') and not (img.mode == 'RGBA' and image_format in ALPHA_FORMATS):
+      img = img.convert('RGB')
+    img.save(savepath, image_format.upper(), **self.getOptions(image_format, img))
+
+  def start(self, img, savepath, alpha=None):
+    # Encode on a background thread, wait() before using the file
+    self.wait()
+    self.error = None
+    self.thread = threading.Thread(target=self.run, args=(img, savepath, alpha))
+    self.thread.start()
+
+  def run(self, img, savepath, alpha):
+    try:
+      self.write(img, savepath, alpha)
+    except Exception as error:
+      self.error = error
+
+  def wait(self):
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    if self.error is not None:
+      error = self.error
+      self.error = None
+      raise error
+
+def getExtension(image_format):
+  # File extension of a format
+  for ext in EXTENSIONS:
+    if EXTENSIONS[ext] == image_format:
+      return ext
+  return '.png'
+
+def new(*args, **kwargs):
+  writer = ImageWriter(*args, **kwargs)
+  return writer
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import os
+import multiprocessing
+from lib import Collager
+from lib import CollageImage
+from lib import ImageWriter
+from lib import ResourceLibrary
+from lib import AnnIndex
+from lib import AdaptiveLayout
+from lib import PreviewWriter
+
+DEFAULT_TILE_SIZE = 64
+
+# Same names and defaults of the pm.py options
+DEFAULT_OPTIONS = {
+  'scale': 1,
+  'images_width': 8,
+  'images_height': None,
+  'threshold': 100,
+  'precision': 4,
+  'near_size': 3,
+  'shuffle': False,
+  'shuffle_distance': 20,
+  'shuffle_geometry': 0,
+  'size_ladder': 0,
+  'batch_matching': False,
+  'ann_candidates': 0,
+  'ann_probes': AnnIndex.DEFAULT_PROBES,
+  'layout': Collager.LAYOUT_SCAN,
+  'adaptive_levels': AdaptiveLayout.DEFAULT_LEVELS,
+  'adaptive_threshold': AdaptiveLayout.DEFAULT_THRESHOLD,
+  'workers': None,
+  'assignment': Collager.ASSIGNMENT_GREEDY,
+  'max_usage': 0,
+  'show_previews': False,
+  'preview_size': PreviewWriter.DEFAULT_MAX_SIZE,
+  'checkpoint': 0,
+  'resume': False,
+  'tile_size': DEFAULT_TILE_SIZE
+}
+
+# Options of the renders of saved schemas
+DEFAULT_RENDER_OPTIONS = {
+  'scale': 1,
+  'precision': 4,
+  'tile_size': DEFAULT_TILE_SIZE
+}
+
+class MosaicService():
+  # Keeps the resource libraries in memory and makes collages with them
+
+  def __init__(self, logger, debug=False):
+    self.debug = debug
+    if debug:
+      self.log = logger.createDebugLogger('service.txt', self)
+    else:
+      self.log = logger.createInfoLogger('service.txt', self)
+    self.libraries = {}
+    self.tile_size = DEFAULT_TILE_SIZE
+    self.duplicates_distance = None
+    self.manifests = {} # Resources folder -> manifest file
+    self.prefetcher = None
+    self.image_writer = None
+    self.thumbnail_cache = None
+
+  def setTileSize(self, size):
+    # Default library images size
+    self.tile_size = size
+
+  def setDuplicatesDistance(self, distance):
+    # Max hash distance of the near duplicates removed from the libraries (None to keep all)
+    self.duplicates_distance = distance
+
+  def setManifest(self, images_folder, manifest):
+    # Read the images of the folder from the manifest (saved if missing)
+    self.manifests[os.path.abspath(images_folder)] = manifest
+
+  def setPrefetcher(self, prefetcher):
+    # Read the images ahead while loading the libraries and rendering
+    self.prefetcher = prefetcher
+
+  def setImageWriter(self, writer):
+    # Settings of the saved collages
+    self.image_writer = writer
+
+  def setThumbnailCache(self, cache):
+    self.thumbnail_cache = cache
+
+  def getLibrary(self, images_folder, tile_size, precision):
+    # Load the library only the first time it is requested
+    key = ResourceLibrary.getKey(images_folder, tile_size, precision, self.duplicates_distance)
+    if not key in self.libraries:
+      self.log.info('getLibrary == Loading ' + str(key))
+      manifest = self.manifests.get(os.path.abspath(images_folder))
+      library = ResourceLibrary.new(images_folder, tile_size, precision, self.duplicates_distance, manifest)
+      library.setLogger(self.log)
+      library.setPrefetcher(self.prefetcher)
+      library.load()
+      self.libraries[key] = library
+    return self.libraries[key]
+
+  def getLibrariesInfo(self):
+    info = []
+    for key in self.libraries:
+      images_folder, sector_size, precision, _ = key
+      library = self.libraries[key]
+      info.append({'resources': images_folder, 'tile_size': library.collage_image_size, 'precision': precision, 'images': len(library.colours)})
+    return info
+
+  def getOptions(self, request):
+    options = dict(DEFAULT_OPTIONS)
+    options['tile_size'] = self.tile_size
+    for key in request:
+      if key in ['input', 'output', 'resources'] or key in DEFAULT_OPTIONS:
+        options[key] = request[key]
+      else:
+        raise ValueError('Unknown option: ' + key)
+    for key in ['input', 'output', 'resources']:
+      if not key in options or options[key] is None:
+        raise ValueError('Missing option: ' + key)
+    if not os.path.exists(options['input']):
+      raise ValueError('Base image not found: ' + options['input'])
+    if not os.path.isdir(options['resources']):
+      raise ValueError('Missing resources folder: ' + options['resources'])
+    return options
+
+  def getRenderOptions(self, request):
+    options = dict(DEFAULT_RENDER_OPTIONS)
+    options['tile_size'] = self.tile_size
+    for key in request:
+      if key in ['schema', 'output', 'resources'] or key in DEFAULT_RENDER_OPTIONS:
+        options[key] = request[key]
+      else:
+        raise ValueError('Unknown option: ' + key)
+    for key in ['schema', 'output', 'resources']:
+      if not key in options or options[key] is None:
+        raise ValueError('Missing option: ' + key)
+    if not os.path.exists(options['schema']):
+      raise ValueError('Schema not found: ' + options['schema'])
+    if not os.path.isdir(options['resources']):
+      raise ValueError('Missing resources folder: ' + options['resources'])
+    return options
+
+  def render(self, request):
+    # Render a saved schema at a scale with the images of the loaded library
+    options = self.getRenderOptions(request)
+    library = self.getLibrary(options['resources'], int(options['tile_size']), int(options['precision']))
+    collage_image = CollageImage.newFromSchema(options['schema'], options['resources'], library.colours)
+    if collage_image is None:
+      raise ValueError('Schema images not found in resources: ' + options['schema'])
+    self.log.info('render == ' + options['output'])
+    writer = self.image_writer
+    if writer is None:
+      writer = ImageWriter.new()
+    collage_image.saveResized(options['output'], int(options['scale']), self.thumbnail_cache, self.prefetcher, writer)
+    writer.wait()
+    return {'output': options['output']}
+
+  def newCollager(self, request):
+    # Collager for the request options using the loaded library
+    options = self.getOptions(request)
+    library = self.getLibrary(options['resources'], int(options['tile_size']), int(options['precision']))
+    images_height = options['images_height']
+    if images_height is not None:
+      images_height = int(images_height)
+    collager = Collager.newFromLibrary(options['input'], library, int(options['images_width']), images_height, self.log, self.debug)
+    applyOptions(collager, options)
+    collager.setPrefetcher(self.prefetcher)
+    if self.thumbnail_cache is not None:
+      collager.setThumbnailCache(self.thumbnail_cache)
+    if self.image_writer is not None:
+      collager.setImageWriter(self.image_writer)
+    return collager
+
+  def collage(self, request):
+    # Make the collage and return the saved files
+    collager = self.newCollager(request)
+    self.log.info('collage == ' + collager.output_image_savepath)
+    try:
+      collager.collage()
+    except Exception:
+      # Keep the placed images to resume from
+      if collager.checkpoint_interval > 0:
+        collager.saveCheckpoint()
+      raise
+    collager.save()
+    return {'output': collager.output_image_savepath, 'schema': collager.output_image_savepath + '.schema.cls'}
+
+  def collageBatch(self, requests, jobs=1):
+    # Load the libraries once, then make the collages (jobs at a time)
+    for request in requests:
+      options = self.getOptions(request)
+      self.getLibrary(options['resources'], int(options['tile_size']), int(options['precision']))
+    if jobs <= 1 or len(requests) <= 1:
+      return [self.collageSafe(request) for request in requests]
+    # The workers share the loaded libraries (fork)
+    global _batch_service
+    _batch_service = self
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(jobs, len(requests))) as pool:
+      results = pool.map(collageBatchWorker, requests)
+    _batch_service = None
+    return results
+
+  def collageSequence(self, requests, threshold=Collager.DEFAULT_SEQUENCE_THRESHOLD):
+    # Frames of a video, in order: a frame reuses the collage and the render of the previous one,
+    # only the images over the changed sectors are matched and rendered again
+    for request in requests:
+      options = self.getOptions(request)
+      self.getLibrary(options['resources'], int(options['tile_size']), int(options['precision']))
+    results = []
+    previous = None # Output of the previous frame
+    reference = None # Sector colours of the last match
+    for request in requests:
+      try:
+        collager = self.newCollager(request)
+        if previous is None:
+          self.log.info('collageSequence == Full frame ' + collager.output_image_savepath)
+          collager.collage()
+          collager.save()
+          reference = collager.getSectorColours()
+        else:
+          self.log.info('collageSequence == Frame ' + collager.output_image_savepath)
+          reference = collager.collageFrame(previous, reference, threshold)
+        previous = collager.output_image_savepath
+        result = {'output': previous, 'schema': previous + '.schema.cls'}
+      except Exception as error:
+        # The next frame starts over
+        self.log.info('collageSequence == Error with ' + str(request.get('input')) + ': ' + str(error))
+        previous = None
+        result = {'error': str(error)}
+      result['input'] = request.get('input')
+      results.append(result)
+    return results
+
+  def collageSafe(self, request):
+    # Same as collage, errors are returned with the result
+    try:
+      result = self.collage(request)
+    except Exception as error:
+      self.log.info('collageSafe == Error with ' + str(request.get('input')) + ': ' + str(error))
+      result = {'error': str(error)}
+    result['input'] = request.get('input')
+    return result
+
+_batch_service = None # Service shared with the batch workers (fork)
+
+def collageBatchWorker(request):
+  return _batch_service.collageSafe(request)
+
+def applyOptions(collager, options):
+  collager.setOutputImage(options['output'])
+  collager.setScaleFactor(int(options['scale']))
+  collager.setShuffleColours(bool(options['shuffle']))
+  collager.setShuffleColoursDistance(int(options['shuffle_distance']))
+  collager.setShuffleGeometry(float(options['shuffle_geometry']))
+  collager.setSizeLadder(int(options['size_ladder']))
+  collager.setBatchMatching(bool(options['batch_matching']))
+  collager.setAnnSearch(int(options['ann_candidates']), int(options['ann_probes']))
+  collager.setLayout(options['layout'])
+  collager.setAdaptiveLayout(int(options['adaptive_levels']), float(options['adaptive_threshold']))
+  if options['workers'] is not None:
+    collager.setWorkers(int(options['workers']))
+  collager.setAssignment(options['assignment'])
+  collager.setMaxUsage(int(options['max_usage']))
+  collager.setThreshold(int(options['threshold']))
+  collager.setNearSize(int(options['near_size']))
+  collager.setShowPartials(bool(options['show_previews']))
+  collager.setPreviewSize(int(options['preview_size']))
+  collager.setCheckpointInterval(int(options['checkpoint']))
+  collager.setResume(bool(options['resume']))
+
+def new(*args, **kwargs):
+  service = MosaicService(*args, **kwargs)
+  return service
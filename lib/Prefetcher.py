@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_DEPTH = 8 # Files read ahead
+DEFAULT_MAX_SIZE = 64 # MB of files read ahead
+DEFAULT_WORKERS = 4 # Reading threads
+
+class Prefetcher():
+  # Reads the next files on a pool of threads while the current one is decoded: at most depth
+  # files are read ahead, and no new read starts while the files waiting pass max_size (MB)
+
+  def __init__(self, depth=DEFAULT_DEPTH, max_size=DEFAULT_MAX_SIZE, workers=DEFAULT_WORKERS):
+    self.depth = max(depth, 1)
+    self.max_bytes = int(max_size * 2**20)
+    self.workers = max(workers, 1)
+
+  def setDepth(self, depth):
+    self.depth = max(depth, 1)
+
+  def setMaxSize(self, max_size):
+    self.max_bytes = int(max_size * 2**20)
+
+  def iterFiles(self, paths):
+    # Yield (path, content) in the order of paths, content is None if the file could not be read
+    paths = iter(paths)
+    pending = collections.deque()
+    finished = False
+    with ThreadPoolExecutor(max_workers=min(self.workers, self.depth)) as executor:
+      try:
+        while True:
+          while not finished and len(pending) < self.depth and (len(pending) == 0 or getWaitingBytes(pending) < self.max_bytes):
+            try:
+              path = next(paths)
+            except StopIteration:
+              finished = True
+              break
+            pending.append((path, executor.submit(readFile, path)))
+          if len(pending) == 0:
+            return
+          path, future = pending.popleft()
+          yield path, future.result()
+      finally:
+        # Stopped early: drop the reads not started
+        for _, future in pending:
+          future.cancel()
+
+def getWaitingBytes(pending):
+  # Bytes of the files already read and not used yet
+  total = 0
+  for _, future in pending:
+    if future.done():
+      content = future.result()
+      if content is not None:
+        total += len(content)
+  return total
+
+def readFile(path):
+  try:
+    with open(path, 'rb') as hand:
+      return hand.read()
+  except (OSError, IOError):
+    return None
+
+def iterFiles(paths, prefetcher=None):
+  # Files read ahead by prefetcher, or one after the other without it
+  if prefetcher is not None:
+    return prefetcher.iterFiles(paths)
+  return ((path, None) for path in paths)
+
+def new(*args, **kwargs):
+  prefetcher = Prefetcher(*args, **kwargs)
+  return prefetcher
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+from lib import CollageImage
+
+DEFAULT_MAX_SIZE = 1024 # Max width or height of the previews (0 for full size)
+
+class PreviewWriter():
+  # Paints and saves the previews on a background thread. Only the last snapshot waiting is kept,
+  # the older ones are dropped
+
+  def __init__(self, savepath, max_size=DEFAULT_MAX_SIZE):
+    self.savepath = savepath
+    self.max_size = max_size
+    self.pending = None
+    self.closed = False
+    self.condition = threading.Condition()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def submit(self, size, placements):
+    # Snapshot of a collage of size, placements as CollageImage.getPlacements (not changed after)
+    snapshot = (size, placements)
+    with self.condition:
+      if self.closed:
+        return
+      self.pending = snapshot
+      self.condition.notify()
+
+  def run(self):
+    while True:
+      with self.condition:
+        while self.pending is None and not self.closed:
+          self.condition.wait()
+        if self.pending is None:
+          return
+        snapshot = self.pending
+        self.pending = None
+      try:
+        self.write(snapshot)
+      except Exception as error:
+        print('\nError saving preview: ' + str(error))
+
+  def write(self, snapshot):
+    size, placements = snapshot
+    preview = CollageImage.paintPreview(size, placements, self.max_size)
+    # Write apart and rename, the saved file is always complete
+    name, ext = os.path.splitext(self.savepath)
+    tmp_path = name + '.preview' + ext
+    preview.save(tmp_path)
+    os.replace(tmp_path, self.savepath)
+
+  def close(self):
+    # Write the last preview and stop, nothing is written after
+    with self.condition:
+      self.closed = True
+      self.condition.notify()
+    self.thread.join()
+
+def new(*args, **kwargs):
+  writer = PreviewWriter(*args, **kwargs)
+  return writer
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import numpy
+from lib import ImageManager
+from lib import CollageImage
+from lib import BatchMatcher
+from lib import ResourceScanner
+from lib import AnnIndex
+from lib import FeatureStore
+from lib import Prefetcher
+
+VALID_FILETYPES = ResourceScanner.VALID_FILETYPES
+
+DEFAULT_COLLAGE_IMAGE_SIZE_PRECISION = 0.8
+
+HASH_BITS = 64
+PAIRS_BLOCK_SIZE = 1024 # Hashes compared at once with a bucket
+BITS_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+class ResourceLibrary():
+  # The images of a resources folder loaded for a given collage image size
+
+  def __init__(self, images_folder, collage_image_size, precision, duplicates_distance=None, manifest=None):
+    self.images_folder = images_folder
+    self.manifest = manifest # File with the images of the folder (saved if missing)
+    self.duplicates_distance = duplicates_distance # Max hash distance of near duplicates (None to keep all)
+    self.precision = precision
+    self.sector_size = max(int(1.0 * collage_image_size / precision), 1)
+    self.collage_image_size = self.sector_size * precision
+    self.collage_image_size_precision = DEFAULT_COLLAGE_IMAGE_SIZE_PRECISION
+    self.collage_image_size_min = None # Enforced limit
+    self.collage_image_size_avg_width = None
+    self.collage_image_size_avg_height = None
+    self.collage_image_size_max_width = None # Non-enforced limit
+    self.collage_image_size_max_height = None # Non-enforced limit
+    self.colours = []
+    self.duplicates = [] # Groups of near duplicates, the first image is kept
+    self.matchers = {}
+    self.stores = {}
+    self.ann_index = None
+    self.prefetcher = None # Reads the images ahead of the decoding
+    self.log = None
+
+  def setLogger(self, log):
+    self.log = log
+
+  def setPrefetcher(self, prefetcher):
+    self.prefetcher = prefetcher
+
+  def getKey(self):
+    return getKey(self.images_folder, self.collage_image_size, self.precision, self.duplicates_distance)
+
+  def load(self):
+    self.log.info('load == Loading colours')
+    self.log.debug('load == Collage image size: ' + str(self.collage_image_size))
+    self.log.debug('load == Collage image size precision: ' + str(self.collage_image_size_precision))
+    self.log.debug('load == Sector size: ' + str(self.sector_size))
+    # Set min size
+    self.collage_image_size_min = int(numpy.ceil(self.collage_image_size * self.collage_image_size_precision))
+    self.log.info('load == Min size: ' + str(self.collage_image_size_min))
+    # Sizes from the image headers, the pixels are not decoded yet
+    self.colours = []
+    print('Loading resources')
+    self.log.info('load == Loading from images')
+    loading_folder = self.images_folder
+    for path in ResourceScanner.iterImages(loading_folder, self.manifest):
+      try:
+        img = ImageManager.new(path)
+        size = img.getMaximalSize(self.collage_image_size)
+        name = ResourceScanner.getRelativeName(path, loading_folder)
+        self.colours.append(CollageImage.newColour(path, img.size, size, self.sector_size, name))
+      except Exception as error:
+        self.log.info('load == Error loading: ' + path)
+        print('\n*Error loading ' + path)
+        continue
+    self.computeSizes()
+    # Average colour and sectors of every image, then only the record is kept
+    levels = getPyramidLevels(self.sector_size, self.collage_image_size_min, self.collage_image_size_max_width, self.collage_image_size_max_height)
+    colours = []
+    files = Prefetcher.iterFiles([colour.getFilepath() for colour in self.colours], self.prefetcher)
+    for colour, (_, content) in zip(self.colours, files):
+      try:
+        colour.extractFeatures(levels, content, self.collage_image_size)
+        colours.append(colour)
+        # Show progress
+        sys.stdout.write('.')
+        sys.stdout.flush()
+      except Exception as error:
+        self.log.info('load == Error loading: ' + colour.getFilepath())
+        print('\n*Error loading ' + colour.getFilepath())
+        continue
+    self.colours = colours
+    if self.duplicates_distance is not None:
+      self.removeDuplicates()
+    self.computeSizes()
+    print('\nLoaded ' + str(len(self.colours)) + ' resources')
+
+  def removeDuplicates(self):
+    # Keep one image (the biggest original) of every group of near duplicates
+    hashes = [colour.getImageHash() for colour in self.colours]
+    groups = findDuplicateGroups(hashes, self.duplicates_distance)
+    self.duplicates = []
+    removed = set()
+    for group in groups:
+      group = sorted(group, key=lambda el : -self.colours[el].original_width * self.colours[el].original_height)
+      self.duplicates.append([self.colours[i] for i in group])
+      removed.update(group[1:])
+    self.colours = [colour for i, colour in enumerate(self.colours) if not i in removed]
+    self.log.info('removeDuplicates == Removed ' + str(len(removed)) + ' near duplicates in ' + str(len(groups)) + ' groups')
+    print('\nRemoved ' + str(len(removed)) + ' near duplicates')
+
+  def saveDuplicatesReport(self, savepath):
+    # A line per group: the kept image, then its duplicates (tab separated)
+    with open(savepath, 'w') as hand:
+      for group in self.duplicates:
+        hand.write('\t'.join([colour.getFilepath() for colour in group]) + '\n')
+
+  def computeSizes(self):
+    images_width = [colour.width for colour in self.colours]
+    images_height = [colour.height for colour in self.colours]
+    self.collage_image_size_avg_width = int(numpy.ceil(numpy.mean(images_width)))
+    self.collage_image_size_avg_height = int(numpy.ceil(numpy.mean(images_height)))
+    self.collage_image_size_max_width = int(numpy.max(images_width))
+    self.collage_image_size_max_height = int(numpy.max(images_height))
+    self.log.info('load == Collage image size avg width: ' + str(self.collage_image_size_avg_width))
+    self.log.info('load == Collage image size avg height: ' + str(self.collage_image_size_avg_height))
+    self.log.info('load == Collage image size max width: ' + str(self.collage_image_size_max_width))
+    self.log.info('load == Collage image size max height: ' + str(self.collage_image_size_max_height))
+
+  def getMatcher(self, levels, ladder=None):
+    # Batch matchers are kept for the next collages
+    key = (tuple(levels), None if ladder is None else tuple(ladder))
+    if not key in self.matchers:
+      self.log.info('getMatcher == Stack signatures for batch matching')
+      store = self.getStore(levels)
+      self.matchers[key] = BatchMatcher.new(self.colours, levels, self.sector_size, self.collage_image_size_min, ladder, store)
+    return self.matchers[key]
+
+  def getStore(self, levels):
+    # Features of the colours in shared memory, the forked workers read the same pages
+    key = tuple(levels)
+    if not key in self.stores:
+      self.log.info('getStore == Move features to shared memory')
+      self.stores[key] = FeatureStore.newFromColours(self.colours, levels)
+    return self.stores[key]
+
+  def getAnnIndex(self):
+    # Index of the tile sized square of the images, built once
+    if self.ann_index is None:
+      self.log.info('getAnnIndex == Build index')
+      self.ann_index = AnnIndex.new(self.colours, self.precision)
+    return self.ann_index
+
+def getPyramidLevels(sector_size, min_size, max_width, max_height):
+  # Sector aligned sizes between the min size and the max size of an image side
+  min_level = max(sector_size * (min_size // sector_size), sector_size)
+  max_level = max(max_width, max_height)
+  return list(range(min_level, max_level + sector_size, sector_size))
+
+def findDuplicateGroups(hashes, max_distance):
+  # Groups (with more than one element) of the indices of hashes within max_distance bits.
+  # Two such hashes are equal on at least one of max_distance + 1 chunks, so only the
+  # hashes sharing a chunk are compared
+  values = numpy.array(hashes, dtype=numpy.uint64)
+  chunks = min(max_distance + 1, HASH_BITS)
+  bounds = [HASH_BITS * k // chunks for k in range(chunks + 1)]
+  parents = list(range(len(hashes)))
+  def find(i):
+    while parents[i] != i:
+      parents[i] = parents[parents[i]]
+      i = parents[i]
+    return i
+  for k in range(chunks):
+    mask = numpy.uint64((1 << (bounds[k+1] - bounds[k])) - 1)
+    keys = (values >> numpy.uint64(bounds[k])) & mask
+    order = numpy.argsort(keys, kind='stable')
+    starts = numpy.nonzero(numpy.diff(keys[order]))[0] + 1
+    for bucket in numpy.split(order, starts):
+      if len(bucket) < 2:
+        continue
+      for a, b in findClosePairs(values, bucket, max_distance):
+        i, j = find(a), find(b)
+        if i != j:
+          parents[j] = i
+  groups = {}
+  for i in range(len(hashes)):
+    groups.setdefault(find(i), []).append(i)
+  return [group for group in groups.values() if len(group) > 1]
+
+def findClosePairs(values, bucket, max_distance):
+  # Pairs of the bucket indices whose hashes are within max_distance bits
+  pairs = []
+  bucket_values = values[bucket]
+  for start in range(0, len(bucket), PAIRS_BLOCK_SIZE):
+    block = bucket_values[start:start+PAIRS_BLOCK_SIZE]
+    distances = countBits(block[:, None] ^ bucket_values[None, :])
+    rows, columns = numpy.nonzero(distances <= max_distance)
+    rows = rows + start
+    keep = rows < columns
+    pairs.extend(zip(bucket[rows[keep]].tolist(), bucket[columns[keep]].tolist()))
+  return pairs
+
+def countBits(values):
+  # Number of bits set in every uint64
+  if hasattr(numpy, 'bitwise_count'): # numpy >= 2.0
+    return numpy.bitwise_count(values)
+  return BITS_TABLE[values[..., None].view(numpy.uint8)].sum(axis=-1)
+
+def getKey(images_folder, collage_image_size, precision, duplicates_distance=None):
+  # Libraries with the same key have the same content
+  sector_size = max(int(1.0 * collage_image_size / precision), 1)
+  return (os.path.abspath(images_folder), sector_size, precision, duplicates_distance)
+
+def new(*args, **kwargs):
+  library = ResourceLibrary(*args, **kwargs)
+  return library
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import os
+
+VALID_FILETYPES = ['.png', '.jpg', '.jpeg']
+
+def hasValidExtension(name):
+  _, ext = os.path.splitext(name)
+  return ext.lower() in VALID_FILETYPES
+
+def scanImages(folder):
+  # Yield the paths of the images in folder and its subfolders, while walking the tree.
+  # The entry types come from the directory listing, files are not stat'ed
+  folders = [folder]
+  while len(folders) > 0:
+    current = folders.pop()
+    try:
+      entries = sorted(os.scandir(current), key=lambda el : el.name)
+    except OSError:
+      continue
+    subfolders = []
+    for entry in entries:
+      if entry.is_dir():
+        subfolders.append(entry.path)
+      elif hasValidExtension(entry.name) and entry.is_file():
+        yield entry.path
+    # Visit the subfolders in name order
+    folders.extend(reversed(subfolders))
+
+def readManifest(manifest_path, folder):
+  # Yield the image paths of a manifest (a path relative to folder per line)
+  with open(manifest_path, 'r') as hand:
+    for line in hand:
+      name = line.rstrip('\n')
+      if name != '' and hasValidExtension(name):
+        yield os.path.join(folder, name)
+
+def saveManifest(manifest_path, folder):
+  # Scan folder and save the image paths relative to it, returns the number of images
+  images_number = 0
+  tmp_path = manifest_path + '.tmp'
+  with open(tmp_path, 'w') as hand:
+    for path in scanImages(folder):
+      hand.write(getRelativeName(path, folder) + '\n')
+      images_number += 1
+  os.replace(tmp_path, manifest_path)
+  return images_number
+
+def getRelativeName(path, folder):
+  # Name of an image in schemas and manifests: its path from folder with / separators
+  return os.path.relpath(path, folder).replace(os.sep, '/')
+
+def iterImages(folder, manifest_path=None):
+  # Images of folder: from the manifest if given (saved first if missing), else scanning the folder
+  if manifest_path is None:
+    return scanImages(folder)
+  if not os.path.exists(manifest_path):
+    saveManifest(manifest_path, folder)
+  return readManifest(manifest_path, folder)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+from PIL import Image
+from lib import ImageManager
+
+DEFAULT_MAX_SIZE = 1024 # MB
+THUMBNAIL_EXTENSION = '.png'
+THUMBNAIL_KIND = 'fit' # Centre cropped to the size (the older thumbnails without it are stretched)
+PNG_MODES = ['1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16']
+HASH_BLOCK_SIZE = 2**20
+
+class ThumbnailCache():
+  # Resized images saved on disk, keyed by the content of the original and the size.
+  # The least recently used thumbnails are removed when the cache is bigger than max_size (MB)
+
+  def __init__(self, folder, max_size=DEFAULT_MAX_SIZE):
+    self.folder = folder
+    self.max_bytes = int(max_size * 2**20)
+    self.hashes = {} # (path, mtime, size) -> content hash
+    self.entries = {} # name -> (last use, bytes)
+    self.total_bytes = 0
+    self.deferred_eviction = False
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(folder, exist_ok=True)
+    self.loadEntries()
+
+  def setMaxSize(self, max_size):
+    self.max_bytes = int(max_size * 2**20)
+    self.evict()
+
+  def setDeferredEviction(self, value=True):
+    # Forked workers only add thumbnails, the parent calls refresh() when they are done
+    self.deferred_eviction = value
+
+  def loadEntries(self):
+    self.entries = {}
+    self.total_bytes = 0
+    for entry in os.scandir(self.folder):
+      if entry.is_file() and entry.name.endswith(THUMBNAIL_EXTENSION):
+        stat = entry.stat()
+        self.entries[entry.name] = (stat.st_mtime, stat.st_size)
+        self.total_bytes += stat.st_size
+
+  def getContentHash(self, imgpath, content=None):
+    # The hash is computed once per run for every file (from its content if already read)
+    stat = os.stat(imgpath)
+    key = (os.path.abspath(imgpath), stat.st_mtime_ns, stat.st_size)
+    if not key in self.hashes and content is not None:
+      self.hashes[key] = hashlib.sha1(content).hexdigest()
+    if not key in self.hashes:
+      content_hash = hashlib.sha1()
+      with open(imgpath, 'rb') as hand:
+        block = hand.read(HASH_BLOCK_SIZE)
+        while len(block) > 0:
+          content_hash.update(block)
+          block = hand.read(HASH_BLOCK_SIZE)
+      self.hashes[key] = content_hash.hexdigest()
+    return self.hashes[key]
+
+  def getName(self, imgpath, size):
+    width, height = size
+    return self.getContentHash(imgpath) + '_' + str(width) + 'x' + str(height) + '_' + THUMBNAIL_KIND + THUMBNAIL_EXTENSION
+
+  def get(self, imgpath, size):
+    # Cached thumbnail or None
+    name = self.getName(imgpath, size)
+    path = os.path.join(self.folder, name)
+    try:
+      img = Image.open(path)
+      img.load()
+      os.utime(path) # Mark as recently used
+      stat = os.stat(path)
+    except (OSError, IOError):
+      # Missing, or removed by another process
+      return None
+    if not name in self.entries:
+      self.total_bytes += stat.st_size # Saved by another process
+    self.entries[name] = (stat.st_mtime, stat.st_size)
+    return img
+
+  def put(self, imgpath, size, img):
+    name = self.getName(imgpath, size)
+    path = os.path.join(self.folder, name)
+    if not img.mode in PNG_MODES:
+      img = img.convert('RGB')
+    # Write apart and rename, other processes may read the same thumbnail
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    img.save(tmp_path, 'PNG', compress_level=1) # Fast to write, decoding is fast anyway
+    os.replace(tmp_path, path)
+    stat = os.stat(path)
+    if name in self.entries:
+      self.total_bytes -= self.entries[name][1]
+    self.entries[name] = (stat.st_mtime, stat.st_size)
+    self.total_bytes += stat.st_size
+    if not self.deferred_eviction:
+      self.evict()
+
+  def getResized(self, imgpath, size, content=None):
+    # Thumbnail of the image at imgpath, decoded and resized only if not cached
+    self.getContentHash(imgpath, content)
+    img = self.get(imgpath, size)
+    if img is not None:
+      self.hits += 1
+      return img
+    self.misses += 1
+    if content is not None:
+      original = ImageManager.newFromContent(content, imgpath)
+    else:
+      original = ImageManager.newFromPath(imgpath)
+    img = original.getResizedCopy(size, antialias=True)
+    self.put(imgpath, size, img)
+    return img
+
+  def refresh(self):
+    # Take the thumbnails saved by other processes into account and evict
+    self.loadEntries()
+    self.evict()
+
+  def evict(self):
+    # Remove the least recently used thumbnails
+    if self.total_bytes <= self.max_bytes:
+      return
+    for name in sorted(self.entries, key=lambda el : self.entries[el][0]):
+      if self.total_bytes <= self.max_bytes:
+        break
+      try:
+        os.remove(os.path.join(self.folder, name))
+      except OSError:
+        pass
+      self.total_bytes -= self.entries[name][1]
+      del self.entries[name]
+
+def new(*args, **kwargs):
+  cache = ThumbnailCache(*args, **kwargs)
+  return cache
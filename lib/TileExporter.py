@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import shutil
+import tempfile
+import collections
+import numpy
+import multiprocessing
+from PIL import Image
+from lib import ImageManager
+
+DEFAULT_TILE_SIZE = 256
+DEFAULT_TILE_FORMAT = 'jpg'
+BACKGROUND_COLOUR = (255, 255, 255)
+LOSSLESS_FORMATS = ['png'] # Tile formats the lower levels can be rebuilt from without losses
+MAX_ORIGINALS_BYTES = 128 * 2**20 # Decoded images kept for the next tiles (every worker)
+
+DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="0" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+'''
+
+class TileExporter():
+  # Render a collage as a DeepZoom tile pyramid: the top level from the original images,
+  # the lower levels downsampling the tiles of the level above
+
+  def __init__(self, collage_image, scale=1, tile_size=DEFAULT_TILE_SIZE, tile_format=DEFAULT_TILE_FORMAT):
+    self.collage_image = collage_image
+    self.scale = scale
+    self.tile_size = tile_size
+    self.tile_format = tile_format
+    width, height = collage_image.size
+    self.width = width * scale
+    self.height = height * scale
+    self.max_level = int(numpy.ceil(numpy.log2(max(self.width, self.height, 1))))
+    self.tiles_folder = None
+    self.tiles_colours = None
+    self.intermediates_folder = None # Lossless copies of the tiles of a lossy format
+    self.thumbnail_cache = None
+    self.originals = collections.OrderedDict() # (path, size) -> decoded image, least recently used first
+    self.originals_bytes = 0
+
+  def setThumbnailCache(self, cache):
+    # With a cache the images are resized whole and cropped
+    self.thumbnail_cache = cache
+
+  def getLevelSize(self, level):
+    factor = 2 ** (self.max_level - level)
+    return int(numpy.ceil(1.0 * self.width / factor)), int(numpy.ceil(1.0 * self.height / factor))
+
+  def getLevelTiles(self, level):
+    width, height = self.getLevelSize(level)
+    columns = int(numpy.ceil(1.0 * width / self.tile_size))
+    rows = int(numpy.ceil(1.0 * height / self.tile_size))
+    return [(level, column, row) for row in range(rows) for column in range(columns)]
+
+  def getTileBox(self, level, column, row):
+    width, height = self.getLevelSize(level)
+    x0 = column * self.tile_size
+    y0 = row * self.tile_size
+    return x0, y0, min(x0 + self.tile_size, width), min(y0 + self.tile_size, height)
+
+  def getTilePath(self, level, column, row):
+    return os.path.join(self.tiles_folder, str(level), str(column) + '_' + str(row) + '.' + self.tile_format)
+
+  def getSourcePath(self, level, column, row):
+    # Tile the lower level is rebuilt from
+    if self.intermediates_folder is None:
+      return self.getTilePath(level, column, row)
+    return os.path.join(self.intermediates_folder, str(level), str(column) + '_' + str(row) + '.png')
+
+  def getOriginal(self, filepath, size=None):
+    # Decoded image (resized with the thumbnail cache), kept while it may span the next tiles
+    key = (filepath, size)
+    if key in self.originals:
+      self.originals.move_to_end(key)
+      return self.originals[key]
+    if size is not None:
+      img = self.thumbnail_cache.getResized(filepath, size)
+    else:
+      original = ImageManager.newFromPath(filepath)
+      original.load()
+      img = original.getImage()
+    self.originals[key] = img
+    self.originals_bytes += img.width * img.height * len(img.getbands())
+    while self.originals_bytes > MAX_ORIGINALS_BYTES and len(self.originals) > 1:
+      _, old = self.originals.popitem(last=False)
+      self.originals_bytes -= old.width * old.height * len(old.getbands())
+    return img
+
+  def indexColours(self):
+    # Positions of the images intersecting each tile of the top level
+    self.tiles_colours = {}
+    for position in self.collage_image.colours:
+      x, y = position
+      width, height = self.collage_image.colours_size[position]
+      first_column = (x * self.scale) // self.tile_size
+      last_column = ((x + width) * self.scale - 1) // self.tile_size
+      first_row = (y * self.scale) // self.tile_size
+      last_row = ((y + height) * self.scale - 1) // self.tile_size
+      for column in range(first_column, last_column + 1):
+        for row in range(first_row, last_row + 1):
+          self.tiles_colours.setdefault((column, row), []).append(position)
+
+  def renderTopTile(self, column, row):
+    # Only the part of each image inside the tile is resized
+    x0, y0, x1, y1 = self.getTileBox(self.max_level, column, row)
+    tile = Image.new('RGB', (x1 - x0, y1 - y0), color=BACKGROUND_COLOUR)
+    for position in self.tiles_colours.get((column, row), []):
+      x, y = position
+      width, height = self.collage_image.colours_size[position]
+      img_x0, img_y0 = x * self.scale, y * self.scale
+      img_x1, img_y1 = img_x0 + width * self.scale, img_y0 + height * self.scale
+      # Intersection in output coordinates
+      cx0, cy0 = max(img_x0, x0), max(img_y0, y0)
+      cx1, cy1 = min(img_x1, x1), min(img_y1, y1)
+      if cx0 >= cx1 or cy0 >= cy1:
+        continue
+      colour = self.collage_image.colours[position]
+      if self.thumbnail_cache is not None:
+        image = self.getOriginal(colour.getFilepath(), (img_x1 - img_x0, img_y1 - img_y0))
+        part = image.crop((cx0 - img_x0, cy0 - img_y0, cx1 - img_x0, cy1 - img_y0))
+        tile.paste(part, (cx0 - x0, cy0 - y0))
+        continue
+      original = self.getOriginal(colour.getFilepath())
+      # Same centre crop as ImageManager.getResizedCopy
+      crop_x0, crop_y0, crop_x1, crop_y1 = ImageManager.getCropBox(original.size, (img_x1 - img_x0, img_y1 - img_y0))
+      factor_x = (crop_x1 - crop_x0) / (img_x1 - img_x0)
+      factor_y = (crop_y1 - crop_y0) / (img_y1 - img_y0)
+      box = (crop_x0 + (cx0 - img_x0) * factor_x, crop_y0 + (cy0 - img_y0) * factor_y, crop_x0 + (cx1 - img_x0) * factor_x, crop_y0 + (cy1 - img_y0) * factor_y)
+      part = original.resize((cx1 - cx0, cy1 - cy0), Image.ANTIALIAS, box=box)
+      tile.paste(part, (cx0 - x0, cy0 - y0))
+    return tile
+
+  def renderLowerTile(self, level, column, row):
+    # Downsample the four tiles of the level above
+    x0, y0, x1, y1 = self.getTileBox(level, column, row)
+    upper_width, upper_height = self.getLevelSize(level + 1)
+    width = min(2 * x1, upper_width) - 2 * x0
+    height = min(2 * y1, upper_height) - 2 * y0
+    upper = Image.new('RGB', (width, height), color=BACKGROUND_COLOUR)
+    for i in range(2):
+      for j in range(2):
+        path = self.getSourcePath(level + 1, 2 * column + i, 2 * row + j)
+        if os.path.exists(path):
+          with Image.open(path) as part:
+            upper.paste(part, (i * self.tile_size, j * self.tile_size))
+    return upper.resize((x1 - x0, y1 - y0), Image.ANTIALIAS)
+
+  def renderTile(self, tile):
+    level, column, row = tile
+    if level == self.max_level:
+      img = self.renderTopTile(column, row)
+    else:
+      img = self.renderLowerTile(level, column, row)
+    img.save(self.getTilePath(level, column, row))
+    if self.intermediates_folder is not None and level > 0:
+      img.save(self.getSourcePath(level, column, row), 'PNG', compress_level=1)
+
+  def export(self, savepath, workers=1):
+    # savepath is the .dzi file, the tiles are saved in the <name>_files folder
+    name, _ = os.path.splitext(savepath)
+    self.tiles_folder = name + '_files'
+    self.indexColours()
+    if not self.tile_format in LOSSLESS_FORMATS:
+      # The lower levels are rebuilt from lossless copies, the losses do not add up
+      self.intermediates_folder = tempfile.mkdtemp(prefix='tiles_', dir=os.path.dirname(os.path.abspath(savepath)))
+    with open(savepath, 'w') as hand:
+      hand.write(DZI_TEMPLATE.format(format=self.tile_format, tile_size=self.tile_size, width=self.width, height=self.height))
+    global _exporter
+    _exporter = self
+    context = multiprocessing.get_context('fork')
+    pool = None
+    if workers > 1:
+      if self.thumbnail_cache is not None:
+        # The workers would evict each other's thumbnails: only this process evicts
+        self.thumbnail_cache.setDeferredEviction(True)
+      pool = context.Pool(workers)
+    try:
+      for level in range(self.max_level, -1, -1):
+        sys.stdout.write('\r Level: ' + str(self.max_level - level + 1) + '/' + str(self.max_level + 1) + '   ')
+        sys.stdout.flush()
+        os.makedirs(os.path.join(self.tiles_folder, str(level)), exist_ok=True)
+        if self.intermediates_folder is not None:
+          os.makedirs(os.path.join(self.intermediates_folder, str(level)), exist_ok=True)
+        tiles = self.getLevelTiles(level)
+        if pool is None:
+          for tile in tiles:
+            self.renderTile(tile)
+        else:
+          pool.map(renderTileWorker, tiles)
+          if self.thumbnail_cache is not None:
+            self.thumbnail_cache.refresh()
+        if self.intermediates_folder is not None and level < self.max_level:
+          # The level above is not needed anymore
+          shutil.rmtree(os.path.join(self.intermediates_folder, str(level + 1)), ignore_errors=True)
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+        if self.thumbnail_cache is not None:
+          self.thumbnail_cache.setDeferredEviction(False)
+      _exporter = None
+      if self.intermediates_folder is not None:
+        shutil.rmtree(self.intermediates_folder, ignore_errors=True)
+        self.intermediates_folder = None
+      self.originals.clear()
+      self.originals_bytes = 0
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+_exporter = None # Exporter shared with the workers (fork)
+
+def renderTileWorker(tile):
+  _exporter.renderTile(tile)
+
+def new(*args, **kwargs):
+  exporter = TileExporter(*args, **kwargs)
+  return exporter
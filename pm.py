@@ -2,10 +2,22 @@
 
 import os
 import sys
+import glob
 import argparse
+import numpy
 from lib import PyLog
 from lib import Collager
 from lib import CollageImage
+from lib import ImageManager
+from lib import MosaicService
+from lib import TileExporter
+from lib import ThumbnailCache
+from lib import PreviewWriter
+from lib import AnnIndex
+from lib import AdaptiveLayout
+from lib import Prefetcher
+from lib import ResourceScanner
+from lib import ImageWriter
 
 path = os.path.abspath(__file__)
 MAIN_FOLDER = os.path.dirname(path)
@@ -17,9 +29,11 @@ if not os.path.exists(LOG_FOLDER):
 logger = PyLog.new(LOG_FOLDER)
 
 parser = argparse.ArgumentParser(description="Photo Mosaic")
-parser.add_argument('--input', help='Base image')
-parser.add_argument('--output', help='Result image')
+parser.add_argument('--input', nargs='+', default=[], help='Base image (many images, directories or glob patterns make one collage each)')
+parser.add_argument('--input-manifest', dest='input_manifest', default=None, help='File with a base image path per line')
+parser.add_argument('--output', help='Result image (directory with many base images)')
 parser.add_argument('--resources', help='Directory with the images to use')
+parser.add_argument('--resources-manifest', dest='resources_manifest', default=None, help='File with the resources paths (relative to the resources folder), created scanning the folder if missing')
 parser.add_argument('--scale', default=1, help='Output scaling, default:1')
 parser.add_argument('--images-on-width', dest='images_width', default=8, help='Images along width (approximate), default:8')
 parser.add_argument('--images-on-height', dest='images_height', help='Images along height (approximate)')
@@ -29,16 +43,60 @@ parser.add_argument('--near-size', dest='near_size', default=3, help='Min distan
 parser.add_argument('--shuffle', default=False, action='store_true', help='Use all the images in a uniformely but lose a bit in colour approximation, default:false')
 parser.add_argument('--shuffle-distance', dest='shuffle_distance', default=20, help='Distance under which colors are considered similar, default:20')
 parser.add_argument('--shuffle-geometry', dest='shuffle_geometry', default=0, help='Makes the images geometry more diverse (uses values between 0 and 1), default:0')
+parser.add_argument('--dedup', default=None, help='Use only one of the resources whose perceptual hashes differ by at most this number of bits (0 for identical images), default:keep all')
+parser.add_argument('--dedup-report', dest='dedup_report', default=None, help='Save the groups of near duplicate resources in this file (with --dedup)')
+parser.add_argument('--size-ladder', dest='size_ladder', default=0, help='Snap images sizes to multiples of this number of sectors, makes resizes reusable (0 to disable), default:0')
+parser.add_argument('--batch-matching', dest='batch_matching', default=False, action='store_true', help='Evaluate all the images at once for each placement (faster with many images), default:false')
+parser.add_argument('--ann-candidates', dest='ann_candidates', default=0, help='Evaluate only this number of images with the closest sectors for each placement, found with an approximate index (0 to evaluate all the images), default:0')
+parser.add_argument('--ann-probes', dest='ann_probes', default=AnnIndex.DEFAULT_PROBES, help='Index lists visited for each placement with --ann-candidates (higher is more accurate and slower), default:' + str(AnnIndex.DEFAULT_PROBES))
+parser.add_argument('--layout', default=Collager.LAYOUT_SCAN, choices=Collager.LAYOUTS, help='Images layout: scan (images of different sizes), grid (square images on a fixed grid, faster), bands (scan in parallel horizontal bands) or adaptive (square images, bigger in uniform areas), default:scan')
+parser.add_argument('--adaptive-levels', dest='adaptive_levels', default=AdaptiveLayout.DEFAULT_LEVELS, help='Adaptive layout images are up to 2^levels times bigger, default:' + str(AdaptiveLayout.DEFAULT_LEVELS))
+parser.add_argument('--adaptive-threshold', dest='adaptive_threshold', default=AdaptiveLayout.DEFAULT_THRESHOLD, help='Adaptive layout splits the areas with a colour deviation above this value, default:' + str(AdaptiveLayout.DEFAULT_THRESHOLD))
+parser.add_argument('--workers', default=None, help='Number of processes for the bands layout, default:number of CPUs')
+parser.add_argument('--assignment', default=Collager.ASSIGNMENT_GREEDY, choices=Collager.ASSIGNMENTS, help='Images assignment in grid layout: greedy or global (best overall match with limited repetitions), default:greedy')
+parser.add_argument('--max-usage', dest='max_usage', default=0, help='Max number of times an image can be used with global assignment (0 for automatic), default:0')
 parser.add_argument('--show-previews', dest='show_previews', action='store_true', default=False, help='Save previews during collage, default:false')
+parser.add_argument('--preview-size', dest='preview_size', default=PreviewWriter.DEFAULT_MAX_SIZE, help='Max width or height of the previews (0 for full size), default:' + str(PreviewWriter.DEFAULT_MAX_SIZE))
+parser.add_argument('--checkpoint', default=0, help='Save a checkpoint every given number of placed images (0 to disable), default:0')
+parser.add_argument('--resume', default=False, action='store_true', help='Continue the collage from the last checkpoint of the output, default:false')
+parser.add_argument('--sequence', default=False, action='store_true', help='The base images are the frames of a video: every frame reuses the previous collage and replaces only the images where the frame changed, default:false')
+parser.add_argument('--sequence-threshold', dest='sequence_threshold', default=Collager.DEFAULT_SEQUENCE_THRESHOLD, help='Sector colour change between frames that replaces the images over it, default:' + str(Collager.DEFAULT_SEQUENCE_THRESHOLD))
+parser.add_argument('--jobs', default=1, help='Number of base images processed in parallel, default:1')
+parser.add_argument('--tile-size', dest='tile_size', default=None, help='Size of the images with many base images, default:computed from the first base image')
 parser.add_argument('--load-schema', dest='load_schema', default=None, help='Load collage from schema')
+parser.add_argument('--export-tiles', dest='export_tiles', default=None, help='Export the schema as a DeepZoom tile pyramid to this .dzi file (only in conjunction with --load-schema)')
+parser.add_argument('--thumbnail-cache', dest='thumbnail_cache', default=None, help='Directory where the resized images are kept for the next renders')
+parser.add_argument('--thumbnail-cache-size', dest='thumbnail_cache_size', default=ThumbnailCache.DEFAULT_MAX_SIZE, help='Max size of the thumbnail cache in MB, default:' + str(ThumbnailCache.DEFAULT_MAX_SIZE))
+parser.add_argument('--prefetch-depth', dest='prefetch_depth', default=Prefetcher.DEFAULT_DEPTH, help='Number of images read ahead of the decoding (0 to disable), default:' + str(Prefetcher.DEFAULT_DEPTH))
+parser.add_argument('--prefetch-size', dest='prefetch_size', default=Prefetcher.DEFAULT_MAX_SIZE, help='Max size in MB of the images read ahead, default:' + str(Prefetcher.DEFAULT_MAX_SIZE))
+parser.add_argument('--output-quality', dest='output_quality', default=ImageWriter.DEFAULT_QUALITY, help='Quality of JPEG and WebP outputs (0-100), default:' + str(ImageWriter.DEFAULT_QUALITY))
+parser.add_argument('--output-compression', dest='output_compression', default=ImageWriter.DEFAULT_COMPRESSION, help='Compression level of PNG outputs (0-9), default:' + str(ImageWriter.DEFAULT_COMPRESSION))
+parser.add_argument('--output-format', dest='output_format', default=None, choices=ImageWriter.FORMATS, help='Format of the outputs with many base images, default:png')
+parser.add_argument('--output-lossless', dest='output_lossless', default=False, action='store_true', help='Lossless WebP output, default:false')
+parser.add_argument('--recollage-box', dest='recollage_box', default=None, help='Replace the images of the schema in the area x0,y0,x1,y1 and update the output (with --load-schema and --input)')
+parser.add_argument('--recollage-mask', dest='recollage_mask', default=None, help='Replace the images of the schema under the non transparent pixels of the mask and update the output (with --load-schema and --input)')
 parser.add_argument('--apply-mask', dest='apply_mask', default=None, help='Apply mask to schema (only in conjunction with --load-schema)')
 parser.add_argument('--debug', default=False, action='store_true', help='Debug')
 
 args = parser.parse_args()
 
-base_image = args.input
+base_images = []
+for pattern in args.input:
+  if glob.has_magic(pattern):
+    base_images.extend(sorted(glob.glob(pattern)))
+  elif os.path.isdir(pattern):
+    base_images.extend(sorted([os.path.join(pattern, name) for name in os.listdir(pattern) if ResourceScanner.hasValidExtension(name)]))
+  else:
+    base_images.append(pattern)
+if args.input_manifest is not None:
+  with open(args.input_manifest, 'r') as hand:
+    for line in hand:
+      if line.strip() != '':
+        base_images.append(line.strip())
+base_image = base_images[0] if len(base_images) > 0 else None
 output_image = args.output
 images_folder = args.resources
+resources_manifest = args.resources_manifest
 scale_factor = int(args.scale)
 images_width = int(args.images_width)
 images_height = int(args.images_height) if args.images_height is not None else None
@@ -48,48 +106,230 @@ near_size = int(args.near_size)
 shuffle = args.shuffle
 shuffle_distance = int(args.shuffle_distance)
 shuffle_geometry = float(args.shuffle_geometry)
+duplicates_distance = int(args.dedup) if args.dedup is not None else None
+dedup_report = args.dedup_report
+size_ladder = int(args.size_ladder)
+batch_matching = args.batch_matching
+ann_candidates = int(args.ann_candidates)
+ann_probes = int(args.ann_probes)
+layout = args.layout
+adaptive_levels = int(args.adaptive_levels)
+adaptive_threshold = float(args.adaptive_threshold)
+workers = int(args.workers) if args.workers is not None else None
+assignment = args.assignment
+max_usage = int(args.max_usage)
 show_partials = int(args.show_previews)
+preview_size = int(args.preview_size)
+checkpoint_interval = int(args.checkpoint)
+jobs = int(args.jobs)
+sequence = args.sequence
+sequence_threshold = float(args.sequence_threshold)
+tile_size = int(args.tile_size) if args.tile_size is not None else None
+resume = args.resume
 schema_filepath = args.load_schema
 apply_mask = args.apply_mask
+export_tiles = args.export_tiles
+recollage_box = None
+if args.recollage_box is not None:
+  recollage_box = tuple([int(el) for el in args.recollage_box.split(',')])
+recollage_mask = args.recollage_mask
+recollage = recollage_box is not None or recollage_mask is not None
+thumbnail_cache = None
+if args.thumbnail_cache is not None:
+  thumbnail_cache = ThumbnailCache.new(args.thumbnail_cache, float(args.thumbnail_cache_size))
+prefetcher = None
+if int(args.prefetch_depth) > 0:
+  prefetcher = Prefetcher.new(int(args.prefetch_depth), float(args.prefetch_size))
+image_writer = ImageWriter.new(compression=int(args.output_compression), quality=int(args.output_quality))
+image_writer.setLossless(args.output_lossless)
+output_format = args.output_format
 debug = args.debug
 
 # Check input - Critical
-if base_image is not None and not os.path.exists(base_image):
-  print("Base image not found")
-  sys.exit(1)
+for path in base_images:
+  if not os.path.exists(path):
+    print("Base image not found: " + path)
+    sys.exit(1)
 if images_folder is None or not os.path.isdir(images_folder):
   print("Missing resources folder")
   sys.exit(1)
 if schema_filepath is not None and not os.path.exists(schema_filepath):
   print("Image schema not found")
   sys.exit(1)
+if recollage and (schema_filepath is None or base_image is None or output_image is None or not os.path.isfile(output_image)):
+  print("Replacing images requires --load-schema, --input and the --output image of the schema")
+  sys.exit(1)
+if duplicates_distance is not None and (duplicates_distance < 0 or duplicates_distance >= 64):
+  print("The dedup distance must be between 0 and 63")
+  sys.exit(1)
+if recollage_box is not None and len(recollage_box) != 4:
+  print("The area must be x0,y0,x1,y1")
+  sys.exit(1)
 # Check input - Warning
 if schema_filepath is None and apply_mask is not None:
   print("Warning: you can apply a mask only when loading a schema.")
   print("The mask will be ignored")
   apply_mask = None
+if schema_filepath is None and export_tiles is not None:
+  print("Warning: you can export tiles only when loading a schema.")
+  print("The tiles will not be exported")
+  export_tiles = None
 
+if output_image is None and export_tiles is None:
+  print("Missing output")
+  sys.exit(1)
+if schema_filepath is None and (len(base_images) > 1 or sequence) and os.path.isfile(output_image):
+  print("With many base images the output must be a directory")
+  sys.exit(1)
 
-if schema_filepath is None:
+
+if schema_filepath is None and (len(base_images) > 1 or sequence):
+  # Load the resources once for all the base images
+  if tile_size is None:
+    first_image = ImageManager.newFromPath(base_image)
+    if images_height is not None:
+      tile_size = int(numpy.ceil(1.0 * first_image.height / images_height))
+    else:
+      tile_size = int(numpy.ceil(1.0 * first_image.width / images_width))
+  if not os.path.exists(output_image):
+    os.makedirs(output_image)
+  service = MosaicService.new(logger, debug)
+  service.setTileSize(tile_size)
+  service.setDuplicatesDistance(duplicates_distance)
+  if resources_manifest is not None:
+    service.setManifest(images_folder, resources_manifest)
+  service.setPrefetcher(prefetcher)
+  service.setImageWriter(image_writer)
+  if thumbnail_cache is not None:
+    service.setThumbnailCache(thumbnail_cache)
+  extension = ImageWriter.getExtension(output_format if output_format is not None else ImageWriter.FORMAT_PNG)
+  # Outputs named after the path of the base images under their common folder
+  root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in base_images])
+  names = set()
+  requests = []
+  for path in base_images:
+    name, _ = os.path.splitext(os.path.relpath(os.path.abspath(path), root))
+    if name in names:
+      # Same name with another extension or listed twice
+      i = 2
+      while name + '-' + str(i) in names:
+        i += 1
+      name = name + '-' + str(i)
+    names.add(name)
+    savepath = os.path.join(output_image, name + extension)
+    if not os.path.isdir(os.path.dirname(savepath)):
+      os.makedirs(os.path.dirname(savepath))
+    request = {'input': path, 'output': savepath, 'resources': images_folder}
+    request['scale'] = scale_factor
+    request['images_width'] = images_width
+    request['images_height'] = images_height
+    request['threshold'] = threshold
+    request['precision'] = precision
+    request['near_size'] = near_size
+    request['shuffle'] = shuffle
+    request['shuffle_distance'] = shuffle_distance
+    request['shuffle_geometry'] = shuffle_geometry
+    request['size_ladder'] = size_ladder
+    request['batch_matching'] = batch_matching
+    request['ann_candidates'] = ann_candidates
+    request['ann_probes'] = ann_probes
+    request['layout'] = layout
+    request['adaptive_levels'] = adaptive_levels
+    request['adaptive_threshold'] = adaptive_threshold
+    request['workers'] = workers
+    request['assignment'] = assignment
+    request['max_usage'] = max_usage
+    request['show_previews'] = show_partials
+    request['preview_size'] = preview_size
+    request['checkpoint'] = checkpoint_interval
+    request['resume'] = resume
+    requests.append(request)
+  if sequence:
+    results = service.collageSequence(requests, sequence_threshold)
+  else:
+    results = service.collageBatch(requests, jobs)
+  if dedup_report is not None:
+    # One report for every library
+    libraries = list(service.libraries.values())
+    report_name, report_ext = os.path.splitext(dedup_report)
+    for i, library in enumerate(libraries):
+      if len(libraries) == 1:
+        library.saveDuplicatesReport(dedup_report)
+      else:
+        library.saveDuplicatesReport(report_name + '.' + str(i+1) + report_ext)
+  failed = False
+  for result in results:
+    if 'error' in result:
+      print('Error with ' + result['input'] + ': ' + result['error'])
+      failed = True
+    else:
+      print('Saved ' + result['output'])
+  if failed:
+    sys.exit(2)
+elif schema_filepath is None:
   # Create collage with image properties
-  collager = Collager.new(base_image, images_folder, images_width, images_height, precision, logger, debug)
+  collager = Collager.new(base_image, images_folder, images_width, images_height, precision, logger, debug, duplicates_distance, resources_manifest, prefetcher)
+  if dedup_report is not None:
+    collager.library.saveDuplicatesReport(dedup_report)
   # Set collage properties
   collager.setOutputImage(output_image)
   collager.setScaleFactor(scale_factor)
   collager.setShuffleColours(shuffle)
   collager.setShuffleColoursDistance(shuffle_distance)
   collager.setShuffleGeometry(shuffle_geometry)
+  collager.setSizeLadder(size_ladder)
+  collager.setBatchMatching(batch_matching)
+  collager.setAnnSearch(ann_candidates, ann_probes)
+  collager.setLayout(layout)
+  collager.setAdaptiveLayout(adaptive_levels, adaptive_threshold)
+  if workers is not None:
+    collager.setWorkers(workers)
+  collager.setAssignment(assignment)
+  collager.setMaxUsage(max_usage)
   collager.setThreshold(threshold)
   collager.setNearSize(near_size)
   collager.setShowPartials(show_partials)
+  collager.setPreviewSize(preview_size)
+  collager.setCheckpointInterval(checkpoint_interval)
+  collager.setResume(resume)
+  if thumbnail_cache is not None:
+    collager.setThumbnailCache(thumbnail_cache)
+  collager.setImageWriter(image_writer)
   try:
     collager.collage()
     print('Resizing and saving (it may require some time)')
   except Exception as error:
     print(str(error))
+    if checkpoint_interval > 0:
+      collager.saveCheckpoint()
     collager.save()
     sys.exit(2)
   collager.save()
+elif recollage:
+  # Replace the images of an area and update the output
+  collager = Collager.new(base_image, images_folder, images_width, images_height, precision, logger, debug, manifest=resources_manifest, prefetcher=prefetcher)
+  collager.setOutputImage(output_image)
+  collager.setScaleFactor(scale_factor)
+  collager.setShuffleColours(shuffle)
+  collager.setShuffleColoursDistance(shuffle_distance)
+  collager.setShuffleGeometry(shuffle_geometry)
+  collager.setSizeLadder(size_ladder)
+  collager.setBatchMatching(batch_matching)
+  # Same layout as the collage: the grid layouts match again the cells of the removed images
+  collager.setLayout(layout)
+  collager.setAdaptiveLayout(adaptive_levels, adaptive_threshold)
+  collager.setAssignment(assignment)
+  collager.setMaxUsage(max_usage)
+  collager.setThreshold(threshold)
+  collager.setNearSize(near_size)
+  if thumbnail_cache is not None:
+    collager.setThumbnailCache(thumbnail_cache)
+  collager.setImageWriter(image_writer)
+  print('Loading schema')
+  cleared, placed = collager.recollageRegion(schema_filepath, recollage_box, recollage_mask)
+  print('Replaced ' + str(len(cleared)) + ' images with ' + str(len(placed)) + ' images')
+  if len(placed) > 0:
+    collager.saveRegion(cleared, placed)
 else:
   print('Loading schema')
   # Load collage image
@@ -100,8 +340,17 @@ else:
   # Apply mask
   if apply_mask is not None:
     collage_image.applyMask(apply_mask)
-  # Resize and save
-  print('Resizing and saving')
-  collage_image.saveResized(output_image, scale_factor)
+  if export_tiles is not None:
+    # Render the tiles of the pyramid
+    print('Exporting tiles')
+    exporter = TileExporter.new(collage_image, scale_factor)
+    if thumbnail_cache is not None:
+      exporter.setThumbnailCache(thumbnail_cache)
+    exporter.export(export_tiles, workers if workers is not None else os.cpu_count())
+  else:
+    # Resize and save
+    print('Resizing and saving')
+    collage_image.saveResized(output_image, scale_factor, thumbnail_cache, prefetcher, image_writer)
+    image_writer.wait()
   
 sys.exit(0)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+from json import JSONEncoder
+from json import JSONDecoder
+from http.server import HTTPServer
+from http.server import BaseHTTPRequestHandler
+from lib import PyLog
+from lib import MosaicService
+
+path = os.path.abspath(__file__)
+MAIN_FOLDER = os.path.dirname(path)
+LOG_FOLDER = os.path.join(MAIN_FOLDER, 'log/')
+
+if not os.path.exists(LOG_FOLDER):
+  os.mkdir(LOG_FOLDER)
+
+logger = PyLog.new(LOG_FOLDER)
+
+JSON_encoder = JSONEncoder()
+JSON_decoder = JSONDecoder()
+
+parser = argparse.ArgumentParser(description="Photo Mosaic service")
+parser.add_argument('--resources', action='append', default=[], help='Directory with the images to load at start (can be repeated)')
+parser.add_argument('--tile-size', dest='tile_size', default=MosaicService.DEFAULT_TILE_SIZE, help='Size of the images in the collages, default:' + str(MosaicService.DEFAULT_TILE_SIZE))
+parser.add_argument('--precision', default=4, help='Precision (higher is better), default:4')
+parser.add_argument('--dedup', default=None, help='Use only one of the resources whose perceptual hashes differ by at most this number of bits, default:keep all')
+parser.add_argument('--host', default='127.0.0.1', help='Address to listen on, default:127.0.0.1')
+parser.add_argument('--port', default=8080, help='Port to listen on, default:8080')
+parser.add_argument('--debug', default=False, action='store_true', help='Debug')
+
+args = parser.parse_args()
+
+tile_size = int(args.tile_size)
+precision = int(args.precision)
+
+service = MosaicService.new(logger, args.debug)
+service.setTileSize(tile_size)
+if args.dedup is not None:
+  service.setDuplicatesDistance(int(args.dedup))
+for images_folder in args.resources:
+  if not os.path.isdir(images_folder):
+    print("Missing resources folder " + images_folder)
+    sys.exit(1)
+  service.getLibrary(images_folder, tile_size, precision)
+
+class RequestHandler(BaseHTTPRequestHandler):
+  # POST /collage with the pm.py options as JSON (e.g. {"input": ..., "output": ..., "resources": ..., "images_width": 32})
+  # POST /render of a saved schema (e.g. {"schema": ..., "output": ..., "resources": ..., "scale": 4})
+  # GET /libraries lists the loaded libraries
+
+  def sendJSON(self, code, data):
+    body = JSON_encoder.encode(data).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == '/libraries':
+      self.sendJSON(200, service.getLibrariesInfo())
+    else:
+      self.sendJSON(404, {'error': 'Not found'})
+
+  def do_POST(self):
+    if self.path == '/collage':
+      action = service.collage
+    elif self.path == '/render':
+      action = service.render
+    else:
+      self.sendJSON(404, {'error': 'Not found'})
+      return
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+      request = JSON_decoder.decode(self.rfile.read(length).decode('utf-8'))
+      result = action(request)
+    except ValueError as error:
+      self.sendJSON(400, {'error': str(error)})
+      return
+    except Exception as error:
+      self.sendJSON(500, {'error': str(error)})
+      return
+    self.sendJSON(200, result)
+
+# One request at a time: the libraries are shared by all the collages
+server = HTTPServer((args.host, int(args.port)), RequestHandler)
+print('Listening on ' + args.host + ':' + str(args.port))
+try:
+  server.serve_forever()
+except KeyboardInterrupt:
+  pass
+server.server_close()
+
+sys.exit(0)
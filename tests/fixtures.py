@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import os
+import numpy
+from PIL import Image
+from lib import PyLog
+
+def makeImage(path, size, seed):
+  # Two colour gradient, different for every seed
+  random_state = numpy.random.RandomState(seed)
+  width, height = size
+  start = random_state.randint(0, 256, 3)
+  end = random_state.randint(0, 256, 3)
+  ramp = numpy.linspace(0, 1, width)[None, :, None]
+  data = start + (end - start) * ramp
+  data = numpy.repeat(data, height, axis=0)
+  Image.fromarray(data.astype(numpy.uint8)).save(path)
+
+def makeResources(folder, number=24):
+  # Resources of a few aspect ratios
+  os.makedirs(folder, exist_ok=True)
+  sizes = [(48, 48), (64, 48), (48, 64), (80, 48)]
+  paths = []
+  for i in range(number):
+    path = os.path.join(folder, 'res_' + str(i).zfill(3) + '.png')
+    makeImage(path, sizes[i % len(sizes)], i)
+    paths.append(path)
+  return paths
+
+def makeBaseImage(path, size=(192, 144), seed=1000):
+  makeImage(path, size, seed)
+  return path
+
+def newLogger(folder):
+  return PyLog.new(os.path.join(folder, 'log'))
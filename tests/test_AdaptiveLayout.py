@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import numpy
+from PIL import Image
+from lib import Collager
+from lib import AdaptiveLayout
+from lib import ImageManager
+from tests import fixtures
+
+class TestAdaptiveLayout(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    # Flat on the left, noise on the right, not a multiple of the biggest cells
+    random_state = numpy.random.RandomState(0)
+    data = numpy.zeros((300, 420, 3), dtype=numpy.uint8)
+    data[:, :] = (90, 140, 200)
+    data[:, 210:] = random_state.randint(0, 256, (300, 210, 3))
+    self.base_image = os.path.join(folder, 'base.png')
+    Image.fromarray(data).save(self.base_image)
+    self.logger = fixtures.newLogger(folder)
+    self.output = os.path.join(folder, 'out.png')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def newCollager(self, layout):
+    collager = Collager.new(self.base_image, self.resources, 12, None, 4, self.logger, False)
+    collager.setOutputImage(self.output)
+    collager.setNearSize(1)
+    collager.setLayout(layout)
+    collager.setupBaseImage()
+    return collager
+
+  def test_uniform_cells_are_merged(self):
+    collager = self.newCollager(Collager.LAYOUT_ADAPTIVE)
+    layout = AdaptiveLayout.new(collager)
+    layout.setup()
+    width, height = collager.base_image.size
+    tile_size = layout.tile_size
+    merged = [(x, y, size) for x, y, size in layout.cells if size > tile_size]
+    self.assertGreater(len(merged), 0)
+    for x, y, size in merged:
+      # Only in the flat half, and inside the canvas
+      self.assertLessEqual(x + size, width // 2 + tile_size)
+      self.assertLessEqual(x + size, width)
+      self.assertLessEqual(y + size, height)
+    # The cells cover the canvas once
+    covered = numpy.zeros((height, width), dtype=numpy.int64)
+    for x, y, size in layout.cells:
+      covered[y:y+size, x:x+size] += 1
+    self.assertTrue(numpy.all(covered == 1))
+
+  def test_tiles_sectors(self):
+    collager = self.newCollager(Collager.LAYOUT_ADAPTIVE)
+    layout = AdaptiveLayout.new(collager)
+    layout.setup()
+    data = collager.base_image.getArray()
+    for tile, (x, y, size) in enumerate(layout.cells):
+      grid = ImageManager.computeSectorGrid(data[y:y+size, x:x+size], size // layout.lines)
+      height_lines, width_lines, _ = grid.shape
+      self.assertTrue(numpy.allclose(layout.tiles[tile, :height_lines, :width_lines], grid, atol=1e-3))
+      self.assertTrue(numpy.all(layout.tiles_mask[tile, :height_lines, :width_lines]))
+      self.assertEqual(numpy.sum(layout.tiles_mask[tile]), height_lines * width_lines)
+
+  def test_fewer_images_than_grid(self):
+    placed = {}
+    for layout in [Collager.LAYOUT_GRID, Collager.LAYOUT_ADAPTIVE]:
+      collager = self.newCollager(layout)
+      collager.collage()
+      placed[layout] = len(collager.collage_image.colours)
+    self.assertLess(placed[Collager.LAYOUT_ADAPTIVE], placed[Collager.LAYOUT_GRID])
+
+  def test_given_cells(self):
+    # Same tiles as the quadtree for the same cells, the images around them are near images
+    collager = self.newCollager(Collager.LAYOUT_ADAPTIVE)
+    collager.collage()
+    layout = AdaptiveLayout.new(collager)
+    layout.setup()
+    tile = len(layout.cells) // 2
+    x, y, size = layout.cells[tile]
+    collager.collage_image.removeImageAtPosition((x, y))
+    cells = AdaptiveLayout.new(collager)
+    cells.setupCells([(x, y, size)])
+    self.assertEqual(cells.tiles_number, 1)
+    self.assertTrue(numpy.allclose(cells.tiles[0], layout.tiles[tile]))
+    near = cells.getNearColours(numpy.full(1, -1, dtype=numpy.int64), 0)
+    expected = sorted(set(cells.index[colour] for colour in collager.getNearImages((x, y))))
+    self.assertGreater(len(expected), 0)
+    self.assertEqual(list(near), expected)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import itertools
+import unittest
+import numpy
+from lib import AssignmentSolver
+
+def bruteForce(costs, capacities):
+  # Min total cost assigning every tile within the capacities
+  tiles_number, colours_number = costs.shape
+  best = None
+  for assignment in itertools.product(range(colours_number), repeat=tiles_number):
+    if numpy.any(numpy.bincount(assignment, minlength=colours_number) > capacities):
+      continue
+    total = sum([costs[tile, colour] for tile, colour in enumerate(assignment)])
+    if best is None or total < best:
+      best = total
+  return best
+
+class TestAuctionSolver(unittest.TestCase):
+
+  def test_optimal_with_capacities(self):
+    random_state = numpy.random.RandomState(0)
+    epsilon = 0.01
+    for _ in range(20):
+      costs = random_state.uniform(0, 50, (6, 3))
+      capacities = numpy.array([3, 2, 1])
+      candidates = numpy.tile(numpy.arange(3), (6, 1))
+      solver = AssignmentSolver.new(candidates, costs, capacities, epsilon)
+      solution = solver.solve()
+      self.assertTrue(numpy.all(solution >= 0))
+      self.assertTrue(numpy.all(numpy.bincount(solution, minlength=3) <= capacities))
+      total = sum([costs[tile, colour] for tile, colour in enumerate(solution)])
+      self.assertLessEqual(total, bruteForce(costs, capacities) + 6 * epsilon + 1e-9)
+
+  def test_sparse_candidates(self):
+    # A tile only gets one of its candidates, tiles without candidates stay unassigned
+    costs = numpy.array([[1.0, 5.0], [1.0, 2.0], [0.0, 0.0]])
+    candidates = numpy.array([[0, 1], [0, -1], [-1, -1]])
+    capacities = numpy.array([1, 1])
+    solution = AssignmentSolver.new(candidates, costs, capacities, 0.01).solve()
+    self.assertEqual(list(solution), [1, 0, -1])
+
+  def test_capacity_leaves_tiles_unassigned(self):
+    costs = numpy.zeros((3, 1))
+    candidates = numpy.zeros((3, 1), dtype=numpy.int64)
+    solution = AssignmentSolver.new(candidates, costs, numpy.array([2])).solve()
+    self.assertEqual(int(numpy.sum(solution == 0)), 2)
+    self.assertEqual(int(numpy.sum(solution == -1)), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import numpy
+from lib import Collager
+from tests import fixtures
+
+class TestBands(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    self.base_image = fixtures.makeBaseImage(os.path.join(folder, 'base.png'), (400, 300))
+    self.logger = fixtures.newLogger(folder)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def newCollager(self):
+    collager = Collager.new(self.base_image, self.resources, 8, None, 4, self.logger, False)
+    collager.setOutputImage(os.path.join(self.tmp.name, 'out.png'))
+    collager.setNearSize(1)
+    collager.setLayout(Collager.LAYOUT_BANDS)
+    collager.setWorkers(3)
+    return collager
+
+  def test_no_squeezed_images_at_the_seams(self):
+    collager = self.newCollager()
+    collager.setupBaseImage()
+    bands = collager.getBands()
+    self.assertEqual(len(bands), 3)
+    seams = [end for start, end in bands[:-1]]
+    collager.collage()
+    collage_image = collager.collage_image
+    for position, size in collage_image.colours_size.items():
+      x, y = position
+      if any(y <= seam <= y + size[1] for seam in seams):
+        self.assertGreaterEqual(size[1], collager.collage_image_size_min)
+    # The bands and the seams cover the whole canvas, without overlaps
+    covered = numpy.zeros((collage_image.height, collage_image.width), dtype=numpy.int64)
+    for position, size in collage_image.colours_size.items():
+      x, y = position
+      covered[y:y+size[1], x:x+size[0]] += 1
+    self.assertTrue((covered == 1).all())
+
+  def test_squeezed_images_are_placed_again(self):
+    collager = self.newCollager()
+    collager.fixParameters()
+    collager.setupBaseImage()
+    collager.setupColours()
+    collage_image = collager.collage_image
+    bands = [(0, 96), (96, 300)]
+    squeezed = collager.collage_image_size_min - 7
+    # Lines of images of the two bands, the last line of the upper band is squeezed on the seam
+    lines = [(0, 96 - squeezed, bands[0]), (96 - squeezed, squeezed, bands[0]), (96, 64, bands[1]), (160, 70, bands[1]), (230, 70, bands[1])]
+    bands_colours = {}
+    for i, (y, height, band) in enumerate(lines):
+      for j in range(8):
+        colour = collager.colours[(5 * i + j) % len(collager.colours)]
+        collager.addSectionToImage(colour, (50 * j, y), (50, height))
+        bands_colours[(50 * j, y)] = band
+    collager.reconcileBands(bands, bands_colours)
+    for position, size in collage_image.colours_size.items():
+      x, y = position
+      if y <= 96 <= y + size[1]:
+        self.assertGreaterEqual(size[1], collager.collage_image_size_min)
+    covered = numpy.zeros((collage_image.height, collage_image.width), dtype=numpy.int64)
+    for position, size in collage_image.colours_size.items():
+      x, y = position
+      covered[y:y+size[1], x:x+size[0]] += 1
+    self.assertTrue((covered == 1).all())
+
+if __name__ == '__main__':
+  unittest.main()
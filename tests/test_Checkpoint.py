@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import tempfile
+import unittest
+import numpy
+from lib import Collager
+from tests import fixtures
+
+class TestCheckpoint(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    self.base_image = fixtures.makeBaseImage(os.path.join(folder, 'base.png'))
+    self.logger = fixtures.newLogger(folder)
+    self.output = os.path.join(folder, 'out.png')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def newCollager(self):
+    collager = Collager.new(self.base_image, self.resources, 6, None, 4, self.logger, False)
+    collager.setOutputImage(self.output)
+    collager.setNearSize(1)
+    collager.setupBaseImage()
+    collager.setupColours()
+    return collager
+
+  def getPlacements(self, collager):
+    collage_image = collager.collage_image
+    return sorted([(pos, collage_image.colours[pos].name, tuple(collage_image.colours_size[pos])) for pos in collage_image.colours])
+
+  def test_resume_gives_the_same_collage(self):
+    random.seed(1)
+    numpy.random.seed(1)
+    collager = self.newCollager()
+    collager.setCheckpointInterval(3)
+    collager.collageStart()
+    self.assertTrue(os.path.exists(collager.getCheckpointPath()))
+    self.assertGreater(collager.collage_placements, 3)
+    expected = self.getPlacements(collager)
+    # Continue from the last checkpoint with another collager
+    resumed = self.newCollager()
+    start = resumed.loadCheckpoint()
+    self.assertEqual(resumed.collage_placements % 3, 0)
+    resumed.collageStart(start)
+    self.assertEqual(self.getPlacements(resumed), expected)
+
+  def test_missing_checkpoint_starts_over(self):
+    collager = self.newCollager()
+    self.assertEqual(collager.loadCheckpoint(), 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import numpy
+from PIL import Image
+from lib import Collager
+from lib import CollageImage
+from lib import ImageManager
+from tests import fixtures
+
+class TestCollageImage(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    self.base_image = fixtures.makeBaseImage(os.path.join(folder, 'base.png'))
+    self.logger = fixtures.newLogger(folder)
+    self.output = os.path.join(folder, 'out.png')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def newCollager(self, layout):
+    collager = Collager.new(self.base_image, self.resources, 6, None, 4, self.logger, False)
+    collager.setOutputImage(self.output)
+    collager.setNearSize(1)
+    collager.setLayout(layout)
+    return collager
+
+  def collageWithoutDecoding(self, collager):
+    # Fails if a resource is decoded after the library is loaded
+    new_from_path = ImageManager.newFromPath
+    new_from_content = ImageManager.newFromContent
+    def failDecode(*args, **kwargs):
+      raise AssertionError('Resource decoded again: ' + str(args[-1]))
+    ImageManager.newFromPath = failDecode
+    ImageManager.newFromContent = failDecode
+    try:
+      collager.collage()
+    finally:
+      ImageManager.newFromPath = new_from_path
+      ImageManager.newFromContent = new_from_content
+
+  def test_placements_do_not_decode(self):
+    for layout in [Collager.LAYOUT_SCAN, Collager.LAYOUT_GRID, Collager.LAYOUT_ADAPTIVE]:
+      collager = self.newCollager(layout)
+      self.collageWithoutDecoding(collager)
+      self.assertGreater(len(collager.collage_image.colours), 0)
+
+  def test_tile_signature_from_the_pyramid(self):
+    collager = self.newCollager(Collager.LAYOUT_GRID)
+    lines = collager.collage_image_size // collager.sector_size
+    for colour in collager.colours:
+      loaded = colour.getTileSignature(collager.collage_image_size)
+      self.assertEqual(loaded.shape, (lines, lines, 3))
+      # Without the signature built at load the closest level is sampled
+      tile_signature = colour.tile_signature
+      colour.tile_signature = None
+      sampled = colour.getTileSignature(collager.collage_image_size)
+      colour.tile_signature = tile_signature
+      self.assertEqual(sampled.shape, loaded.shape)
+      # Built from the centre square of the resource, never from a squeezed copy
+      with Image.open(colour.getFilepath()) as img:
+        width, height = img.size
+        side = min(width, height)
+        box = ((width - side) // 2, (height - side) // 2, (width + side) // 2, (height + side) // 2)
+        crop = img.convert('RGB').crop(box).resize((lines, lines), Image.BOX)
+      numpy.testing.assert_allclose(loaded, numpy.asarray(crop), atol=6)
+
+  def test_preview(self):
+    collager = self.newCollager(Collager.LAYOUT_GRID)
+    collager.collage()
+    collage_image = collager.collage_image
+    preview = collage_image.getPreview(50)
+    self.assertEqual(max(preview.size), 50)
+    self.assertEqual(collage_image.getPreview().size, tuple(collage_image.size))
+
+  def test_occupancy_bits(self):
+    # Same answers as a bool array
+    random_state = numpy.random.RandomState(0)
+    collage_image = CollageImage.new((37, 29))
+    expected = numpy.zeros((29, 37), dtype=bool)
+    for _ in range(60):
+      x, y = random_state.randint(0, 37), random_state.randint(0, 29)
+      width, height = random_state.randint(1, 20, 2)
+      value = bool(random_state.randint(2))
+      collage_image.setOccupied((x, y), (width, height), value)
+      expected[y:y+height, x:x+width] = value
+      self.assertTrue(numpy.array_equal(collage_image.getOccupied((0, 0), (37, 29)), expected))
+      x, y = random_state.randint(0, 37), random_state.randint(0, 29)
+      self.assertEqual(collage_image.isPositionEmpty((x, y)), not expected[y, x])
+      self.assertEqual(collage_image.getMaxSpaceRight((x, y), 50), int(numpy.argmax(numpy.append(expected[y, x:], True))))
+      self.assertEqual(collage_image.getMaxSpaceBottom((x, y), 50), int(numpy.argmax(numpy.append(expected[y:, x], True))))
+
+  def test_occupied_mask(self):
+    collage_image = CollageImage.new((20, 10))
+    colour = CollageImage.newColour('image.png', (10, 10))
+    # Overlapping images over more than the collage area, past the border, with a hole
+    collage_image.markColourAtPosition(colour, (0, 0), (12, 10))
+    collage_image.markColourAtPosition(colour, (8, 0), (10, 10))
+    collage_image.markColourAtPosition(colour, (15, 0), (10, 4))
+    mask = collage_image.getOccupiedMask(2)
+    self.assertIsNotNone(mask)
+    self.assertEqual(mask.size, (40, 20))
+    mask = numpy.asarray(mask)
+    self.assertTrue(numpy.all(mask[:, :36] == 255))
+    self.assertTrue(numpy.all(mask[:8, 36:] == 255))
+    self.assertTrue(numpy.all(mask[8:, 36:] == 0))
+    collage_image.markColourAtPosition(colour, (18, 4), (2, 6))
+    self.assertIsNone(collage_image.getOccupiedMask(2))
+
+if __name__ == '__main__':
+  unittest.main()
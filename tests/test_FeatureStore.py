@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import multiprocessing
+import numpy
+from lib import Collager
+from lib import FeatureStore
+from tests import fixtures
+
+def readStore(layout):
+  # Sum of the signatures seen by another process
+  store = FeatureStore.attach(layout)
+  total = float(numpy.sum(store['signatures']))
+  store.release()
+  return total
+
+class TestFeatureStore(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    self.base_image = fixtures.makeBaseImage(os.path.join(folder, 'base.png'))
+    self.logger = fixtures.newLogger(folder)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def newCollager(self, layout, workers):
+    collager = Collager.new(self.base_image, self.resources, 6, None, 4, self.logger, False)
+    collager.setOutputImage(os.path.join(self.tmp.name, 'out.png'))
+    collager.setNearSize(1)
+    collager.setLayout(layout)
+    collager.setWorkers(workers)
+    collager.setupBaseImage()
+    return collager
+
+  def test_pyramids_are_views_of_the_store(self):
+    collager = self.newCollager(Collager.LAYOUT_SCAN, 1)
+    levels = collager.getPyramidLevels()
+    pyramids = [dict(colour.pyramid) for colour in collager.colours]
+    store = FeatureStore.newFromColours(collager.colours, levels)
+    for colour, pyramid in zip(collager.colours, pyramids):
+      for level in levels:
+        self.assertTrue(numpy.array_equal(colour.pyramid[level], pyramid[level]))
+        self.assertTrue(numpy.shares_memory(colour.pyramid[level], store['signatures']))
+        self.assertFalse(colour.pyramid[level].flags.writeable)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+      total = pool.apply(readStore, (store.getLayout(),))
+    self.assertAlmostEqual(total, float(numpy.sum(store['signatures'])), places=0)
+    store.release()
+
+  def test_bands_workers_share_the_store(self):
+    collager = self.newCollager(Collager.LAYOUT_BANDS, 2)
+    collager.setupColours()
+    self.assertIsNone(collager.matcher)
+    self.assertEqual(len(collager.library.stores), 1)
+    collager = self.newCollager(Collager.LAYOUT_SCAN, 1)
+    collager.setupColours()
+    self.assertEqual(len(collager.library.stores), 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import numpy
+from lib import FittingCache
+from lib import ResourceLibrary
+from tests import fixtures
+
+class Colour():
+  # Dimensions only, as used by the cache
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+
+class TestFittingCache(unittest.TestCase):
+
+  def setUp(self):
+    random_state = numpy.random.RandomState(0)
+    self.colours = [Colour(int(width), int(height)) for width, height in random_state.randint(20, 120, (50, 2))]
+    self.areas = [((64, 64), (32, 32)), ((200, 40), (10, 40)), ((30, 90), (30, 20))]
+
+  def test_candidates_only_are_computed(self):
+    for ladder in [None, [24, 32, 40, 48, 56, 64]]:
+      cache = FittingCache.new(self.colours, 24, ladder)
+      everything = numpy.arange(len(self.colours))
+      for max_area, min_area in self.areas:
+        candidates = numpy.array([3, 7, 11])
+        geometry = cache.getGeometry(max_area, min_area, candidates)
+        self.assertEqual(list(numpy.nonzero(geometry['known'])[0]), [3, 7, 11])
+        full = cache.computeGeometry(max_area, min_area, everything)
+        geometry = cache.getGeometry(max_area, min_area, everything)
+        for field in full:
+          self.assertTrue(numpy.array_equal(geometry[field], full[field]), field)
+      self.assertEqual(cache.misses, 2 * len(self.areas))
+
+  def test_scalar_path_computes_the_whole_area(self):
+    for ladder in [None, [24, 32, 40, 48, 56, 64]]:
+      cache = FittingCache.new(self.colours, 24, ladder)
+      everything = numpy.arange(len(self.colours))
+      for max_area, min_area in self.areas:
+        cache.getGeometry(max_area, min_area, numpy.array([3, 7]))
+        for colour in self.colours:
+          size, difference = cache.checkFitting(colour, max_area, min_area)
+          self.assertIsInstance(size[0], int)
+          self.assertIsInstance(difference, float)
+        geometry = cache.getGeometry(max_area, min_area)
+        self.assertTrue(numpy.all(geometry['known']))
+        full = cache.computeGeometry(max_area, min_area, everything)
+        for field in full:
+          self.assertTrue(numpy.array_equal(geometry[field], full[field]), field)
+      # The candidates of the batch path, then all the colours at the first scalar call
+      self.assertEqual(cache.misses, 2 * len(self.areas))
+      self.assertEqual(cache.hits, len(self.areas) * len(self.colours))
+
+  def test_sizes_fit_the_area(self):
+    cache = FittingCache.new(self.colours, 24)
+    indices = numpy.arange(len(self.colours))
+    for max_area, min_area in self.areas:
+      widths, heights, differences = cache.checkFittings(indices, max_area, min_area)
+      geometry = cache.getGeometry(max_area, min_area, indices)
+      fitting = geometry['fitting']
+      self.assertTrue(numpy.all(widths[fitting] <= max_area[0] + 1))
+      self.assertTrue(numpy.all(heights[fitting] <= max_area[1] + 1))
+      self.assertTrue(numpy.all(differences[fitting] == 0))
+
+class TestAnnIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    resources = os.path.join(self.tmp.name, 'res')
+    fixtures.makeResources(resources, 40)
+    self.library = ResourceLibrary.new(resources, 32, 4)
+    self.library.setLogger(fixtures.newLogger(self.tmp.name).createInfoLogger('library.txt', self))
+    self.library.load()
+    self.index = self.library.getAnnIndex()
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def referenceQuery(self, refer_signature, excluded, k, probes):
+    # Every list visited in order of distance, excluded colours removed with isin
+    index = self.index
+    vector = index.project(index.getVector(refer_signature)[None].astype(numpy.float32))[0]
+    excluded_indices = numpy.array([index.index[colour] for colour in excluded], dtype=numpy.int64)
+    order = numpy.argsort(numpy.sum((index.centroids - vector) ** 2, axis=1))
+    candidates = []
+    found = 0
+    for probed, l in enumerate(order):
+      if probed >= probes and found >= k:
+        break
+      members = index.lists[l]
+      members = members[numpy.logical_not(numpy.isin(members, excluded_indices))]
+      candidates.append(members)
+      found += len(members)
+    candidates = numpy.concatenate(candidates)
+    if len(candidates) > k:
+      distances = numpy.sum((index.vectors[candidates] - vector) ** 2, axis=1)
+      candidates = candidates[numpy.argpartition(distances, k - 1)[:k]]
+    return candidates
+
+  def test_query_matches_the_reference(self):
+    colours = self.library.colours
+    for i, colour in enumerate(colours):
+      signature = colour.getSignature(colour.getSize())
+      excluded = colours[i:i+5]
+      for k, probes in [(4, 1), (8, 2), (30, 1)]:
+        result = self.index.query(signature, excluded, k, probes)
+        expected = self.referenceQuery(signature, excluded, k, probes)
+        self.assertEqual(sorted(result.tolist()), sorted(expected.tolist()))
+        self.assertFalse(any(colours[j] in excluded for j in result))
+      self.assertFalse(numpy.any(self.index.excluded))
+
+if __name__ == '__main__':
+  unittest.main()
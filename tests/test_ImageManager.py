@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import unittest
+import numpy
+from PIL import Image
+from lib import ImageManager
+
+class TestSectors(unittest.TestCase):
+
+  def setUp(self):
+    random_state = numpy.random.RandomState(0)
+    self.data = random_state.randint(0, 256, (37, 53, 3)).astype(numpy.uint8)
+
+  def test_array_is_uint8(self):
+    img = ImageManager.newFromData(Image.fromarray(self.data))
+    self.assertEqual(img.getArray().dtype, numpy.uint8)
+
+  def test_sector_grid_on_uint8(self):
+    # Same means as on a float copy, including the smaller border sectors
+    grid = ImageManager.computeSectorGrid(self.data, 8)
+    expected = ImageManager.computeSectorGrid(self.data.astype(numpy.float64), 8)
+    self.assertEqual(grid.shape, (5, 7, 3))
+    numpy.testing.assert_allclose(grid, expected)
+    numpy.testing.assert_allclose(grid[-1, -1], numpy.mean(self.data[32:, 48:], axis=(0, 1)))
+
+  def test_shifted_signature(self):
+    img = ImageManager.newFromData(Image.fromarray(self.data))
+    img.setSectorSize(4)
+    signature = img.createShiftedSignature((8, 4), (16, 8))
+    self.assertEqual(signature.shape, (2, 4, 3))
+    numpy.testing.assert_allclose(signature[0, 0], numpy.mean(self.data[4:8, 8:12], axis=(0, 1)))
+  def test_resized_copy_is_centre_cropped(self):
+    # Red borders on the sides of a 2:1 image are cropped away, not squeezed in
+    data = numpy.zeros((40, 80, 3), numpy.uint8)
+    data[:, :, 2] = 255
+    data[:, :20] = (255, 0, 0)
+    data[:, 60:] = (255, 0, 0)
+    img = ImageManager.newFromData(Image.fromarray(data))
+    resized = numpy.asarray(img.getResizedCopy((16, 16)))
+    self.assertEqual(resized.shape, (16, 16, 3))
+    # Only the filter support at the box edges may reach the cropped borders
+    self.assertTrue((resized[:, 1:-1, 0] == 0).all())
+    self.assertTrue((resized[:, :, 0] < 64).all())
+    self.assertEqual(ImageManager.getCropBox((80, 40), (16, 16)), (20.0, 0.0, 60.0, 40.0))
+    self.assertEqual(ImageManager.getCropBox((40, 80), (20, 10)), (0.0, 30.0, 40.0, 50.0))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from PIL import Image
+from lib import ImageWriter
+from tests import fixtures
+
+class TestImageWriter(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    source = fixtures.makeBaseImage(os.path.join(self.tmp.name, 'source.png'), (300, 700))
+    self.img = Image.open(source).convert('RGB')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_tiff_strips(self):
+    savepath = os.path.join(self.tmp.name, 'out.tif')
+    ImageWriter.new().write(self.img, savepath)
+    with Image.open(savepath) as saved:
+      self.assertEqual(saved.tag_v2[278], ImageWriter.DEFAULT_ROWS_PER_STRIP)
+      self.assertEqual(saved.tag_v2[259], 8) # Adobe deflate
+      self.assertEqual(saved.convert('RGB').tobytes(), self.img.tobytes())
+
+  def test_format_from_extension(self):
+    writer = ImageWriter.new()
+    for ext, image_format in [('.png', 'PNG'), ('.jpg', 'JPEG'), ('.webp', 'WEBP')]:
+      savepath = os.path.join(self.tmp.name, 'out' + ext)
+      writer.start(self.img.copy(), savepath, Image.new('L', self.img.size, 255))
+      writer.wait()
+      with Image.open(savepath) as saved:
+        self.assertEqual(saved.format, image_format)
+        self.assertEqual(saved.size, self.img.size)
+    self.assertEqual(ImageWriter.getExtension(ImageWriter.FORMAT_JPEG), '.jpg')
+
+if __name__ == '__main__':
+  unittest.main()
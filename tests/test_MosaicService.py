@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from PIL import Image
+from lib import MosaicService
+from lib import ThumbnailCache
+from tests import fixtures
+
+class TestMosaicService(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    self.base_image = fixtures.makeBaseImage(os.path.join(folder, 'base.png'))
+    self.output = os.path.join(folder, 'out.png')
+    self.service = MosaicService.new(fixtures.newLogger(folder))
+    self.service.setTileSize(32)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_render_uses_the_loaded_library(self):
+    result = self.service.collage({'input': self.base_image, 'output': self.output, 'resources': self.resources, 'images_width': 6, 'near_size': 1})
+    self.assertEqual(len(self.service.libraries), 1)
+    library = list(self.service.libraries.values())[0]
+    scaled = os.path.join(self.tmp.name, 'scaled.png')
+    render = self.service.render({'schema': result['schema'], 'output': scaled, 'resources': self.resources, 'scale': 2})
+    self.assertEqual(render['output'], scaled)
+    # Same library, the render did not load the resources again
+    self.assertEqual(list(self.service.libraries.values()), [library])
+    width, height = Image.open(self.output).size
+    self.assertEqual(Image.open(scaled).size, (2 * width, 2 * height))
+
+  def test_render_checks_the_options(self):
+    with self.assertRaises(ValueError):
+      self.service.render({'schema': 'missing.cls', 'output': self.output, 'resources': self.resources})
+    with self.assertRaises(ValueError):
+      self.service.render({'schema': self.base_image, 'output': self.output, 'resources': self.resources, 'images_width': 3})
+
+  def test_batch_options_reach_the_collager(self):
+    cache = ThumbnailCache.new(os.path.join(self.tmp.name, 'cache'))
+    self.service.setThumbnailCache(cache)
+    collager = self.service.newCollager({'input': self.base_image, 'output': self.output, 'resources': self.resources,
+      'show_previews': True, 'preview_size': 100, 'checkpoint': 5, 'resume': True})
+    self.assertTrue(collager.show_partials)
+    self.assertEqual(collager.preview_size, 100)
+    self.assertEqual(collager.checkpoint_interval, 5)
+    self.assertTrue(collager.resume)
+    self.assertIs(collager.thumbnail_cache, cache)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import unittest
+from PIL import Image
+from lib import Collager
+from lib import CollageImage
+from lib import PreviewWriter
+from tests import fixtures
+
+class TestPreviewWriter(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    self.base_image = fixtures.makeBaseImage(os.path.join(folder, 'base.png'))
+    self.logger = fixtures.newLogger(folder)
+    self.output = os.path.join(folder, 'out.png')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_preview_painted_by_the_writer(self):
+    collager = Collager.new(self.base_image, self.resources, 6, None, 4, self.logger, False)
+    collager.setOutputImage(self.output)
+    collager.setNearSize(1)
+    collager.setLayout(Collager.LAYOUT_GRID)
+    collager.collage()
+    collage_image = collager.collage_image
+    # Painting is left to the writer thread
+    paint_preview = CollageImage.paintPreview
+    threads = []
+    def recordThread(*args, **kwargs):
+      threads.append(threading.current_thread())
+      return paint_preview(*args, **kwargs)
+    CollageImage.paintPreview = recordThread
+    try:
+      writer = PreviewWriter.new(self.output, 50)
+      writer.submit(collage_image.size, collage_image.getPlacements())
+      writer.close()
+    finally:
+      CollageImage.paintPreview = paint_preview
+    self.assertEqual(len(threads), 1)
+    self.assertIsNot(threads[0], threading.current_thread())
+    with Image.open(self.output) as img:
+      preview = img.convert('RGB')
+    expected = collage_image.getPreview(50)
+    self.assertEqual(preview.size, expected.size)
+    self.assertEqual(max(preview.size), 50)
+    self.assertEqual(list(preview.getdata()), list(expected.getdata()))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import random
+import tempfile
+import unittest
+import numpy
+from lib import Collager
+from tests import fixtures
+
+class TestRecollage(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    self.base_image = fixtures.makeBaseImage(os.path.join(folder, 'base.png'))
+    self.logger = fixtures.newLogger(folder)
+    self.output = os.path.join(folder, 'out.png')
+    random.seed(1)
+    numpy.random.seed(1)
+    collager = self.newCollager()
+    collager.collage()
+    collager.save()
+    self.schema = self.output + '.schema.cls'
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def newCollager(self):
+    collager = Collager.new(self.base_image, self.resources, 6, None, 4, self.logger, False)
+    collager.setOutputImage(self.output)
+    collager.setNearSize(1)
+    return collager
+
+  def readSchema(self):
+    with open(self.schema, 'r') as hand:
+      lines = [json.loads(line) for line in hand]
+    return lines[0], lines[1:]
+
+  def test_base_image_is_not_resized(self):
+    collager = self.newCollager()
+    def failResize(width, height):
+      raise AssertionError('Base image resized to ' + str((width, height)))
+    collager.base_image.resize = failResize
+    cleared, placed = collager.recollageRegion(self.schema, (0, 0, 40, 40))
+    self.assertGreater(len(cleared), 0)
+
+  def test_only_the_cleared_areas_are_filled(self):
+    # Leave a hole on the top left corner
+    size, images = self.readSchema()
+    images = sorted(images, key=lambda el : (el[1][1], el[1][0]))
+    hole = images[0]
+    self.assertEqual(hole[1], [0, 0])
+    with open(self.schema, 'w') as hand:
+      for line in [size] + images[1:]:
+        hand.write(json.dumps(line) + '\n')
+    collager = self.newCollager()
+    width, height = size
+    cleared, placed = collager.recollageRegion(self.schema, (width - 40, 0, width, 40))
+    self.assertGreater(len(placed), 0)
+    region = numpy.zeros((height, width), dtype=bool)
+    for position, cleared_size in cleared:
+      region[position[1]:position[1]+cleared_size[1], position[0]:position[0]+cleared_size[0]] = True
+    for x, y in placed:
+      self.assertTrue(region[y, x])
+    self.assertTrue(collager.collage_image.isPositionEmpty((0, 0)))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+import numpy
+from PIL import Image
+from lib import ResourceLibrary
+from tests import fixtures
+
+def bruteForceGroups(hashes, max_distance):
+  # Connected components of the pairs within max_distance bits
+  parents = list(range(len(hashes)))
+  def find(i):
+    while parents[i] != i:
+      i = parents[i]
+    return i
+  for i in range(len(hashes)):
+    for j in range(i + 1, len(hashes)):
+      if bin(hashes[i] ^ hashes[j]).count('1') <= max_distance:
+        parents[find(j)] = find(i)
+  groups = {}
+  for i in range(len(hashes)):
+    groups.setdefault(find(i), []).append(i)
+  return sorted([group for group in groups.values() if len(group) > 1])
+
+class TestResourceLibrary(unittest.TestCase):
+
+  def test_duplicate_groups_match_brute_force(self):
+    random_state = numpy.random.RandomState(0)
+    hashes = [int(value) for value in random_state.randint(0, 2**63, 200, dtype=numpy.int64)]
+    # Near copies with a few flipped bits, and chains of them
+    for i in range(40):
+      value = hashes[random_state.randint(len(hashes))]
+      for bit in random_state.choice(64, random_state.randint(0, 6), replace=False):
+        value ^= 1 << int(bit)
+      hashes.append(value)
+    for max_distance in [0, 1, 3, 5, 8]:
+      groups = sorted([sorted(group) for group in ResourceLibrary.findDuplicateGroups(hashes, max_distance)])
+      self.assertEqual(groups, bruteForceGroups(hashes, max_distance))
+
+  def test_near_duplicates_are_removed(self):
+    with tempfile.TemporaryDirectory() as folder:
+      # Random blocks: the gradients of the fixtures have close hashes
+      resources = os.path.join(folder, 'res')
+      os.makedirs(resources)
+      random_state = numpy.random.RandomState(0)
+      paths = []
+      for i in range(8):
+        path = os.path.join(resources, 'res_' + str(i).zfill(3) + '.png')
+        blocks = random_state.randint(0, 256, (6, 8, 3)).astype(numpy.uint8)
+        Image.fromarray(blocks).resize((64, 48), Image.NEAREST).save(path)
+        paths.append(path)
+      # A bigger copy of the first image, kept instead of the original
+      with Image.open(paths[0]) as img:
+        img.resize((img.width * 2, img.height * 2)).save(os.path.join(resources, 'copy.png'))
+      library = ResourceLibrary.new(resources, 32, 4, 0)
+      library.setLogger(fixtures.newLogger(folder).createInfoLogger('library.txt', self))
+      library.load()
+      self.assertEqual(len(library.colours), 8)
+      self.assertEqual(len(library.duplicates), 1)
+      self.assertEqual([colour.name for colour in library.duplicates[0]], ['copy.png', 'res_000.png'])
+      report = os.path.join(folder, 'duplicates.txt')
+      library.saveDuplicatesReport(report)
+      with open(report, 'r') as hand:
+        self.assertEqual(hand.read().strip().split('\t'), [os.path.join(resources, 'copy.png'), paths[0]])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from lib import ResourceScanner
+from tests import fixtures
+
+class TestResourceScanner(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.folder = os.path.join(self.tmp.name, 'res')
+    for subfolder in ['', 'b', 'a', os.path.join('a', 'c')]:
+      os.makedirs(os.path.join(self.folder, subfolder), exist_ok=True)
+      fixtures.makeImage(os.path.join(self.folder, subfolder, 'image.png'), (8, 8), 0)
+    with open(os.path.join(self.folder, 'notes.txt'), 'w') as hand:
+      hand.write('not an image')
+    self.names = ['a/c/image.png', 'a/image.png', 'b/image.png', 'image.png']
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def getNames(self, paths):
+    return sorted([ResourceScanner.getRelativeName(path, self.folder) for path in paths])
+
+  def test_scan_is_recursive(self):
+    self.assertEqual(self.getNames(ResourceScanner.scanImages(self.folder)), self.names)
+
+  def test_manifest_is_saved_and_read(self):
+    manifest = os.path.join(self.tmp.name, 'manifest.txt')
+    self.assertEqual(self.getNames(ResourceScanner.iterImages(self.folder, manifest)), self.names)
+    with open(manifest, 'r') as hand:
+      self.assertEqual(sorted(hand.read().split()), self.names)
+    # The manifest is used as it is, the folder is not scanned again
+    with open(manifest, 'w') as hand:
+      hand.write('b/image.png\n\nnotes.txt\n')
+    self.assertEqual(self.getNames(ResourceScanner.iterImages(self.folder, manifest)), ['b/image.png'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import tempfile
+import unittest
+import numpy
+from PIL import Image
+from lib import MosaicService
+from tests import fixtures
+
+class TestSequence(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources)
+    # Three frames: the second is the same as the first, the third changes on the top left
+    first = fixtures.makeBaseImage(os.path.join(folder, 'frame_0.png'))
+    data = numpy.array(Image.open(first))
+    Image.fromarray(data).save(os.path.join(folder, 'frame_1.png'))
+    data[:48, :48] = 255 - data[:48, :48]
+    Image.fromarray(data).save(os.path.join(folder, 'frame_2.png'))
+    self.frames = [os.path.join(folder, 'frame_' + str(i) + '.png') for i in range(3)]
+    self.service = MosaicService.new(fixtures.newLogger(folder))
+    self.service.setTileSize(32)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def readSchema(self, result):
+    with open(result['schema'], 'r') as hand:
+      return sorted([tuple(map(str, json.loads(line))) for line in hand.readlines()[1:]])
+
+  def test_frames_reuse_the_previous_collage(self):
+    requests = []
+    for i, frame in enumerate(self.frames):
+      requests.append({'input': frame, 'output': os.path.join(self.tmp.name, 'out_' + str(i) + '.png'), 'resources': self.resources, 'images_width': 6, 'near_size': 1})
+    results = self.service.collageSequence(requests)
+    self.assertFalse(any('error' in result for result in results))
+    schemas = [set(self.readSchema(result)) for result in results]
+    # Same frame: same collage
+    self.assertEqual(schemas[0], schemas[1])
+    # Only the images over the changed area are replaced
+    changed = schemas[1] - schemas[2]
+    self.assertGreater(len(changed), 0)
+    self.assertLess(len(changed), len(schemas[1]))
+    for image in schemas[1]:
+      x, y = json.loads(image[1])
+      if x >= 48 or y >= 48:
+        self.assertIn(image, schemas[2])
+    size = Image.open(results[0]['output']).size
+    for result in results:
+      self.assertEqual(Image.open(result['output']).size, size)
+
+  def runSequence(self, options):
+    requests = []
+    for i, frame in enumerate(self.frames):
+      request = {'input': frame, 'output': os.path.join(self.tmp.name, 'out_' + str(i) + '.png'), 'resources': self.resources, 'images_width': 6, 'near_size': 1}
+      request.update(options)
+      requests.append(request)
+    results = self.service.collageSequence(requests)
+    self.assertEqual([result.get('error') for result in results], [None] * len(results))
+    return results
+
+  def test_previews_do_not_overwrite_the_frames(self):
+    # The previews of the first frame are written over its output, never over the next frames
+    results = self.runSequence({'show_previews': True, 'preview_size': 64})
+    size = Image.open(results[0]['output']).size
+    self.assertGreater(max(size), 64)
+    for result in results:
+      self.assertEqual(Image.open(result['output']).size, size)
+
+  def test_grid_layouts_keep_the_cells(self):
+    for layout in ['grid', 'adaptive']:
+      results = self.runSequence({'layout': layout})
+      schemas = [self.readSchema(result) for result in results]
+      cells = [sorted((position, size) for name, position, size in schema) for schema in schemas]
+      self.assertEqual(cells[0], cells[1])
+      self.assertEqual(cells[1], cells[2])
+      if layout == 'grid':
+        # The tiles over the changed area are matched again
+        self.assertNotEqual(schemas[1], schemas[2])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from lib import ThumbnailCache
+from tests import fixtures
+
+def putThumbnails(args):
+  # Worker saving the same thumbnails as the others
+  folder, paths = args
+  cache = ThumbnailCache.new(folder)
+  for path in paths:
+    cache.getResized(path, (20, 20))
+
+class TestThumbnailCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.resources = fixtures.makeResources(os.path.join(self.tmp.name, 'res'), 8)
+    self.folder = os.path.join(self.tmp.name, 'cache')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_thumbnails_are_keyed_by_content(self):
+    cache = ThumbnailCache.new(self.folder)
+    img = cache.getResized(self.resources[0], (24, 24))
+    self.assertEqual(img.size, (24, 24))
+    copy = os.path.join(self.tmp.name, 'copy.png')
+    shutil.copy(self.resources[0], copy)
+    cache.getResized(copy, (24, 24))
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+    # Another run finds the thumbnail on disk
+    cache = ThumbnailCache.new(self.folder)
+    cache.getResized(self.resources[0], (24, 24))
+    self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+  def test_least_recently_used_are_evicted(self):
+    cache = ThumbnailCache.new(self.folder)
+    for path in self.resources[:3]:
+      cache.getResized(path, (40, 40))
+    sizes = [entry[1] for entry in cache.entries.values()]
+    cache.getResized(self.resources[0], (40, 40)) # Used again
+    cache.setMaxSize((sum(sizes) - min(sizes) + 1) / 2**20)
+    self.assertEqual(len(cache.entries), 2)
+    self.assertIsNotNone(cache.get(self.resources[0], (40, 40)))
+    self.assertIsNone(cache.get(self.resources[1], (40, 40)))
+
+  def test_deferred_eviction(self):
+    cache = ThumbnailCache.new(self.folder, 0)
+    cache.setDeferredEviction(True)
+    for path in self.resources:
+      cache.getResized(path, (16, 16))
+    self.assertEqual(len(os.listdir(self.folder)), len(self.resources))
+    cache.refresh()
+    self.assertEqual(os.listdir(self.folder), [])
+
+  def test_concurrent_writes(self):
+    # Processes writing the same thumbnails leave only complete files
+    context = multiprocessing.get_context('fork')
+    with context.Pool(4) as pool:
+      pool.map(putThumbnails, [(self.folder, self.resources)] * 4)
+    names = sorted(os.listdir(self.folder))
+    self.assertEqual(len(names), len(self.resources))
+    self.assertTrue(all(name.endswith(ThumbnailCache.THUMBNAIL_EXTENSION) for name in names))
+    cache = ThumbnailCache.new(self.folder)
+    for path in self.resources:
+      self.assertEqual(cache.get(path, (20, 20)).size, (20, 20))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import tempfile
+import unittest
+import numpy
+from PIL import Image
+from lib import CollageImage
+from lib import ImageManager
+from lib import TileExporter
+from lib import ThumbnailCache
+from tests import fixtures
+
+class TestTileExporter(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    folder = self.tmp.name
+    self.resources = os.path.join(folder, 'res')
+    fixtures.makeResources(self.resources, 4)
+    # Four images of 120x120 on a 240x240 collage: every image spans four tiles of 64
+    self.schema = os.path.join(folder, 'collage.cls')
+    with open(self.schema, 'w') as hand:
+      hand.write(json.dumps([240, 240]) + '\n')
+      for i, position in enumerate([(0, 0), (120, 0), (0, 120), (120, 120)]):
+        hand.write(json.dumps(['res_' + str(i).zfill(3) + '.png', position, [120, 120]]) + '\n')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def export(self, tile_format, collage_image=None):
+    if collage_image is None:
+      collage_image = CollageImage.newFromSchema(self.schema, self.resources)
+    exporter = TileExporter.new(collage_image, 1, 64, tile_format)
+    savepath = os.path.join(self.tmp.name, tile_format, 'collage.dzi')
+    os.makedirs(os.path.dirname(savepath))
+    exporter.export(savepath, 1)
+    return exporter
+
+  def test_images_are_decoded_once(self):
+    collage_image = CollageImage.newFromSchema(self.schema, self.resources)
+    opened = []
+    new_from_path = ImageManager.newFromPath
+    def countOpens(*args, **kwargs):
+      opened.append(args[0])
+      return new_from_path(*args, **kwargs)
+    ImageManager.newFromPath = countOpens
+    try:
+      self.export('png', collage_image)
+    finally:
+      ImageManager.newFromPath = new_from_path
+    self.assertEqual(len(opened), 4)
+
+  def test_lower_levels_do_not_stack_losses(self):
+    lossless = self.export('png')
+    lossy = self.export('jpg')
+    # No lossless copies left
+    self.assertEqual(sorted(os.listdir(os.path.join(self.tmp.name, 'jpg'))), ['collage.dzi', 'collage_files'])
+    for level in range(lossless.max_level):
+      for tile in lossless.getLevelTiles(level):
+        # Same as compressing the lossless tile once
+        expected = io.BytesIO()
+        Image.open(lossless.getTilePath(*tile)).save(expected, 'JPEG')
+        expected = numpy.asarray(Image.open(expected))
+        result = numpy.asarray(Image.open(lossy.getTilePath(*tile)))
+        self.assertTrue(numpy.array_equal(expected, result))
+
+  def test_workers_leave_the_eviction_to_the_parent(self):
+    collage_image = CollageImage.newFromSchema(self.schema, self.resources)
+    cache = ThumbnailCache.new(os.path.join(self.tmp.name, 'cache'), 0)
+    exporter = TileExporter.new(collage_image, 1, 64, 'png')
+    exporter.setThumbnailCache(cache)
+    exporter.export(os.path.join(self.tmp.name, 'collage.dzi'), 2)
+    self.assertFalse(cache.deferred_eviction)
+    self.assertEqual(os.listdir(os.path.join(self.tmp.name, 'cache')), [])
+    self.assertTrue(os.path.exists(exporter.getTilePath(exporter.max_level, 3, 3)))
+
+if __name__ == '__main__':
+  unittest.main()